@@ -0,0 +1,186 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import time
+import imaplib
+import http.client
+
+# errors which mean that host is overloaded (timeouts, dropped connections,
+# ...). logical errors (wrong password, ...) do not change limits
+CONGESTION_ERROR_TYPES = (
+        OSError,
+        imaplib.IMAP4.abort,
+        http.client.HTTPException,
+        )
+# try is slow if its latency is more than ``SLOW_FACTOR`` times of the least
+# latency of the previous window (and more than ``SLOW_MIN_LATENCY``)
+SLOW_FACTOR = 3.0
+SLOW_MIN_LATENCY = 0.5
+LATENCY_WINDOW_SIZE = 50
+DECREASE_FACTOR = 0.5
+
+class LimitSlot:
+    pass
+
+class AimdLimit:
+    # limit of concurrent tries to one host. limit grows by one per try while
+    # no congestion is seen (slow start), then by one per ``limit`` tries
+    # (additive increase), and it is halved on congestion (multiplicative
+    # decrease). tries started before the last decrease do not decrease it
+    # again
+    
+    def __init__(self, host, min_limit, max_limit, log_func=None):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.slow_start = True
+        self.decrease_count = 0
+        self._log_func = log_func
+        self._cond = threading.Condition()
+        self._last_decrease_time = None
+        self._window_min_latency = None
+        self._window_count = 0
+        self._base_latency = None
+    
+    def _new_slot(self):
+        # caller must hold ``self._cond``
+        
+        self.in_flight += 1
+        
+        slot = LimitSlot()
+        slot.limit = self
+        slot.start_time = time.monotonic()
+        
+        return slot
+    
+    def try_acquire(self):
+        # this function is thread-safe. returns ``None`` if limit is reached
+        
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return
+            
+            return self._new_slot()
+    
+    def acquire(self):
+        # this function is thread-safe
+        
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            
+            return self._new_slot()
+    
+    def _is_slow(self, latency):
+        # caller must hold ``self._cond``
+        
+        if self._window_min_latency is None or latency < self._window_min_latency:
+            self._window_min_latency = latency
+        
+        self._window_count += 1
+        
+        if self._window_count >= LATENCY_WINDOW_SIZE:
+            self._base_latency = self._window_min_latency
+            self._window_min_latency = None
+            self._window_count = 0
+        
+        return self._base_latency is not None and \
+                latency > SLOW_MIN_LATENCY and \
+                latency > self._base_latency * SLOW_FACTOR
+    
+    def release(self, slot, error_type=None, latency=None):
+        # ``latency`` is ``None`` if duration of try does not tell about
+        # latency of host. this function is thread-safe
+        
+        with self._cond:
+            self.in_flight -= 1
+            old_limit = int(self.limit)
+            
+            if error_type is not None and \
+                    issubclass(error_type, CONGESTION_ERROR_TYPES):
+                reason = error_type.__name__
+            elif latency is not None and self._is_slow(latency):
+                reason = 'slow {:.3f}s'.format(latency)
+            else:
+                reason = None
+            
+            if reason is None:
+                if self.slow_start:
+                    self.limit += 1.0
+                else:
+                    self.limit += 1.0 / self.limit
+                
+                self.limit = min(self.limit, float(self.max_limit))
+            elif self._last_decrease_time is None or \
+                    slot.start_time >= self._last_decrease_time:
+                self.limit = max(self.limit * DECREASE_FACTOR, float(self.min_limit))
+                self.slow_start = False
+                self.decrease_count += 1
+                self._last_decrease_time = time.monotonic()
+            
+            new_limit = int(self.limit)
+            self._cond.notify_all()
+        
+        if new_limit != old_limit and self._log_func is not None:
+            self._log_func('adaptive: {}: limit {} -> {}{}'.format(
+                    self.host,
+                    old_limit,
+                    new_limit,
+                    ' ({})'.format(reason) if reason is not None else '',
+                    ))
+
+class AdaptiveConcurrency:
+    # ``AimdLimit`` for every host. limits are created on the first use
+    
+    def __init__(self, min_limit, max_limit, log_func=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._log_func = log_func
+        self._lock = threading.Lock()
+        self._limit_map = {}
+    
+    def get_limit(self, host):
+        # this function is thread-safe
+        
+        with self._lock:
+            limit = self._limit_map.get(host)
+            
+            if limit is None:
+                limit = self._limit_map[host] = AimdLimit(
+                        host,
+                        self.min_limit,
+                        self.max_limit,
+                        log_func=self._log_func,
+                        )
+            
+            return limit
+    
+    def limit_list(self):
+        # this function is thread-safe
+        
+        with self._lock:
+            return list(self._limit_map.values())
@@ -0,0 +1,222 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import asyncio
+import functools
+import time
+import imaplib
+from . import reactivator
+from . import mail_watch
+
+# async versions of phases. network calls of ``urllib`` and ``imaplib`` are
+# still blocking, so they are run in ``lj_reac_ctx.executor`` (a limited pool
+# of threads), but waiting between mailbox checks is done by the event loop.
+# so a job which is waiting for validation email does not hold any thread
+
+def new_wakeup(loop):
+    # returns future and thread-safe function which completes it (the
+    # function may be called even after the loop is closed)
+    
+    future = loop.create_future()
+    
+    def set_result():
+        if not future.done():
+            future.set_result(None)
+    
+    def wakeup_func():
+        try:
+            loop.call_soon_threadsafe(set_result)
+        except RuntimeError:
+            # the loop is closed
+            
+            pass
+    
+    return future, wakeup_func
+
+async def run_blocking(lj_reac_ctx, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    
+    return await loop.run_in_executor(
+            lj_reac_ctx.executor,
+            functools.partial(func, *args, **kwargs),
+            )
+
+async def login_phase(lj_reac_ctx):
+    resp = await run_blocking(
+            lj_reac_ctx,
+            reactivator.open_drained,
+            lj_reac_ctx,
+            reactivator.new_login_request(lj_reac_ctx),
+            )
+    
+    reactivator.check_login_resp(lj_reac_ctx, resp)
+
+async def send_valid_phase(lj_reac_ctx):
+    resp = await run_blocking(
+            lj_reac_ctx,
+            reactivator.open_drained,
+            lj_reac_ctx,
+            reactivator.new_send_valid_request(lj_reac_ctx),
+            )
+    
+    reactivator.check_send_valid_resp(lj_reac_ctx, resp)
+
+async def mail_phase(lj_reac_ctx):
+    # one IMAP session is kept during the phase. IDLE is not used here: it
+    # would hold a thread of executor, so the watcher gives only adaptive
+    # delays between checks, and waiting is done by the event loop
+    
+    await run_blocking(lj_reac_ctx, reactivator.mail_prepare, lj_reac_ctx)
+    
+    email = lj_reac_ctx.email
+    loop = asyncio.get_running_loop()
+    deadline = reactivator.budget_deadline(
+            lj_reac_ctx,
+            time.monotonic() + reactivator.MAIL_WAIT_TIMEOUT,
+            )
+    
+    try:
+        imap_pool = lj_reac_ctx.imap_pool
+        
+        while True:
+            # threads of executor must not wait for free session: jobs which
+            # hold sessions would not get a thread to release them. the pool
+            # wakes the job up when a session of the host is freed
+            
+            wakeup, wakeup_func = new_wakeup(loop)
+            imap = await run_blocking(
+                    lj_reac_ctx,
+                    imap_pool.acquire,
+                    lj_reac_ctx.mail_service,
+                    lj_reac_ctx.email_login,
+                    lj_reac_ctx.email_pass,
+                    timeout=reactivator.budget_timeout(
+                            lj_reac_ctx,
+                            reactivator.IMAP_CONNECT_TIMEOUT,
+                            ),
+                    block=False,
+                    wakeup_func=wakeup_func,
+                    )
+            
+            if imap is not None:
+                break
+            
+            # the wait is limited by budget of job (it is checked on next
+            # acquire)
+            
+            await asyncio.wait(
+                    (wakeup,),
+                    timeout=lj_reac_ctx.deadline - time.monotonic()
+                            if lj_reac_ctx.deadline is not None else None,
+                    )
+        
+        rx_byte_count = imap.rx_byte_count
+        tx_byte_count = imap.tx_byte_count
+        
+        try:
+            watcher = mail_watch.MailWatcher(
+                    imap,
+                    use_idle=False,
+                    min_delay=reactivator.MAIL_CHECK_MIN_DELAY,
+                    max_delay=reactivator.MAIL_CHECK_MAX_DELAY,
+                    )
+            
+            while True:
+                # waiting for token is done by the event loop too
+                
+                await asyncio.sleep(lj_reac_ctx.rate_limiter.reserve(
+                        lj_reac_ctx.imap_host,
+                        'imap_poll',
+                        ))
+                
+                reactivator.imap_settimeout(
+                        imap,
+                        reactivator.budget_timeout(
+                                lj_reac_ctx,
+                                reactivator.IMAP_CONNECT_TIMEOUT,
+                                ),
+                        )
+                
+                with lj_reac_ctx.stats.timer('mail_poll'):
+                    mail_text = await run_blocking(
+                            lj_reac_ctx,
+                            reactivator.mail_search,
+                            imap,
+                            email,
+                            uid_cache=lj_reac_ctx.uid_cache,
+                            )
+                confirm_url = reactivator.find_confirm_url(mail_text)
+                
+                if confirm_url is not None:
+                    break
+                
+                remaining = deadline - time.monotonic()
+                
+                if remaining <= 0.0:
+                    raise reactivator.MailNotReceivedError(
+                            'confirm_url not received',
+                            )
+                
+                await asyncio.sleep(min(watcher.next_delay(), remaining))
+        except Exception as err:
+            # state of session is unknown after IMAP or network error
+            
+            if isinstance(err, (imaplib.IMAP4.error, OSError)):
+                await run_blocking(lj_reac_ctx, imap_pool.discard, imap)
+            else:
+                imap_pool.release(imap)
+            
+            raise
+        except:
+            # cancelled: session can be still used by executor
+            
+            loop.run_in_executor(lj_reac_ctx.executor, imap_pool.discard, imap)
+            
+            raise
+        finally:
+            lj_reac_ctx.imap_rx_byte_count += imap.rx_byte_count - rx_byte_count
+            lj_reac_ctx.imap_tx_byte_count += imap.tx_byte_count - tx_byte_count
+        
+        imap_pool.release(imap)
+    except imaplib.IMAP4.error as imap_error:
+        raise reactivator.imap_error_with_email(email, imap_error)
+    
+    lj_reac_ctx.confirm_url = confirm_url
+
+async def confirm_phase(lj_reac_ctx):
+    resp = await run_blocking(
+            lj_reac_ctx,
+            reactivator.open_drained,
+            lj_reac_ctx,
+            reactivator.new_confirm_request(lj_reac_ctx),
+            )
+    
+    reactivator.check_confirm_resp(lj_reac_ctx, resp)
+
+PHASE_LIST = (
+        login_phase,
+        send_valid_phase,
+        mail_phase,
+        confirm_phase,
+        )
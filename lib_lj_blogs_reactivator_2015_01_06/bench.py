@@ -0,0 +1,616 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import argparse
+import threading
+import itertools
+import resource
+import os, os.path
+import sys
+import time
+import csv
+import subprocess
+import tempfile
+from . import safe_run
+from . import reactivator
+from . import imap_stub
+from . import lj_stub
+from . import task_ingest
+from . import get_useragent
+
+def percentile(sorted_value_list, q):
+    if not sorted_value_list:
+        return 0.0
+    
+    i = min(len(sorted_value_list) - 1, int(len(sorted_value_list) * q))
+    
+    return sorted_value_list[i]
+
+def get_rss():
+    # returns current resident set size (bytes)
+    
+    try:
+        with open('/proc/self/statm', 'rb') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RssSampler:
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = 0.1
+        
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.sample_list = []
+    
+    def _thread_func(self):
+        while not self._stop_event.is_set():
+            self.sample_list.append(get_rss())
+            self._stop_event.wait(self._interval)
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._thread_func, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.sample_list.append(get_rss())
+
+def fake_row(row_i):
+    return (
+            'user{}@mail.ru'.format(row_i),
+            'email-pass-{}'.format(row_i),
+            'lj-user-{}'.format(row_i),
+            'lj-pass-{}'.format(row_i),
+            )
+
+def fake_account(lj_username):
+    # returns ``(email, email_pass)`` of account of ``fake_row()``
+    
+    prefix, sep, row_i_str = lj_username.rpartition('-')
+    
+    if prefix != 'lj-user' or not row_i_str.isdigit():
+        return
+    
+    email, email_pass, lj_username, lj_pass = fake_row(int(row_i_str))
+    
+    return email, email_pass
+
+def write_fake_csv(path, row_count):
+    with open(path, 'w', encoding='utf-8', newline='') as fd:
+        csv_writer = csv.writer(fd)
+        
+        for row_i in range(row_count):
+            csv_writer.writerow(fake_row(row_i))
+
+def gen_csv_cmd(args):
+    write_fake_csv(args.out_path, args.row_count)
+
+def safe_run_cmd(args):
+    caller_ident = threading.get_ident()
+    
+    def unsafe_func(row):
+        if threading.get_ident() != caller_ident:
+            safe_run_ctx['spawn_count'] += 1
+        
+        if len(row) != 4:
+            raise ValueError('invalid row')
+        
+        email, email_pass, lj_username, lj_pass = row
+        
+        if '@' not in email:
+            raise ValueError('invalid email')
+        
+        return lj_username
+    
+    for mode in args.mode or sorted(safe_run.SAFE_RUN_FUNC_MAP):
+        safe_run_func = safe_run.SAFE_RUN_FUNC_MAP[mode]
+        safe_run_ctx = {'spawn_count': 0}
+        latency_list = []
+        error_count = 0
+        
+        with open(args.in_path, 'r', encoding='utf-8', errors='replace') as fd:
+            begin_time = time.perf_counter()
+            
+            for row in csv.reader(fd):
+                call_time = time.perf_counter()
+                result, error = safe_run_func(unsafe_func, row)
+                latency_list.append(time.perf_counter() - call_time)
+                
+                if error is not None:
+                    error_count += 1
+            
+            total_time = time.perf_counter() - begin_time
+        
+        latency_list.sort()
+        call_count = len(latency_list)
+        
+        print(
+                '{}: calls {}, errors {}, threads spawned {}, total {:.3f}s, '
+                '{:.0f} calls/s, latency mean {:.1f}us p50 {:.1f}us '
+                'p99 {:.1f}us max {:.1f}us'.format(
+                        mode,
+                        call_count,
+                        error_count,
+                        safe_run_ctx['spawn_count'],
+                        total_time,
+                        call_count / total_time if total_time else 0.0,
+                        sum(latency_list) / call_count * 1e6 if call_count else 0.0,
+                        percentile(latency_list, 0.5) * 1e6,
+                        percentile(latency_list, 0.99) * 1e6,
+                        percentile(latency_list, 1.0) * 1e6,
+                        ),
+                )
+
+def new_junk_mail(email, junk_i, size):
+    return (
+            'From: news{}@example.com\r\n'
+            'To: {}\r\n'
+            'Subject: news #{}\r\n'
+            '\r\n'
+            '{}\r\n'
+            ).format(junk_i, email, junk_i, 'x' * size).encode()
+
+def mail_watch_cmd(args):
+    stub = imap_stub.StubImapServer(idle=not args.no_idle)
+    stub.start()
+    
+    try:
+        imap_host, imap_port = stub.address
+        reactivator.MAIL_SERVICE_MAP['stub.test'] = reactivator.MailService(
+                imap_host,
+                imap_port=imap_port,
+                imap_starttls=False,
+                )
+        
+        for account_i in range(args.count):
+            email = 'user{}@stub.test'.format(account_i)
+            confirm_url = 'http://www.livejournal.com/confirm/{}'.format(account_i)
+            
+            stub.add_mailbox(email, 'pass')
+            
+            for backlog_i in range(args.backlog):
+                stub.deliver(email, new_junk_mail(email, backlog_i, args.backlog_size))
+            
+            stub.deliver(
+                    email,
+                    imap_stub.new_validation_mail(email, confirm_url),
+                    delay=args.delay,
+                    )
+            
+            lj_reac_ctx = reactivator.new_lj_reactivator_ctx(
+                    email=email,
+                    email_pass='pass',
+                    lj_username='user{}'.format(account_i),
+                    lj_pass='pass',
+                    ua_name='bench',
+                    )
+            
+            begin_time = time.perf_counter()
+            reactivator.mail_phase(lj_reac_ctx)
+            total_time = time.perf_counter() - begin_time
+            
+            assert lj_reac_ctx.confirm_url == confirm_url
+            
+            print(
+                    '{}: mail delay {:.3f}s, received after {:.3f}s '
+                    '(wake-up latency {:.3f}s), imap received {} bytes, '
+                    'sent {} bytes'.format(
+                            email,
+                            args.delay,
+                            total_time,
+                            total_time - args.delay,
+                            lj_reac_ctx.imap_rx_byte_count,
+                            lj_reac_ctx.imap_tx_byte_count,
+                            ),
+                    )
+        
+        print('imap connections {}, logins {}'.format(
+                stub.connection_count, stub.login_count))
+    finally:
+        stub.stop()
+
+class IngestBenchTask:
+    pass
+
+def ingest_cmd(args):
+    def new_task(row_i, row):
+        task = IngestBenchTask()
+        task.row_i = row_i
+        task.email, task.email_pass, task.lj_username, task.lj_pass = row
+        
+        return task
+    
+    for mode in ('locked-iter', 'ingest') if args.baseline else ('ingest',):
+        with open(args.in_path, 'r', encoding='utf-8', errors='replace', newline='') as fd:
+            if mode == 'ingest':
+                ingest = task_ingest.TaskIngest(
+                        fd,
+                        new_task,
+                        prefetch=args.prefetch,
+                        batch_size=args.batch_size,
+                        )
+                get_task_func = ingest.get
+            else:
+                # the way of ``main`` before streaming ingest: generator
+                # under shared lock
+                
+                def new_task_iter():
+                    for row_i, row in enumerate(csv.reader(fd)):
+                        if len(row) != 4:
+                            continue
+                        
+                        yield new_task(row_i, row)
+                
+                task_iter = new_task_iter()
+                task_iter_lock = threading.RLock()
+                
+                def get_task_func():
+                    with task_iter_lock:
+                        return next(task_iter, None)
+            
+            wait_time_list = []
+            task_counter = itertools.count()
+            
+            def consumer_func():
+                wait_time = 0.0
+                
+                while True:
+                    get_time = time.perf_counter()
+                    task = get_task_func()
+                    wait_time += time.perf_counter() - get_time
+                    
+                    if task is None:
+                        break
+                    
+                    next(task_counter)
+                    
+                    if args.work:
+                        time.sleep(args.work)
+                
+                wait_time_list.append(wait_time)
+            
+            sampler = RssSampler()
+            sampler.start()
+            begin_time = time.perf_counter()
+            
+            if mode == 'ingest':
+                ingest.start()
+            
+            thread_list = list(threading.Thread(target=consumer_func)
+                    for thread_i in range(args.thread_count))
+            
+            for thread in thread_list:
+                thread.start()
+            
+            for thread in thread_list:
+                thread.join()
+            
+            total_time = time.perf_counter() - begin_time
+            sampler.stop()
+        
+        task_count = next(task_counter)
+        rss_list = sampler.sample_list
+        
+        print(
+                '{}: tasks {}, total {:.3f}s, {:.0f} tasks/s, '
+                'consumers waited {:.1f}% of time, '
+                'rss first {:.1f}MiB max {:.1f}MiB last {:.1f}MiB'.format(
+                        mode,
+                        task_count,
+                        total_time,
+                        task_count / total_time if total_time else 0.0,
+                        sum(wait_time_list) / (total_time * args.thread_count) * 100.0
+                                if total_time else 0.0,
+                        rss_list[0] / 1048576.0,
+                        max(rss_list) / 1048576.0,
+                        rss_list[-1] / 1048576.0,
+                        ),
+                )
+        
+        if mode == 'ingest':
+            print(
+                    'ingest: rows {}, empty rows {}, malformed rows {}'.format(
+                            ingest.row_count,
+                            ingest.empty_count,
+                            ingest.malformed_count,
+                            ),
+                    )
+
+def parse_int_list(value):
+    return list(int(item) for item in value.split(','))
+
+def e2e_child_cmd(args):
+    # runs ``main`` with LJ and mail.ru replaced by stub servers of parent
+    
+    from . import main as main_module
+    
+    imap_host, imap_port = args.imap_address.rsplit(':', 1)
+    
+    reactivator.LJ_HTTPS_URL = args.lj_url
+    reactivator.LJ_HTTP_URL = args.lj_url
+    reactivator.MAIL_SERVICE_MAP['mail.ru'] = reactivator.MailService(
+            imap_host,
+            int(imap_port),
+            imap_starttls=False,
+            )
+    get_useragent.USERAGENT_LIST_URL = lj_stub.useragent_list_url(args.lj_url)
+    
+    main_args = args.main_args
+    
+    if main_args[:1] == ['--']:
+        main_args = main_args[1:]
+    
+    sys.argv = ['lj-blogs-reacticator'] + main_args
+    main_module.main()
+
+def e2e_cmd(args):
+    imap_server = imap_stub.StubImapServer(idle=not args.no_idle)
+    lj_server = lj_stub.StubLjServer(
+            imap_server,
+            fake_account,
+            mail_delay=args.mail_delay,
+            )
+    imap_server.start()
+    lj_server.start()
+    
+    child_env = dict(os.environ)
+    child_env['PYTHONPATH'] = os.pathsep.join(filter(None, (
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            child_env.get('PYTHONPATH'),
+            )))
+    child_code = 'from {} import bench; bench.main()'.format(__package__)
+    
+    try:
+        with tempfile.TemporaryDirectory(prefix='lj-bench-') as tmp_dir:
+            for row_count in args.sizes:
+                in_path = os.path.join(tmp_dir, 'in-{}.csv'.format(row_count))
+                write_fake_csv(in_path, row_count)
+                
+                for thread_count in args.thread_counts:
+                    out_path = os.path.join(
+                            tmp_dir,
+                            'out-{}-{}'.format(row_count, thread_count),
+                            )
+                    main_args = [in_path, out_path, str(thread_count)]
+                    
+                    if args.async_mode:
+                        main_args.insert(0, '--async')
+                    
+                    with open(os.devnull, 'wb') as devnull:
+                        start_time = time.monotonic()
+                        proc = subprocess.Popen(
+                                [
+                                        sys.executable, '-c', child_code,
+                                        'e2e-child',
+                                        '--lj-url', lj_server.url,
+                                        '--imap-address',
+                                        '{}:{}'.format(*imap_server.address),
+                                        '--',
+                                        ] + main_args,
+                                stdout=devnull,
+                                env=child_env,
+                                )
+                        # ``wait4()`` gives resource usage of the child only
+                        
+                        pid, status, rusage = os.wait4(proc.pid, 0)
+                        proc.returncode = os.waitstatus_to_exitcode(status)
+                        elapsed = time.monotonic() - start_time
+                    
+                    good_path = '{}.good.csv'.format(out_path)
+                    
+                    with open(good_path, 'rb') as fd:
+                        good_count = sum(1 for line in fd)
+                    
+                    print(
+                            'rows {}, threads {}: {:.1f} accounts/sec, good {}, '
+                            'peak rss {:.1f} MiB, cpu {:.2f} ms/account, '
+                            'status {}'.format(
+                                    row_count,
+                                    thread_count,
+                                    row_count / elapsed,
+                                    good_count,
+                                    rusage.ru_maxrss / 1024,
+                                    (rusage.ru_utime + rusage.ru_stime) * 1000.0 /
+                                            max(row_count, 1),
+                                    proc.returncode,
+                                    ),
+                            flush=True,
+                            )
+    finally:
+        lj_server.stop()
+        imap_server.stop()
+    
+    print('stub requests: {}'.format(', '.join(
+            '{} {}'.format(path, count)
+            for path, count in sorted(lj_server.request_count_map.items()))))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='benchmarks for lj-blogs-reactivator',
+            )
+    
+    subparsers = parser.add_subparsers(metavar='COMMAND')
+    subparsers.required = True
+    
+    gen_csv_parser = subparsers.add_parser(
+            'gen-csv',
+            help='generate in csv-file of fake accounts',
+            )
+    gen_csv_parser.set_defaults(cmd_func=gen_csv_cmd)
+    gen_csv_parser.add_argument(
+            'out_path',
+            metavar='OUT-PATH',
+            help='path to generated csv-file',
+            )
+    gen_csv_parser.add_argument(
+            'row_count',
+            metavar='ROW-COUNT',
+            type=int,
+            help='count of rows',
+            )
+    
+    safe_run_parser = subparsers.add_parser(
+            'safe-run',
+            help='compare modes of safe_run (thread churn and latency)',
+            )
+    safe_run_parser.set_defaults(cmd_func=safe_run_cmd)
+    safe_run_parser.add_argument(
+            '--mode',
+            action='append',
+            choices=tuple(sorted(safe_run.SAFE_RUN_FUNC_MAP)),
+            help='mode to measure (default: all modes)',
+            )
+    safe_run_parser.add_argument(
+            'in_path',
+            metavar='IN-PATH',
+            help='path to in csv-file of accounts',
+            )
+    
+    mail_watch_parser = subparsers.add_parser(
+            'mail-watch',
+            help='measure wake-up latency of mail_phase with local stub '
+                    'IMAP server',
+            )
+    mail_watch_parser.set_defaults(cmd_func=mail_watch_cmd)
+    mail_watch_parser.add_argument(
+            '--no-idle',
+            action='store_true',
+            help='stub server does not support IDLE',
+            )
+    mail_watch_parser.add_argument(
+            '--delay',
+            type=float,
+            default=3.0,
+            help='delay of validation email delivery (seconds)',
+            )
+    mail_watch_parser.add_argument(
+            '--backlog',
+            type=int,
+            default=0,
+            help='count of other unread messages in every mailbox',
+            )
+    mail_watch_parser.add_argument(
+            '--backlog-size',
+            type=int,
+            default=100000,
+            help='size of other unread messages (bytes)',
+            )
+    mail_watch_parser.add_argument(
+            '--count',
+            type=int,
+            default=3,
+            help='count of accounts',
+            )
+    
+    ingest_parser = subparsers.add_parser(
+            'ingest',
+            help='measure throughput and memory of reading in csv-file',
+            )
+    ingest_parser.set_defaults(cmd_func=ingest_cmd)
+    ingest_parser.add_argument(
+            '--thread-count',
+            type=int,
+            default=100,
+            help='count of consumer threads',
+            )
+    ingest_parser.add_argument(
+            '--work',
+            type=float,
+            default=0.0,
+            help='time of work per task in consumer (seconds)',
+            )
+    ingest_parser.add_argument(
+            '--prefetch',
+            type=int,
+            default=task_ingest.DEFAULT_PREFETCH,
+            help='limit of tasks which are read ahead',
+            )
+    ingest_parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=task_ingest.DEFAULT_BATCH_SIZE,
+            help='count of tasks in one hand-off',
+            )
+    ingest_parser.add_argument(
+            '--baseline',
+            action='store_true',
+            help='measure also generator under shared lock',
+            )
+    ingest_parser.add_argument(
+            'in_path',
+            metavar='IN-PATH',
+            help='path to in csv-file of accounts',
+            )
+    
+    e2e_parser = subparsers.add_parser(
+            'e2e',
+            help='run main end-to-end against local stub LJ and IMAP servers',
+            )
+    e2e_parser.set_defaults(cmd_func=e2e_cmd)
+    e2e_parser.add_argument(
+            '--sizes',
+            type=parse_int_list,
+            default=[100, 1000],
+            help='comma separated counts of accounts (default: 100,1000)',
+            )
+    e2e_parser.add_argument(
+            '--thread-counts',
+            type=parse_int_list,
+            default=[10, 100],
+            help='comma separated counts of threads (default: 10,100)',
+            )
+    e2e_parser.add_argument(
+            '--mail-delay',
+            type=float,
+            default=1.0,
+            help='delay of validation email delivery (seconds)',
+            )
+    e2e_parser.add_argument(
+            '--no-idle',
+            action='store_true',
+            help='stub IMAP server does not support IDLE',
+            )
+    e2e_parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='async_mode',
+            help='run main with --async',
+            )
+    
+    e2e_child_parser = subparsers.add_parser(
+            'e2e-child',
+            help='(internal) main process of e2e benchmark',
+            )
+    e2e_child_parser.set_defaults(cmd_func=e2e_child_cmd)
+    e2e_child_parser.add_argument('--lj-url', required=True)
+    e2e_child_parser.add_argument('--imap-address', required=True)
+    e2e_child_parser.add_argument('main_args', nargs=argparse.REMAINDER)
+    
+    args = parser.parse_args()
+    
+    args.cmd_func(args)
@@ -0,0 +1,145 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import hashlib
+import array
+import bisect
+import heapq
+
+DEFAULT_RECENT_SIZE = 65536
+
+def key_hash(key):
+    return int.from_bytes(
+            hashlib.blake2b(key.encode('utf-8', 'replace'), digest_size=8).digest(),
+            'little',
+            )
+
+class HashKeySet:
+    # set of keys for very large inputs: only 64-bit hashes of keys are kept
+    # (8 bytes per key). new hashes go to small ``set``, which is merged into
+    # levels of sorted arrays (sizes of levels grow as powers of two, so
+    # every hash is merged about ``log(n)`` times)
+    
+    def __init__(self, recent_size=None):
+        if recent_size is None:
+            recent_size = DEFAULT_RECENT_SIZE
+        
+        self._recent_size = recent_size
+        self._recent = set()
+        self._level_list = []
+        self.count = 0
+    
+    def _level_contains(self, level, h):
+        i = bisect.bisect_left(level, h)
+        
+        return i < len(level) and level[i] == h
+    
+    def _flush_recent(self):
+        merged = array.array('Q', sorted(self._recent))
+        self._recent.clear()
+        
+        while self._level_list and len(self._level_list[-1]) <= len(merged):
+            # two sorted arrays are merged in linear time, without list of
+            # python ints
+            
+            level = self._level_list.pop()
+            new_merged = array.array('Q')
+            new_merged.extend(heapq.merge(level, merged))
+            merged = new_merged
+        
+        self._level_list.append(merged)
+    
+    def add(self, key):
+        # returns ``False`` if key was added before
+        
+        h = key_hash(key)
+        
+        if h in self._recent:
+            return False
+        
+        for level in self._level_list:
+            if self._level_contains(level, h):
+                return False
+        
+        self._recent.add(h)
+        self.count += 1
+        
+        if len(self._recent) >= self._recent_size:
+            self._flush_recent()
+        
+        return True
+
+def account_key(lj_username):
+    # LJ usernames are case insensitive, ``-`` and ``_`` are the same
+    
+    return lj_username.strip().lower().replace('-', '_')
+
+def mailbox_key(email):
+    return email.strip().lower()
+
+class RowDedup:
+    # streaming stage: rows which repeat an account of a previous row are
+    # collapsed. it is called from one ingest thread only
+    
+    def __init__(self, recent_size=None):
+        self._key_set = HashKeySet(recent_size=recent_size)
+        self.duplicate_count = 0
+    
+    def is_duplicate(self, lj_username):
+        if self._key_set.add(account_key(lj_username)):
+            return False
+        
+        self.duplicate_count += 1
+        
+        return True
+
+class MailboxLockMap:
+    # one job at a time owns a mailbox: validation mail of one job should
+    # not be searched and taken by other job of the same mailbox
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner_map = {}
+        self.busy_count = 0
+    
+    def try_acquire(self, key, owner):
+        # this function is thread-safe
+        
+        with self._lock:
+            cur_owner = self._owner_map.setdefault(key, owner)
+            
+            if cur_owner is owner:
+                return True
+            
+            self.busy_count += 1
+            
+            return False
+    
+    def release(self, key, owner):
+        # this function is thread-safe
+        
+        with self._lock:
+            if self._owner_map.get(key) is owner:
+                del self._owner_map[key]
@@ -25,31 +25,37 @@ assert str is not bytes
 from urllib import parse as url_parse
 from urllib import request as url_request
 import json
+from . import resp_stream
 
 USERAGENT_LIST_URL = 'https://getuseragent.blogspot.com/2014/03/getuseragent.html'
 REQUEST_TIMEOUT = 60.0
 REQUEST_READ_LIMIT = 10000000
 
-def get_useragent_list():
+def get_useragent_list(opener=None):
     marker_prefix = 'USERAGENT_DATA'
     start_marker = '\x3c!--{}_START'.format(marker_prefix)
     stop_marker = '{}_STOP--\x3e'.format(marker_prefix)
     
-    opener = url_request.build_opener()
+    if opener is None:
+        opener = url_request.build_opener()
+    
     opener_res = opener.open(
             url_request.Request(USERAGENT_LIST_URL),
             timeout=REQUEST_TIMEOUT,
             )
-    raw_data = opener_res.read(REQUEST_READ_LIMIT).decode(errors='replace')
-    start_pos = raw_data.find(start_marker)
-    stop_pos = raw_data.find(stop_marker)
+    useragent_raw_data = resp_stream.find_between(
+            opener_res,
+            start_marker.encode(),
+            stop_marker.encode(),
+            REQUEST_READ_LIMIT,
+            )
     
-    if start_pos == -1 or stop_pos == -1:
+    if useragent_raw_data is None:
         raise ValueError(
                 'not found: start_marker or stop_marker',
                 )
     
-    useragent_raw_data = raw_data[start_pos+len(start_marker):stop_pos]
+    useragent_raw_data = useragent_raw_data.decode(errors='replace')
     useragent_data = json.loads(useragent_raw_data)
     
     if not isinstance(useragent_data, (tuple, list)):
@@ -0,0 +1,401 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import time
+import io
+import socket
+import select
+import http.client
+from urllib import error as url_error
+from urllib import request as url_request
+from urllib import response as url_response
+from . import resp_stream
+from . import net_cache
+
+DEFAULT_READ_LIMIT = 10000000
+# errors of reused connection which mean that server has closed it while
+# connection was idle. request is sent again by new connection in this case
+STALE_ERROR_TYPES = (
+        http.client.RemoteDisconnected,
+        http.client.BadStatusLine,
+        ConnectionResetError,
+        BrokenPipeError,
+        )
+
+class HttpPoolConn:
+    pass
+
+class TlsCacheHTTPSConnection(http.client.HTTPSConnection):
+    # TLS sessions are resumed by ``tls_cache``
+    
+    def __init__(self, host, tls_cache, **kwargs):
+        super().__init__(host, context=tls_cache.context, **kwargs)
+        
+        self._tls_cache = tls_cache
+    
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        
+        if self._tunnel_host:
+            server_hostname = self._tunnel_host
+        else:
+            server_hostname = self.host
+        
+        self.sock = self._tls_cache.wrap_socket(
+                self.sock,
+                server_hostname,
+                self.port,
+                )
+
+def _is_dropped(conn):
+    # idle connection must not have anything to read. readable socket means
+    # that server has closed connection (or has sent garbage)
+    
+    sock = conn.sock
+    
+    if sock is None:
+        return True
+    
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        
+        return bool(poller.poll(0))
+    
+    rlist, wlist, xlist = select.select((sock,), (), (), 0.0)
+    
+    return bool(rlist)
+
+class PoolBody(io.RawIOBase):
+    # body of pooled response. it is read from connection on demand. the
+    # connection goes back to pool when body is read to the end, or when body
+    # is closed (the rest is drained then, but no more than ``read_limit``
+    # bytes of whole body)
+    
+    def __init__(self, http_pool, pool_conn, resp):
+        super().__init__()
+        
+        self._http_pool = http_pool
+        self._pool_conn = pool_conn
+        self._resp = resp
+        self._read_count = 0
+    
+    def _finish(self, drained):
+        pool_conn = self._pool_conn
+        self._pool_conn = None
+        
+        if drained and not self._resp.will_close:
+            self._http_pool._release(pool_conn)
+        else:
+            self._http_pool._close(pool_conn)
+    
+    def _drain(self):
+        remaining = self._http_pool.read_limit - self._read_count
+        
+        try:
+            while remaining > 0 and not self._resp.isclosed():
+                chunk = self._resp.read(min(resp_stream.CHUNK_SIZE, remaining))
+                
+                if not chunk:
+                    break
+                
+                remaining -= len(chunk)
+        except (OSError, http.client.HTTPException):
+            self._finish(False)
+            
+            return
+        
+        drained = self._resp.isclosed()
+        
+        if not drained:
+            with self._http_pool._lock:
+                self._http_pool.over_limit_count += 1
+        
+        self._finish(drained)
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buf):
+        if self._pool_conn is None:
+            return 0
+        
+        try:
+            size = self._resp.readinto(buf)
+        except (OSError, http.client.HTTPException):
+            self._finish(False)
+            
+            raise
+        
+        self._read_count += size
+        
+        if not size or self._resp.isclosed():
+            self._finish(True)
+        
+        return size
+    
+    def close(self):
+        if self._pool_conn is not None:
+            self._drain()
+        
+        super().close()
+    
+    def __del__(self):
+        # forgotten body is not drained by garbage collector
+        
+        if self._pool_conn is not None:
+            self._finish(False)
+
+class HttpConnPool:
+    # keeps HTTP/1.1 keep-alive connections between requests. connections are
+    # keyed by (scheme, host, proxy_key). connection is used by one response
+    # until its body is consumed or closed (see ``PoolBody``), idle
+    # connections are closed after ``idle_timeout``
+    
+    def __init__(
+            self,
+            read_limit=None,
+            max_idle_per_host=None,
+            idle_timeout=None,
+            dns_cache=None,
+            tls_cache=None,
+            ):
+        if read_limit is None:
+            read_limit = DEFAULT_READ_LIMIT
+        
+        if max_idle_per_host is None:
+            max_idle_per_host = 100
+        
+        if idle_timeout is None:
+            idle_timeout = 30.0
+        
+        if dns_cache is None:
+            dns_cache = net_cache.DEFAULT_DNS_CACHE
+        
+        if tls_cache is None:
+            tls_cache = net_cache.DEFAULT_TLS_CACHE
+        
+        self.read_limit = read_limit
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache
+        self.tls_cache = tls_cache
+        self._lock = threading.Lock()
+        # key -> list of idle connections (the last one is most recently used)
+        self._idle_map = {}
+        self.open_count = 0
+        self.reuse_count = 0
+        self.stale_count = 0
+        self.over_limit_count = 0
+    
+    def _close(self, pool_conn):
+        try:
+            pool_conn.conn.close()
+        except Exception:
+            pass
+    
+    def _evict_list(self, now):
+        # caller must hold ``self._lock``. returns connections to be closed
+        
+        evict_list = []
+        
+        for key, idle_list in tuple(self._idle_map.items()):
+            while idle_list and now - idle_list[0].release_time > self.idle_timeout:
+                evict_list.append(idle_list.pop(0))
+            
+            if not idle_list:
+                del self._idle_map[key]
+        
+        return evict_list
+    
+    def _acquire(self, key):
+        # this function is thread-safe. returns idle connection or ``None``
+        
+        with self._lock:
+            close_list = self._evict_list(time.monotonic())
+            idle_list = self._idle_map.get(key)
+            pool_conn = idle_list.pop() if idle_list else None
+        
+        for evict_conn in close_list:
+            self._close(evict_conn)
+        
+        if pool_conn is not None and _is_dropped(pool_conn.conn):
+            self._close(pool_conn)
+            
+            with self._lock:
+                self.stale_count += 1
+            
+            return
+        
+        return pool_conn
+    
+    def _release(self, pool_conn):
+        # this function is thread-safe
+        
+        pool_conn.release_time = time.monotonic()
+        
+        with self._lock:
+            idle_list = self._idle_map.setdefault(pool_conn.key, [])
+            
+            if len(idle_list) < self.max_idle_per_host:
+                idle_list.append(pool_conn)
+                
+                return
+        
+        self._close(pool_conn)
+    
+    def _new_conn(self, key, timeout):
+        scheme, host, proxy_key = key
+        
+        if scheme == 'https':
+            conn = TlsCacheHTTPSConnection(host, self.tls_cache, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=timeout)
+        
+        if proxy_key is None:
+            # addresses are not resolved locally, when proxy is used
+            
+            conn._create_connection = self.dns_cache.create_connection
+        
+        pool_conn = HttpPoolConn()
+        pool_conn.key = key
+        pool_conn.conn = conn
+        pool_conn.release_time = None
+        
+        with self._lock:
+            self.open_count += 1
+        
+        return pool_conn
+    
+    def _request(self, pool_conn, req, headers):
+        conn = pool_conn.conn
+        timeout = req.timeout
+        
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        
+        conn.timeout = timeout
+        
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        
+        conn.request(req.get_method(), req.selector, req.data, headers)
+        sock = conn.sock
+        resp = conn.getresponse()
+        # TLS 1.3 tickets come after the handshake, with the first response
+        
+        self.tls_cache.save(sock, conn.port)
+        
+        return resp
+    
+    def open(self, req, scheme, proxy_key=None):
+        # this function is thread-safe
+        
+        host = req.host
+        
+        if not host:
+            raise url_error.URLError('no host given')
+        
+        key = scheme, host, proxy_key
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        
+        pool_conn = self._acquire(key)
+        
+        if pool_conn is not None:
+            with self._lock:
+                self.reuse_count += 1
+            
+            try:
+                resp = self._request(pool_conn, req, headers)
+            except STALE_ERROR_TYPES:
+                self._close(pool_conn)
+                
+                with self._lock:
+                    self.stale_count += 1
+                
+                pool_conn = None
+            except OSError as err:
+                self._close(pool_conn)
+                
+                raise url_error.URLError(err)
+            except http.client.HTTPException:
+                self._close(pool_conn)
+                
+                raise
+        
+        if pool_conn is None:
+            pool_conn = self._new_conn(key, req.timeout)
+            
+            try:
+                resp = self._request(pool_conn, req, headers)
+            except OSError as err:
+                self._close(pool_conn)
+                
+                raise url_error.URLError(err)
+            except http.client.HTTPException:
+                self._close(pool_conn)
+                
+                raise
+        
+        result = url_response.addinfourl(
+                io.BufferedReader(PoolBody(self, pool_conn, resp)),
+                resp.msg,
+                req.full_url,
+                resp.status,
+                )
+        result.msg = resp.reason
+        
+        return result
+    
+    def close_all(self):
+        # this function is thread-safe
+        
+        with self._lock:
+            close_list = []
+            
+            for idle_list in self._idle_map.values():
+                close_list.extend(idle_list)
+            
+            self._idle_map.clear()
+        
+        for pool_conn in close_list:
+            self._close(pool_conn)
+
+class KeepAliveHandler(url_request.BaseHandler):
+    # is called before default handlers of opener (but after trace handlers).
+    # ``proxy_key`` keeps apart connections opened via different proxies
+    handler_order = 400
+    
+    def __init__(self, http_pool, proxy_key=None):
+        self._http_pool = http_pool
+        self._proxy_key = proxy_key
+    
+    def http_open(self, req):
+        return self._http_pool.open(req, 'http', proxy_key=self._proxy_key)
+    
+    def https_open(self, req):
+        return self._http_pool.open(req, 'https', proxy_key=self._proxy_key)
@@ -0,0 +1,198 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import re
+import binascii
+import quopri
+
+# parsing of IMAP responses (RFC 3501) which ``imaplib`` returns as is
+
+class ImapParseError(ValueError):
+    pass
+
+_LPAREN = object()
+_RPAREN = object()
+_LITERAL_RE = re.compile(rb'\{\d+\}$')
+
+def tokenize(text, token_list):
+    text = _LITERAL_RE.sub(b'', text.rstrip())
+    pos = 0
+    
+    while pos < len(text):
+        char = text[pos:pos+1]
+        
+        if char in b' \r\n':
+            pos += 1
+        elif char == b'(':
+            token_list.append(_LPAREN)
+            pos += 1
+        elif char == b')':
+            token_list.append(_RPAREN)
+            pos += 1
+        elif char == b'"':
+            value = bytearray()
+            pos += 1
+            
+            while pos < len(text) and text[pos:pos+1] != b'"':
+                if text[pos:pos+1] == b'\\':
+                    pos += 1
+                
+                value += text[pos:pos+1]
+                pos += 1
+            
+            token_list.append(bytes(value))
+            pos += 1
+        else:
+            begin_pos = pos
+            
+            while pos < len(text) and text[pos:pos+1] not in b' ()':
+                if text[pos:pos+1] == b'[':
+                    # section of BODY[...] can contain spaces and parentheses
+                    
+                    end_pos = text.find(b']', pos)
+                    
+                    if end_pos == -1:
+                        raise ImapParseError('unclosed section: {!r}'.format(text))
+                    
+                    pos = end_pos
+                
+                pos += 1
+            
+            atom = text[begin_pos:pos]
+            
+            token_list.append(None if atom.upper() == b'NIL' else atom)
+
+def build_list(token_list):
+    stack = [[]]
+    
+    for token in token_list:
+        if token is _LPAREN:
+            stack.append([])
+        elif token is _RPAREN:
+            if len(stack) < 2:
+                raise ImapParseError('unexpected close parenthesis')
+            
+            value = stack.pop()
+            stack[-1].append(value)
+        else:
+            stack[-1].append(token)
+    
+    if len(stack) != 1:
+        raise ImapParseError('unclosed parenthesis')
+    
+    return stack[0]
+
+def parse_fetch_data(fetch_data):
+    # ``fetch_data`` is data of ``imap.fetch()`` or of ``imap.uid('FETCH', ...)``.
+    # returns list of dicts: item name (upper case, ``BODY[...]`` is
+    # normalized to ``BODY[]``) -> value. literals are values as bytes
+    
+    response_list = []
+    token_list = None
+    
+    for item in fetch_data:
+        if item is None:
+            continue
+        
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        
+        if token_list is None or re.match(rb'\d+ ', text):
+            token_list = []
+            response_list.append(token_list)
+        
+        tokenize(text, token_list)
+        
+        if literal is not None:
+            token_list.append(literal)
+    
+    result_list = []
+    
+    for token_list in response_list:
+        value_list = build_list(token_list)
+        
+        if len(value_list) != 2 or not isinstance(value_list[1], list):
+            raise ImapParseError('invalid FETCH response: {!r}'.format(value_list))
+        
+        attr_list = value_list[1]
+        attr_map = {}
+        
+        for name, value in zip(attr_list[0::2], attr_list[1::2]):
+            if not isinstance(name, bytes):
+                raise ImapParseError('invalid FETCH item name: {!r}'.format(name))
+            
+            name = name.upper().decode(errors='replace')
+            
+            if name.startswith('BODY['):
+                name = 'BODY[]'
+            
+            attr_map[name] = value
+        
+        result_list.append(attr_map)
+    
+    return result_list
+
+def find_text_plain(body, section=()):
+    # finds first ``text/plain`` part in BODYSTRUCTURE ``body``.
+    # returns (section for ``BODY[...]``, content transfer encoding) or ``None``
+    
+    if not isinstance(body, list) or not body:
+        return
+    
+    if isinstance(body[0], list):
+        # multipart
+        
+        for part_i, part in enumerate(body):
+            if not isinstance(part, list):
+                break
+            
+            found = find_text_plain(part, section + (part_i + 1,))
+            
+            if found is not None:
+                return found
+        
+        return
+    
+    if len(body) < 6 or not isinstance(body[0], bytes) or \
+            not isinstance(body[1], bytes):
+        return
+    
+    if body[0].lower() != b'text' or body[1].lower() != b'plain':
+        return
+    
+    encoding = body[5].decode(errors='replace').lower() \
+            if isinstance(body[5], bytes) else '7bit'
+    
+    return '.'.join(str(i) for i in (section or (1,))), encoding
+
+def decode_transfer(data, encoding):
+    if encoding == 'base64':
+        return binascii.a2b_base64(data)
+    
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    
+    return data
@@ -0,0 +1,314 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import contextlib
+import time
+import imaplib
+
+# a mailbox is used again only by retries and by next mailbox checks of the
+# same job, so idle session is not needed for long
+DEFAULT_IDLE_TIMEOUT = 30.0
+
+class ImapPoolSession:
+    pass
+
+class ImapPool:
+    # keeps authenticated IMAP sessions between uses. sessions are keyed by
+    # (imap_host, imap_port, email_login). sessions are checked by NOOP before reuse,
+    # idle sessions are closed after ``idle_timeout`` (checked on acquire and
+    # on release), and count of opened sessions to one host is limited by
+    # ``max_per_host`` (``None`` is no limit)
+    
+    def __init__(self, open_func, close_func, max_per_host=None, idle_timeout=None):
+        if idle_timeout is None:
+            idle_timeout = DEFAULT_IDLE_TIMEOUT
+        
+        self._open_func = open_func
+        self._close_func = close_func
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        # key -> list of idle sessions (the last one is most recently used)
+        self._idle_map = {}
+        # imap_host -> count of opened sessions (idle and busy)
+        self._host_count_map = {}
+        # imap_host -> functions which are called when session of the host
+        # is freed (see ``acquire()``)
+        self._waiter_map = {}
+        self.open_count = 0
+        self.reuse_count = 0
+        self.check_fail_count = 0
+        self.evict_count = 0
+    
+    def _close(self, session):
+        try:
+            self._close_func(session.imap)
+        except Exception:
+            pass
+    
+    def _forget(self, session):
+        # caller must hold ``self._cond``
+        
+        host = session.key[0]
+        self._host_count_map[host] -= 1
+        self._notify(host)
+    
+    def _notify(self, host):
+        # caller must hold ``self._cond``
+        
+        self._cond.notify_all()
+        
+        for wakeup_func in self._waiter_map.pop(host, ()):
+            wakeup_func()
+    
+    def _evict_list(self, now):
+        # caller must hold ``self._cond``. returns sessions to be closed
+        
+        evict_list = []
+        
+        for key, idle_list in tuple(self._idle_map.items()):
+            while idle_list and now - idle_list[0].release_time > self.idle_timeout:
+                session = idle_list.pop(0)
+                self._forget(session)
+                evict_list.append(session)
+            
+            if not idle_list:
+                del self._idle_map[key]
+        
+        self.evict_count += len(evict_list)
+        
+        return evict_list
+    
+    def _steal_idle(self, host):
+        # caller must hold ``self._cond``. takes the oldest idle session of
+        # other mailbox of ``host`` (it is closed to free place)
+        
+        oldest = None
+        
+        for key, idle_list in self._idle_map.items():
+            if key[0] != host or not idle_list:
+                continue
+            
+            if oldest is None or idle_list[0].release_time < oldest.release_time:
+                oldest = idle_list[0]
+        
+        if oldest is None:
+            return
+        
+        idle_list = self._idle_map[oldest.key]
+        idle_list.pop(0)
+        
+        if not idle_list:
+            del self._idle_map[oldest.key]
+        
+        self._forget(oldest)
+        self.evict_count += 1
+        
+        return oldest
+    
+    def evict_idle(self):
+        # this function is thread-safe
+        
+        with self._cond:
+            evict_list = self._evict_list(time.monotonic())
+        
+        for session in evict_list:
+            self._close(session)
+    
+    def acquire(self, mail_service, email_login, email_pass, timeout=None,
+            block=None, wakeup_func=None):
+        # this function is thread-safe. ``timeout``: timeout of socket of the
+        # session (``None`` keeps timeout of idle session, and gives default
+        # timeout to new one). if ``block`` is ``False``, ``None`` is returned
+        # at once when all sessions of the host are busy (instead of
+        # waiting), and ``wakeup_func()`` (if any) is called once when a
+        # session of the host is freed. it is called under lock of the pool,
+        # so it must not block
+        
+        if block is None:
+            block = True
+        
+        host = mail_service.imap_host
+        key = host, mail_service.imap_port, email_login
+        
+        while True:
+            session = None
+            close_list = []
+            busy = False
+            
+            with self._cond:
+                while True:
+                    close_list.extend(self._evict_list(time.monotonic()))
+                    idle_list = self._idle_map.get(key)
+                    
+                    if idle_list:
+                        session = idle_list.pop()
+                        
+                        if not idle_list:
+                            del self._idle_map[key]
+                        
+                        break
+                    
+                    host_count = self._host_count_map.get(host, 0)
+                    
+                    if self.max_per_host is None or host_count < self.max_per_host:
+                        self._host_count_map[host] = host_count + 1
+                        
+                        break
+                    
+                    stolen = self._steal_idle(host)
+                    
+                    if stolen is not None:
+                        close_list.append(stolen)
+                        
+                        continue
+                    
+                    if not block:
+                        if wakeup_func is not None:
+                            self._waiter_map.setdefault(host, []).append(wakeup_func)
+                        
+                        busy = True
+                        
+                        break
+                    
+                    self._cond.wait()
+            
+            for closed_session in close_list:
+                self._close(closed_session)
+            
+            if busy:
+                return
+            
+            if session is None:
+                break
+            
+            try:
+                if timeout is not None:
+                    session.imap.sock.settimeout(timeout)
+                
+                typ, data = session.imap.noop()
+                
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error('NOOP error: {!r}'.format(typ))
+            except (imaplib.IMAP4.error, OSError):
+                with self._cond:
+                    self.check_fail_count += 1
+                    self._forget(session)
+                
+                self._close(session)
+                
+                continue
+            
+            with self._cond:
+                self.reuse_count += 1
+            
+            return session.imap
+        
+        try:
+            imap = self._open_func(
+                    mail_service,
+                    email_login,
+                    email_pass,
+                    timeout=timeout,
+                    )
+        except:
+            with self._cond:
+                self._host_count_map[host] -= 1
+                self._notify(host)
+            
+            raise
+        
+        imap.pool_key = key
+        
+        with self._cond:
+            self.open_count += 1
+        
+        return imap
+    
+    def release(self, imap):
+        # this function is thread-safe
+        
+        session = ImapPoolSession()
+        session.imap = imap
+        session.key = imap.pool_key
+        session.release_time = time.monotonic()
+        
+        with self._cond:
+            self._idle_map.setdefault(session.key, []).append(session)
+            self._notify(session.key[0])
+            evict_list = self._evict_list(session.release_time)
+        
+        for evicted_session in evict_list:
+            self._close(evicted_session)
+    
+    def discard(self, imap):
+        # this function is thread-safe. it is used for broken sessions
+        
+        session = ImapPoolSession()
+        session.imap = imap
+        session.key = imap.pool_key
+        
+        with self._cond:
+            self._forget(session)
+        
+        self._close(session)
+    
+    @contextlib.contextmanager
+    def session(self, mail_service, email_login, email_pass, timeout=None):
+        imap = self.acquire(mail_service, email_login, email_pass, timeout=timeout)
+        
+        try:
+            yield imap
+        except Exception as err:
+            # state of session is unknown after IMAP or network error
+            
+            if isinstance(err, (imaplib.IMAP4.error, OSError)):
+                self.discard(imap)
+            else:
+                self.release(imap)
+            
+            raise
+        except:
+            self.discard(imap)
+            
+            raise
+        
+        self.release(imap)
+    
+    def close_all(self):
+        # this function is thread-safe
+        
+        with self._cond:
+            close_list = []
+            
+            for idle_list in self._idle_map.values():
+                for session in idle_list:
+                    self._forget(session)
+                    close_list.append(session)
+            
+            self._idle_map.clear()
+        
+        for session in close_list:
+            self._close(session)
@@ -0,0 +1,581 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import socketserver
+import select
+import time
+import datetime
+import re
+from email import utils as email_utils
+from email import parser as email_parser
+
+# minimal IMAP server for local tests and benchmarks. it keeps mailboxes in
+# memory and supports only commands which are used by ``reactivator``
+
+class StubMailbox:
+    def __init__(self, password):
+        self.password = password
+        self.uidvalidity = int(time.time())
+        self.uidnext = 1
+        # list of [uid, flag_set, raw_msg, internal_date]
+        self.msg_list = []
+
+def new_validation_mail(email, confirm_url, sender=None, subject=None):
+    if sender is None:
+        sender = 'do-not-reply@livejournal.com'
+    
+    if subject is None:
+        subject = 'Validate Email'
+    
+    return (
+            'From: {}\r\n'
+            'To: {}\r\n'
+            'Subject: {}\r\n'
+            'Date: {}\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n'
+            '\r\n'
+            'To validate your email address, follow the link:\r\n'
+            '\r\n'
+            ' {} \r\n'
+            ).format(
+                    sender,
+                    email,
+                    subject,
+                    email_utils.formatdate(),
+                    confirm_url,
+                    ).encode()
+
+def split_args(arg_str):
+    # splits arguments of command: atoms, quoted strings and parenthesized
+    # lists (they are kept as one raw argument)
+    
+    arg_list = []
+    pos = 0
+    
+    while pos < len(arg_str):
+        char = arg_str[pos]
+        
+        if char == ' ':
+            pos += 1
+        elif char == '"':
+            end_pos = pos + 1
+            value = []
+            
+            while end_pos < len(arg_str) and arg_str[end_pos] != '"':
+                if arg_str[end_pos] == '\\':
+                    end_pos += 1
+                
+                value.append(arg_str[end_pos:end_pos+1])
+                end_pos += 1
+            
+            arg_list.append(''.join(value))
+            pos = end_pos + 1
+        elif char == '(':
+            depth = 0
+            end_pos = pos
+            
+            while end_pos < len(arg_str):
+                if arg_str[end_pos] == '(':
+                    depth += 1
+                elif arg_str[end_pos] == ')':
+                    depth -= 1
+                    
+                    if not depth:
+                        break
+                
+                end_pos += 1
+            
+            arg_list.append(arg_str[pos:end_pos+1])
+            pos = end_pos + 1
+        else:
+            end_pos = arg_str.find(' ', pos)
+            
+            if end_pos == -1:
+                end_pos = len(arg_str)
+            
+            arg_list.append(arg_str[pos:end_pos])
+            pos = end_pos
+    
+    return arg_list
+
+class StubImapHandler(socketserver.StreamRequestHandler):
+    def send_line(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        
+        self.wfile.write(line + b'\r\n')
+        self.wfile.flush()
+    
+    def handle(self):
+        stub = self.server.stub
+        
+        with stub.cond:
+            stub.connection_count += 1
+        
+        self.mailbox = None
+        self.known_count = 0
+        
+        capability_list = ['IMAP4rev1']
+        
+        if stub.idle:
+            capability_list.append('IDLE')
+        
+        self.capability_str = ' '.join(capability_list)
+        self.send_line('* OK [CAPABILITY {}] stub ready'.format(self.capability_str))
+        
+        while True:
+            line = self.rfile.readline()
+            
+            if not line:
+                break
+            
+            line = line.rstrip(b'\r\n').decode(errors='replace')
+            
+            tag, sep, rest = line.partition(' ')
+            cmd, sep, arg_str = rest.partition(' ')
+            cmd = cmd.upper()
+            arg_list = split_args(arg_str)
+            uid_mode = False
+            
+            if cmd == 'UID':
+                uid_mode = True
+                cmd = arg_list[0].upper()
+                arg_list = arg_list[1:]
+            
+            cmd_func = getattr(self, 'cmd_{}'.format(cmd.lower()), None)
+            
+            if cmd_func is None:
+                self.send_line('{} BAD unknown command'.format(tag))
+                
+                continue
+            
+            if cmd_func(tag, arg_list, uid_mode) is False:
+                break
+    
+    def readable(self):
+        self.connection.settimeout(0.0)
+        try:
+            buffered = self.rfile.peek(1)
+        except BlockingIOError:
+            buffered = None
+        finally:
+            self.connection.settimeout(None)
+        
+        if buffered:
+            return True
+        
+        readable_list, writable_list, error_list = \
+                select.select((self.connection,), (), (), 0.0)
+        
+        return bool(readable_list)
+    
+    def report_exists(self):
+        # caller must hold ``stub.cond``
+        
+        count = len(self.mailbox.msg_list)
+        
+        if count != self.known_count:
+            self.known_count = count
+            self.send_line('* {} EXISTS'.format(count))
+            
+            return True
+        
+        return False
+    
+    def cmd_capability(self, tag, arg_list, uid_mode):
+        self.send_line('* CAPABILITY {}'.format(self.capability_str))
+        self.send_line('{} OK CAPABILITY completed'.format(tag))
+    
+    def cmd_starttls(self, tag, arg_list, uid_mode):
+        self.send_line('{} NO STARTTLS is not supported'.format(tag))
+    
+    def cmd_login(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        with stub.cond:
+            stub.login_count += 1
+            mailbox = stub.mailbox_map.get(arg_list[0] if arg_list else None)
+        
+        if mailbox is None or len(arg_list) != 2 or \
+                arg_list[1] != mailbox.password:
+            self.send_line('{} NO LOGIN failed'.format(tag))
+            
+            return
+        
+        self.mailbox = mailbox
+        self.send_line('{} OK LOGIN completed'.format(tag))
+    
+    def cmd_select(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        if self.mailbox is None:
+            self.send_line('{} NO not authenticated'.format(tag))
+            
+            return
+        
+        with stub.cond:
+            self.known_count = len(self.mailbox.msg_list)
+            self.send_line('* {} EXISTS'.format(self.known_count))
+            self.send_line('* 0 RECENT')
+            self.send_line('* OK [UIDVALIDITY {}] UIDs valid'.format(
+                    self.mailbox.uidvalidity))
+            self.send_line('* OK [UIDNEXT {}] predicted next UID'.format(
+                    self.mailbox.uidnext))
+            self.send_line('* FLAGS (\\Seen)')
+        
+        self.send_line('{} OK [READ-WRITE] SELECT completed'.format(tag))
+    
+    cmd_examine = cmd_select
+    
+    def cmd_noop(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        if self.mailbox is not None:
+            with stub.cond:
+                self.report_exists()
+        
+        self.send_line('{} OK NOOP completed'.format(tag))
+    
+    def cmd_idle(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        if not stub.idle or self.mailbox is None:
+            self.send_line('{} BAD IDLE is not allowed'.format(tag))
+            
+            return
+        
+        self.send_line('+ idling')
+        
+        while True:
+            with stub.cond:
+                self.report_exists()
+                stub.cond.wait(0.05)
+                self.report_exists()
+            
+            if self.readable():
+                line = self.rfile.readline()
+                
+                if not line:
+                    return False
+                
+                break
+        
+        self.send_line('{} OK IDLE terminated'.format(tag))
+    
+    def selected_msg_list(self):
+        # returns list of (seq_num, msg)
+        
+        return list(
+                (msg_i + 1, msg)
+                for msg_i, msg in enumerate(self.mailbox.msg_list))
+    
+    def cmd_search(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        if self.mailbox is None:
+            self.send_line('{} NO not selected'.format(tag))
+            
+            return
+        
+        with stub.cond:
+            num_list = []
+            
+            msg_list = self.selected_msg_list()
+            max_uid = msg_list[-1][1][0] if msg_list else 0
+            
+            for seq_num, msg in msg_list:
+                uid, flag_set, raw_msg, internal_date = msg
+                
+                if stub.match_criteria(msg, max_uid, arg_list):
+                    num_list.append(uid if uid_mode else seq_num)
+        
+        self.send_line(' '.join(['* SEARCH'] + list(str(n) for n in num_list)))
+        self.send_line('{} OK SEARCH completed'.format(tag))
+    
+    def cmd_fetch(self, tag, arg_list, uid_mode):
+        stub = self.server.stub
+        
+        if self.mailbox is None or len(arg_list) < 2:
+            self.send_line('{} NO not selected'.format(tag))
+            
+            return
+        
+        item_str = ' '.join(arg_list[1:])
+        
+        if item_str.startswith('(') and item_str.endswith(')'):
+            item_str = item_str[1:-1]
+        
+        with stub.cond:
+            msg_list = self.selected_msg_list()
+            num_set = stub.parse_sequence_set(
+                    arg_list[0],
+                    msg_list[-1][1][0] if uid_mode and msg_list else len(msg_list),
+                    )
+            
+            for seq_num, msg in msg_list:
+                uid, flag_set, raw_msg, internal_date = msg
+                
+                if (uid if uid_mode else seq_num) not in num_set:
+                    continue
+                
+                data = stub.fetch_data(msg, item_str, uid_mode)
+                stub.sent_byte_count += len(data)
+                self.wfile.write('* {} FETCH ('.format(seq_num).encode() + data + b')\r\n')
+        
+        self.wfile.flush()
+        self.send_line('{} OK FETCH completed'.format(tag))
+    
+    def cmd_close(self, tag, arg_list, uid_mode):
+        self.send_line('{} OK CLOSE completed'.format(tag))
+    
+    def cmd_logout(self, tag, arg_list, uid_mode):
+        self.send_line('* BYE logging out')
+        self.send_line('{} OK LOGOUT completed'.format(tag))
+        
+        return False
+
+class StubImapServer:
+    def __init__(self, host=None, port=None, idle=None):
+        if host is None:
+            host = '127.0.0.1'
+        
+        if port is None:
+            port = 0
+        
+        if idle is None:
+            idle = True
+        
+        self.idle = idle
+        self.cond = threading.Condition()
+        self.mailbox_map = {}
+        self.connection_count = 0
+        self.login_count = 0
+        self.sent_byte_count = 0
+        
+        self._server = socketserver.ThreadingTCPServer(
+                (host, port),
+                StubImapHandler,
+                bind_and_activate=False,
+                )
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._server.stub = self
+        self._thread = None
+    
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+    
+    def start(self):
+        self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                kwargs={'poll_interval': 0.1},
+                daemon=True,
+                )
+        self._thread.start()
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def add_mailbox(self, login, password):
+        with self.cond:
+            self.mailbox_map.setdefault(login, StubMailbox(password))
+    
+    def deliver(self, login, raw_msg, delay=None):
+        # this function is thread-safe
+        
+        if delay:
+            timer = threading.Timer(delay, self.deliver, args=(login, raw_msg))
+            timer.daemon = True
+            timer.start()
+            
+            return
+        
+        with self.cond:
+            mailbox = self.mailbox_map[login]
+            mailbox.msg_list.append(
+                    [mailbox.uidnext, set(), raw_msg, datetime.date.today()])
+            mailbox.uidnext += 1
+            self.cond.notify_all()
+    
+    def parse_sequence_set(self, sequence_set_str, max_num):
+        # returns container of numbers. ``*`` is ``max_num``
+        
+        range_list = []
+        
+        for item in sequence_set_str.split(','):
+            first_str, sep, last_str = item.partition(':')
+            first = max_num if first_str == '*' else int(first_str)
+            last = first if not sep else \
+                    max_num if last_str == '*' else int(last_str)
+            range_list.append(range(min(first, last), max(first, last) + 1))
+        
+        return NumSet(range_list)
+    
+    def match_criteria(self, msg, max_uid, arg_list):
+        uid, flag_set, raw_msg, internal_date = msg
+        header = None
+        arg_i = 0
+        
+        while arg_i < len(arg_list):
+            key = arg_list[arg_i].upper()
+            arg_i += 1
+            
+            if key == 'ALL':
+                continue
+            
+            if key == 'UNSEEN':
+                if '\\Seen' in flag_set:
+                    return False
+                
+                continue
+            
+            value = arg_list[arg_i]
+            arg_i += 1
+            
+            if key == 'UID':
+                num_set = self.parse_sequence_set(value, max_uid)
+                
+                if uid not in num_set:
+                    return False
+            elif key in ('FROM', 'TO', 'SUBJECT'):
+                if header is None:
+                    header = email_parser.BytesHeaderParser().parsebytes(raw_msg)
+                
+                if value.lower() not in ' '.join(header.get_all(key, ())).lower():
+                    return False
+            elif key == 'SINCE':
+                day_str, month_str, year_str = value.split('-')
+                since_date = datetime.datetime.strptime(
+                        '{}-{}-{}'.format(day_str, month_str.title(), year_str),
+                        '%d-%b-%Y',
+                        ).date()
+                
+                if internal_date < since_date:
+                    return False
+            else:
+                raise ValueError('unsupported search key: {!r}'.format(key))
+        
+        return True
+    
+    def fetch_data(self, msg, item_str, uid_mode):
+        uid, flag_set, raw_msg, internal_date = msg
+        part_list = []
+        item_list = re.findall(r'BODY(?:\.PEEK)?\[[^\]]*\]|[A-Z0-9.]+', item_str.upper())
+        
+        if uid_mode and 'UID' not in item_list:
+            item_list.insert(0, 'UID')
+        
+        msg = email_parser.BytesParser().parsebytes(raw_msg)
+        
+        for item in item_list:
+            if item == 'UID':
+                part_list.append('UID {}'.format(uid).encode())
+            elif item == 'FLAGS':
+                part_list.append('FLAGS ({})'.format(' '.join(sorted(flag_set))).encode())
+            elif item == 'RFC822':
+                flag_set.add('\\Seen')
+                part_list.append(literal('RFC822', raw_msg))
+            elif item == 'BODYSTRUCTURE':
+                part_list.append(b'BODYSTRUCTURE ' + bodystructure(msg))
+            elif item.startswith('BODY'):
+                section = item[item.index('[') + 1:-1]
+                
+                if not item.startswith('BODY.PEEK'):
+                    flag_set.add('\\Seen')
+                
+                part_list.append(literal(
+                        'BODY[{}]'.format(section),
+                        body_section(raw_msg, msg, section),
+                        ))
+            else:
+                raise ValueError('unsupported fetch item: {!r}'.format(item))
+        
+        return b' '.join(part_list)
+
+class NumSet:
+    def __init__(self, range_list):
+        self._range_list = range_list
+    
+    def __contains__(self, num):
+        return any(num in r for r in self._range_list)
+
+def literal(name, data):
+    return '{} {{{}}}\r\n'.format(name, len(data)).encode() + data
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+def bodystructure(msg):
+    if msg.is_multipart():
+        return '({} {})'.format(
+                ''.join(bodystructure(part).decode() for part in msg.get_payload()),
+                quote(msg.get_content_subtype()),
+                ).encode()
+    
+    payload = msg.get_payload(decode=False)
+    charset = msg.get_content_charset()
+    
+    return '({} {} {} NIL NIL {} {} {})'.format(
+            quote(msg.get_content_maintype()),
+            quote(msg.get_content_subtype()),
+            '("charset" {})'.format(quote(charset)) if charset else 'NIL',
+            quote(msg.get('content-transfer-encoding', '7bit')),
+            len(payload.encode(errors='replace')),
+            payload.count('\n'),
+            ).encode()
+
+def body_section(raw_msg, msg, section):
+    header_end = raw_msg.find(b'\r\n\r\n')
+    
+    if section.startswith('HEADER.FIELDS'):
+        name_list = re.findall(r'[^\s()"]+', section[len('HEADER.FIELDS'):])
+        line_list = []
+        
+        for name in name_list:
+            for value in msg.get_all(name, ()):
+                line_list.append('{}: {}\r\n'.format(name.title(), value))
+        
+        return ''.join(line_list).encode() + b'\r\n'
+    
+    if section == 'HEADER':
+        return raw_msg[:header_end+4]
+    
+    if section in ('', 'TEXT') or (section == '1' and not msg.is_multipart()):
+        return raw_msg if section == '' else raw_msg[header_end+4:]
+    
+    part = msg
+    
+    for part_num in section.split('.'):
+        part = part.get_payload()[int(part_num) - 1]
+    
+    return part.get_payload(decode=False).encode(errors='replace')
@@ -0,0 +1,279 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os, os.path
+import threading
+import time
+import http.server
+
+METRIC_PREFIX = 'lj_reactivator_'
+
+# shards of finished threads are moved to one shard not more often than once
+# per the interval (seconds) when new shard is made
+COMPACT_INTERVAL = 10.0
+
+# metric families: name -> (type, help)
+METRIC_FAMILY_MAP = {
+        'tasks_begun_total': ('counter', 'tasks which were begun'),
+        'tasks_done_total': ('counter', 'finished tasks by result'),
+        'tasks_in_flight': ('gauge', 'tasks which were begun but not finished'),
+        'tasks_done_per_minute': ('gauge', 'finished tasks per minute for last '
+                'interval of metrics surface'),
+        'phase_tries_total': ('counter', 'finished tries of phases'),
+        'phase_errors_total': ('counter', 'failed tries of phases by error type'),
+        'phases_in_flight': ('gauge', 'tries of phases in progress'),
+        'job_retries_total': ('counter', 'failed tries which will be repeated'),
+        'job_budget_exhausted_total': ('counter', 'jobs which were cancelled '
+                'because their budget was exhausted'),
+        'mailbox_busy_total': ('counter', 'job steps put off because mailbox was '
+                'busy with other job'),
+        'queue_depth': ('gauge', 'items waiting in queues'),
+        'stage_busy_workers': ('gauge', 'workers of pipeline stage which run '
+                'steps'),
+        'stage_steps_total': ('counter', 'steps which were run by workers of '
+                'pipeline stage'),
+        'rate_limit_waits_total': ('counter', 'operations which waited for token '
+                'of rate limiter'),
+        'rate_limit_wait_seconds_total': ('counter', 'time of waiting for tokens '
+                'of rate limiter'),
+        }
+
+class LiveMetrics:
+    # counters and gauges for live metrics surface. every thread updates its
+    # own shard (``dict``) without locking, and shards are summed by reader.
+    # gauges are counters too: they are increased and decreased, or their
+    # values are given by functions (see ``set_gauge_func()``). shards of
+    # finished threads (see ``safe_run.safe_run()``) are moved to one shard
+    # on snapshot (periodic writer of metrics surface), and when new shard is
+    # made but not more often than ``COMPACT_INTERVAL``, so count of shards
+    # is not growing even without metrics surface
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shard_list = []
+        self._dead_shard = {}
+        self._gauge_func_map = {}
+        self._compact_time = time.monotonic()
+    
+    def _get_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        
+        shard = self._local.shard = {}
+        
+        with self._lock:
+            if time.monotonic() - self._compact_time >= COMPACT_INTERVAL:
+                self._compact()
+            
+            self._shard_list.append((threading.current_thread(), shard))
+        
+        return shard
+    
+    def _compact(self):
+        # caller must hold ``self._lock``. finished threads do not update
+        # their shards anymore
+        
+        live_shard_list = []
+        
+        for thread, shard in self._shard_list:
+            if thread.is_alive():
+                live_shard_list.append((thread, shard))
+                
+                continue
+            
+            for key, value in shard.items():
+                self._dead_shard[key] = self._dead_shard.get(key, 0) + value
+        
+        self._shard_list = live_shard_list
+        self._compact_time = time.monotonic()
+    
+    def add(self, name, value=1, **labels):
+        # this function is thread-safe
+        
+        key = name, tuple(sorted(labels.items()))
+        shard = self._get_shard()
+        shard[key] = shard.get(key, 0) + value
+    
+    def set_gauge_func(self, name, func, **labels):
+        # this function is thread-safe
+        
+        with self._lock:
+            self._gauge_func_map[name, tuple(sorted(labels.items()))] = func
+    
+    def snapshot(self):
+        # this function is thread-safe. returns ``dict`` of metric values
+        
+        with self._lock:
+            self._compact()
+            value_map = dict(self._dead_shard)
+            
+            for thread, shard in self._shard_list:
+                # copying of ``dict`` is atomic
+                
+                for key, value in shard.copy().items():
+                    value_map[key] = value_map.get(key, 0) + value
+            
+            gauge_func_list = list(self._gauge_func_map.items())
+        
+        for key, func in gauge_func_list:
+            value_map[key] = func()
+        
+        return value_map
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    
+    return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(
+                    label_name,
+                    str(label_value).replace('\\', '\\\\').replace('"', '\\"'),
+                    )
+            for label_name, label_value in labels))
+
+def format_prometheus(value_map):
+    # text exposition format of Prometheus
+    
+    line_list = []
+    
+    for name in sorted(set(name for name, labels in value_map)):
+        metric_type, metric_help = METRIC_FAMILY_MAP.get(name, ('untyped', name))
+        full_name = '{}{}'.format(METRIC_PREFIX, name)
+        
+        line_list.append('# HELP {} {}'.format(full_name, metric_help))
+        line_list.append('# TYPE {} {}'.format(full_name, metric_type))
+        
+        for key in sorted(key for key in value_map if key[0] == name):
+            line_list.append('{}{} {}'.format(
+                    full_name,
+                    format_labels(key[1]),
+                    value_map[key],
+                    ))
+    
+    return ''.join('{}\n'.format(line) for line in line_list)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            
+            return
+        
+        data = self.server.metrics_surface.last_text.encode('utf-8')
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format, *args):
+        pass
+
+class MetricsSurface:
+    # every ``interval`` seconds takes snapshot of metrics, rewrites stats
+    # file (if ``path`` is given) and keeps the text for HTTP endpoint on
+    # localhost (if ``port`` is given)
+    
+    def __init__(self, metrics, interval, path=None, port=None):
+        self._metrics = metrics
+        self._interval = interval
+        self._path = path
+        self._port = port
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._http_server = None
+        self._last_time = None
+        self._last_done_count = 0
+        self.last_text = ''
+    
+    def update(self):
+        value_map = self._metrics.snapshot()
+        now = time.monotonic()
+        done_count = sum(
+                value for (name, labels), value in value_map.items()
+                if name == 'tasks_done_total'
+                )
+        
+        if self._last_time is not None and now > self._last_time:
+            value_map['tasks_done_per_minute', ()] = round(
+                    (done_count - self._last_done_count) * 60.0 /
+                            (now - self._last_time),
+                    3,
+                    )
+        
+        self._last_time = now
+        self._last_done_count = done_count
+        self.last_text = format_prometheus(value_map)
+        
+        if self._path is not None:
+            tmp_path = os.path.join(
+                    os.path.dirname(self._path),
+                    'new.{}'.format(os.path.basename(self._path)),
+                    )
+            
+            with open(tmp_path, 'w', encoding='utf-8', newline='\n') as fd:
+                fd.write(self.last_text)
+            
+            os.replace(tmp_path, self._path)
+    
+    def _thread_func(self):
+        while not self._stop_event.wait(self._interval):
+            self.update()
+    
+    def start(self):
+        self.update()
+        
+        if self._port is not None:
+            self._http_server = http.server.ThreadingHTTPServer(
+                    ('127.0.0.1', self._port),
+                    MetricsHandler,
+                    )
+            self._http_server.daemon_threads = True
+            self._http_server.metrics_surface = self
+            
+            threading.Thread(
+                    target=self._http_server.serve_forever,
+                    daemon=True,
+                    ).start()
+        
+        self._thread = threading.Thread(target=self._thread_func, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop_event.set()
+        
+        if self._thread is not None:
+            self._thread.join()
+        
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+        
+        self.update()
+
+DEFAULT_LIVE_METRICS = LiveMetrics()
@@ -0,0 +1,181 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import http.server
+import json
+import itertools
+from urllib import parse as url_parse
+from . import imap_stub
+
+# minimal HTTP server instead of LJ for local tests and benchmarks. it
+# implements only pages which are used by ``reactivator`` (and page of user
+# agent list for ``get_useragent``). validation emails are delivered to
+# mailboxes of ``imap_stub.StubImapServer``
+
+USERAGENT_LIST = (
+        'Mozilla/5.0 (X11; Linux x86_64; rv:35.0) Gecko/20100101 Firefox/35.0',
+        'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:35.0) Gecko/20100101 Firefox/35.0',
+        )
+
+def useragent_list_url(url):
+    # ``get_useragent.USERAGENT_LIST_URL`` is replaced by it
+    
+    return url_parse.urljoin(url, 'useragents.html')
+
+class StubLjHandler(http.server.BaseHTTPRequestHandler):
+    # keeps connections alive like real LJ does
+    protocol_version = 'HTTP/1.1'
+    
+    def _read_form(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        
+        return dict(url_parse.parse_qsl(data.decode('utf-8', 'replace')))
+    
+    def _send(self, code, body=None, location=None, cookie=None):
+        data = (body or '').encode('utf-8')
+        
+        self.send_response(code)
+        
+        if location is not None:
+            self.send_header('Location', location)
+        
+        if cookie is not None:
+            self.send_header('Set-Cookie', cookie)
+        
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        stub = self.server.stub
+        path = self.path.split('?', 1)[0]
+        stub.count_request('/confirm/' if path.startswith('/confirm/') else path)
+        
+        if path == '/useragents.html':
+            self._send(200, '<html>\x3c!--USERAGENT_DATA_START{}USERAGENT_DATA_STOP--\x3e'
+                    '</html>'.format(json.dumps(USERAGENT_LIST)))
+        elif path in ('/update.bml', '/register.bml'):
+            self._send(200, '<html></html>')
+        elif path.startswith('/confirm/'):
+            self._send(302, location=url_parse.urljoin(
+                    stub.url, 'register.bml?confirmed=1'))
+        else:
+            self._send(404)
+    
+    def do_POST(self):
+        stub = self.server.stub
+        path = self.path.split('?', 1)[0]
+        form = self._read_form()
+        stub.count_request(path)
+        
+        if path == '/login.bml':
+            if stub.account_func(form.get('user', '')) is None:
+                self._send(200, '<html>bad password</html>')
+                
+                return
+            
+            self._send(
+                    302,
+                    location=form.get('ref') or url_parse.urljoin(stub.url, 'update.bml'),
+                    cookie='ljsession={}; path=/'.format(next(stub.session_counter)),
+                    )
+        elif path == '/register.bml':
+            account = stub.account_func(form.get('authas', ''))
+            
+            if account is None:
+                self._send(404)
+                
+                return
+            
+            email, email_pass = account
+            confirm_url = url_parse.urljoin(
+                    stub.url,
+                    'confirm/{}'.format(url_parse.quote(form['authas'])),
+                    )
+            stub.imap_server.add_mailbox(email, email_pass)
+            stub.imap_server.deliver(
+                    email,
+                    imap_stub.new_validation_mail(email, confirm_url),
+                    delay=stub.mail_delay,
+                    )
+            self._send(200, '<html></html>')
+        else:
+            self._send(404)
+    
+    def log_message(self, format, *args):
+        pass
+
+class StubLjServer:
+    # ``account_func(lj_username)`` returns ``(email, email_pass)`` of
+    # account or ``None`` for unknown account
+    
+    def __init__(self, imap_server, account_func, host=None, port=None,
+            mail_delay=None):
+        if host is None:
+            host = '127.0.0.1'
+        
+        if port is None:
+            port = 0
+        
+        self.imap_server = imap_server
+        self.account_func = account_func
+        self.mail_delay = mail_delay
+        self.session_counter = itertools.count()
+        self.request_count_map = {}
+        self._lock = threading.Lock()
+        
+        self._server = http.server.ThreadingHTTPServer(
+                (host, port),
+                StubLjHandler,
+                )
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+    
+    @property
+    def url(self):
+        # ``reactivator.LJ_HTTPS_URL`` and ``reactivator.LJ_HTTP_URL`` are
+        # replaced by it
+        
+        return 'http://{}:{}'.format(*self._server.server_address[:2])
+    
+    def count_request(self, path):
+        # this function is thread-safe
+        
+        with self._lock:
+            self.request_count_map[path] = self.request_count_map.get(path, 0) + 1
+    
+    def start(self):
+        self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                kwargs={'poll_interval': 0.1},
+                daemon=True,
+                )
+        self._thread.start()
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,168 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import time
+import select
+import ssl
+import imaplib
+
+class MailWatcher:
+    # waits for changes of selected mailbox of authenticated IMAP session.
+    # IDLE command (RFC 2177) is used if server supports it, otherwise
+    # mailbox is checked with adaptive (growing) delays
+    
+    def __init__(self, imap, use_idle=None, min_delay=None, max_delay=None):
+        if use_idle is None:
+            use_idle = True
+        
+        if min_delay is None:
+            min_delay = 1.0
+        
+        if max_delay is None:
+            max_delay = 10.0
+        
+        self.imap = imap
+        self.idle = use_idle and 'IDLE' in imap.capabilities
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._delay = min_delay
+    
+    def next_delay(self):
+        delay = self._delay
+        self._delay = min(self._delay * 2.0, self._max_delay)
+        
+        return delay
+    
+    def reset_delay(self):
+        self._delay = self._min_delay
+    
+    def _buffered_or_readable(self, timeout):
+        imap = self.imap
+        sock = imap.sock
+        
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            return True
+        
+        sock_timeout = sock.gettimeout()
+        sock.settimeout(0.0)
+        try:
+            buffered = imap.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            buffered = None
+        finally:
+            sock.settimeout(sock_timeout)
+        
+        if buffered:
+            return True
+        
+        if hasattr(select, 'poll'):
+            # ``select.select()`` does not accept descriptors above
+            # ``FD_SETSIZE``, but many sessions can be opened in pool
+            
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            
+            return bool(poller.poll(max(0.0, timeout) * 1000.0))
+        
+        readable_list, writable_list, error_list = \
+                select.select((sock,), (), (), max(0.0, timeout))
+        
+        return bool(readable_list)
+    
+    def _idle_wait(self, timeout):
+        imap = self.imap
+        tag = imap._new_tag()
+        
+        imap.send(tag + b' IDLE\r\n')
+        
+        while True:
+            line = imap.readline()
+            
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+            
+            if line.startswith(b'+'):
+                break
+            
+            if line.startswith(tag):
+                # IDLE is rejected
+                
+                self.idle = False
+                
+                return False
+        
+        changed = False
+        deadline = time.monotonic() + timeout
+        
+        while not changed:
+            remaining = deadline - time.monotonic()
+            
+            if remaining <= 0.0 or not self._buffered_or_readable(remaining):
+                break
+            
+            line = imap.readline()
+            
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+            
+            if line.startswith(b'*') and \
+                    (b'EXISTS' in line.upper() or b'RECENT' in line.upper()):
+                changed = True
+        
+        imap.send(b'DONE\r\n')
+        
+        while True:
+            line = imap.readline()
+            
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+            
+            if line.startswith(b'*') and \
+                    (b'EXISTS' in line.upper() or b'RECENT' in line.upper()):
+                changed = True
+            
+            if line.startswith(tag):
+                if not line[len(tag):].split()[0].upper() == b'OK':
+                    raise imaplib.IMAP4.error(
+                            'IDLE error: {!r}'.format(line.decode(errors='replace')),
+                            )
+                
+                break
+        
+        return changed
+    
+    def wait(self, timeout):
+        # returns when mailbox is (possible) changed or when ``timeout`` is
+        # expired. result is ``False`` if it is known that mailbox is not
+        # changed
+        
+        if self.idle:
+            changed = self._idle_wait(timeout)
+            
+            if self.idle:
+                return changed
+        
+        time.sleep(max(0.0, min(self.next_delay(), timeout)))
+        
+        return True
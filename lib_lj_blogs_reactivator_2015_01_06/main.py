@@ -22,15 +22,35 @@
 
 assert str is not bytes
 
+import os
 import argparse
 import random
 import threading
+import asyncio
+from concurrent import futures
 import itertools
 import csv
+import io
+import time
 from . import out_mgr
 from . import safe_run
 from . import get_useragent
 from . import reactivator
+from . import phase_retry
+from . import task_ingest
+from . import progress_journal
+from . import dedup
+from . import phase_stats
+from . import live_metrics
+from . import trace_transport
+from . import net_cache
+from . import adaptive_limit
+from . import rate_limit
+from . import staged_reactivator
+from . import stage_pipeline
+from . import shard_run
+from . import work_queue
+from . import results_store
 
 class ArgumentError(Exception):
     pass
@@ -38,7 +58,56 @@ class ArgumentError(Exception):
 class Task:
     pass
 
-def main():
+def csv_line(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    
+    return buf.getvalue()
+
+def start_out_writer(out, out_flush_delay, out_fsync):
+    out.get_fd_and_lock(ext='out.log')
+    out.get_fd_and_lock(ext='err.log')
+    out.get_fd_and_lock(ext='err-tb.log')
+    out.get_fd_and_lock(ext='good.csv')
+    out.get_fd_and_lock(ext='bad.csv')
+    out.get_fd_and_lock(ext='journal')
+    out.start_writer(
+            flush_delay=out_flush_delay,
+            fsync=out_fsync,
+            last_ext='journal',
+            )
+
+def main_processes(process_count, out_path, resume, out_flush_delay, out_fsync,
+        results_run_id):
+    out = out_mgr.OutMgr(out_path, append=resume)
+    shard_list = shard_run.start_processes(
+            process_count,
+            lambda shard: main(shard=shard, results_run_id=results_run_id),
+            out.get_path(ext='journal'),
+            )
+    
+    start_out_writer(out, out_flush_delay, out_fsync)
+    
+    progress = shard_run.merge_processes(shard_list, out, print)
+    
+    print_str = 'processes: {}, good {}, bad {}'.format(
+            process_count,
+            progress.good_count,
+            progress.bad_count,
+            )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    print_str = 'done!'
+    out.write(print_str, ext='out.log')
+    out.stop_writer()
+    print(print_str)
+
+def main(shard=None, results_run_id=None):
+    # ``shard``: the process is a child of --processes mode (see
+    # ``shard_run.start_processes()``). ``results_run_id``: id of the run in
+    # results database, which is given by parent process
+    
     parser = argparse.ArgumentParser(
             description='utility for reactivation (via email) of bad '
                     'LJ-blog accounts',
@@ -50,6 +119,233 @@ def main():
             help='address of SOCKS5-proxy',
             )
     
+    parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='async_mode',
+            help='run jobs as asyncio tasks instead of threads. '
+                    'THREAD-COUNT is a count of jobs in progress then',
+            )
+    
+    parser.add_argument(
+            '--staged',
+            metavar='SEND-WORKERS,MAIL-WORKERS,CONFIRM-WORKERS',
+            help='run phases in pipeline of stages: login and sending of '
+                    'validation email, waiting for email (one worker checks '
+                    'many mailboxes), confirmation. every stage has its own '
+                    'queue and count of worker threads. THREAD-COUNT is a '
+                    'count of jobs in progress then',
+            )
+    
+    parser.add_argument(
+            '--processes',
+            metavar='PROCESS-COUNT',
+            type=int,
+            default=1,
+            help='shard in csv-file across PROCESS-COUNT worker processes '
+                    '(rows of one mailbox go to one process), every one with '
+                    'THREAD-COUNT threads. out files are written by parent '
+                    'process',
+            )
+    
+    parser.add_argument(
+            '--io-threads',
+            metavar='IO-THREAD-COUNT',
+            type=int,
+            default=10,
+            help='count of threads for blocking network calls in --async mode',
+            )
+    
+    parser.add_argument(
+            '--safe-run-mode',
+            choices=tuple(sorted(safe_run.SAFE_RUN_FUNC_MAP)),
+            default='in-thread',
+            help='how errors of a job are isolated: inside of worker thread '
+                    '(default) or in separate thread for every phase try',
+            )
+    
+    parser.add_argument(
+            '--imap-per-host',
+            metavar='IMAP-CONNECTION-COUNT',
+            type=int,
+            help='limit of opened IMAP connections to one host '
+                    '(default: THREAD-COUNT)',
+            )
+    
+    parser.add_argument(
+            '--adaptive',
+            action='store_true',
+            help='limit concurrent phases of every host (LJ and IMAP-host) by '
+                    'adaptive limit, which grows while tries are fast and '
+                    'successful and falls down on timeouts and slow tries. '
+                    'THREAD-COUNT is a count of jobs in progress then',
+            )
+    
+    parser.add_argument(
+            '--adaptive-min',
+            metavar='MIN-LIMIT',
+            type=int,
+            default=1,
+            help='the least adaptive limit of one host (default: 1)',
+            )
+    
+    parser.add_argument(
+            '--adaptive-max',
+            metavar='MAX-LIMIT',
+            type=int,
+            help='the greatest adaptive limit of one host '
+                    '(default: THREAD-COUNT)',
+            )
+    
+    parser.add_argument(
+            '--rate',
+            metavar='OPERATION=RATE[/BURST]',
+            action='append',
+            default=[],
+            help='limit rate (per second) of operation to every host by token '
+                    'bucket. operations: {}. BURST is a count of operations '
+                    'which can go at once (default: one second of RATE). '
+                    'can be given several times'.format(
+                            ', '.join(rate_limit.OPERATION_NAMES),
+                            ),
+            )
+    
+    parser.add_argument(
+            '--job-budget',
+            metavar='SECONDS',
+            type=float,
+            help='limit time of every job (all phases with retries) by '
+                    'SECONDS: phases get shares of remaining budget, network '
+                    'calls get remaining budget of phase as timeout, and job '
+                    'is cancelled when budget is exhausted (default: no '
+                    'limit)',
+            )
+    
+    parser.add_argument(
+            '--no-keep-alive',
+            action='store_true',
+            help='open new HTTP connection for every request instead of '
+                    'reusing kept-alive connections',
+            )
+    
+    parser.add_argument(
+            '--uid-cache',
+            action='store_true',
+            help='keep checked UIDs of mailboxes in file next to out files, '
+                    'so next runs do not check old messages again',
+            )
+    
+    parser.add_argument(
+            '--prefetch',
+            metavar='TASK-COUNT',
+            type=int,
+            default=task_ingest.DEFAULT_PREFETCH,
+            help='limit of tasks which are read from in csv-file ahead',
+            )
+    
+    parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='continue interrupted run: rows finished by previous run '
+                    '(see journal out file) are skipped, and out files are '
+                    'continued',
+            )
+    
+    parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help='collapse rows which repeat LJ-username of previous rows '
+                    '(default: all rows are run)',
+            )
+    
+    parser.add_argument(
+            '--work-queue',
+            metavar='QUEUE-PATH',
+            help='take rows from work queue in SQLite-file, which is shared '
+                    'by several runs (nodes) with the same in csv-file: '
+                    'rows are leased, leases of crashed runs expire, and '
+                    'every row is written to out files of one run only',
+            )
+    
+    parser.add_argument(
+            '--lease-time',
+            metavar='SECONDS',
+            type=float,
+            default=work_queue.DEFAULT_LEASE_TIME,
+            help='lease of row of --work-queue expires when the run does not '
+                    'renew it for SECONDS',
+            )
+    
+    parser.add_argument(
+            '--results-db',
+            metavar='RESULTS-DB-PATH',
+            help='record result of every job (status, failed phase, error '
+                    'class, count of tries, durations of phases) into '
+                    'SQLite-file. see lj-blogs-reacticator-results for '
+                    'export of results',
+            )
+    
+    parser.add_argument(
+            '--out-flush-delay',
+            metavar='SECONDS',
+            type=float,
+            default=out_mgr.DEFAULT_FLUSH_DELAY,
+            help='out files are written by single thread in groups of '
+                    'records: the delay limits how long records wait for '
+                    'writing',
+            )
+    
+    parser.add_argument(
+            '--out-fsync',
+            action='store_true',
+            help='sync out files to disk after every written group of records',
+            )
+    
+    parser.add_argument(
+            '--metrics-file',
+            action='store_true',
+            help='rewrite metrics file (Prometheus text format) next to out '
+                    'files every METRICS-INTERVAL seconds',
+            )
+    
+    parser.add_argument(
+            '--metrics-port',
+            metavar='PORT',
+            type=int,
+            help='serve metrics (Prometheus text format) by HTTP on '
+                    '127.0.0.1:PORT',
+            )
+    
+    parser.add_argument(
+            '--metrics-interval',
+            metavar='METRICS-INTERVAL',
+            type=float,
+            default=10.0,
+            help='seconds between updates of metrics',
+            )
+    
+    parser.add_argument(
+            '--trace-record',
+            metavar='TRACE-PATH',
+            help='record HTTP and IMAP traffic into trace file',
+            )
+    
+    parser.add_argument(
+            '--trace-replay',
+            metavar='TRACE-PATH',
+            help='replay HTTP and IMAP traffic from trace file instead of '
+                    'network',
+            )
+    
+    parser.add_argument(
+            '--trace-latency-scale',
+            metavar='SCALE',
+            type=float,
+            default=1.0,
+            help='recorded latencies are multiplied by SCALE in '
+                    '--trace-replay mode (0 is without delays)',
+            )
+    
     parser.add_argument(
             'in_path',
             metavar='IN-PATH',
@@ -75,6 +371,114 @@ def main():
     in_csv_path = args.in_path
     out_path = args.out_path
     thread_count = args.thread_count
+    async_mode = args.async_mode
+    io_thread_count = args.io_threads
+    staged_str = args.staged
+    process_count = args.processes
+    safe_run_func = safe_run.SAFE_RUN_FUNC_MAP[args.safe_run_mode]
+    imap_per_host = args.imap_per_host
+    use_keep_alive = not args.no_keep_alive
+    job_budget = args.job_budget
+    rate_str_list = args.rate
+    use_adaptive = args.adaptive
+    adaptive_min = args.adaptive_min
+    adaptive_max = args.adaptive_max
+    use_uid_cache = args.uid_cache
+    prefetch = args.prefetch
+    resume = args.resume
+    use_dedup = args.dedup
+    work_queue_path = args.work_queue
+    lease_time = args.lease_time
+    results_db_path = args.results_db
+    out_flush_delay = args.out_flush_delay
+    out_fsync = args.out_fsync
+    use_metrics_file = args.metrics_file
+    metrics_port = args.metrics_port
+    metrics_interval = args.metrics_interval
+    trace_record_path = args.trace_record
+    trace_replay_path = args.trace_replay
+    trace_latency_scale = args.trace_latency_scale
+    
+    if thread_count < 1:
+        raise ArgumentError('invalid thread_count argument')
+    
+    if staged_str is not None:
+        try:
+            stage_worker_count_list = list(int(v) for v in staged_str.split(','))
+        except ValueError:
+            stage_worker_count_list = None
+        
+        if async_mode or stage_worker_count_list is None or \
+                len(stage_worker_count_list) != len(staged_reactivator.STAGE_LIST) or \
+                min(stage_worker_count_list) < 1:
+            raise ArgumentError('invalid staged argument')
+        
+        stage_list = list(
+                stage_pipeline.Stage(stage_name, phase_name_list, worker_count)
+                for (stage_name, phase_name_list), worker_count in zip(
+                        staged_reactivator.STAGE_LIST,
+                        stage_worker_count_list,
+                        ))
+    else:
+        stage_list = None
+    
+    if process_count < 1:
+        raise ArgumentError('invalid processes argument')
+    
+    if process_count > 1 and (metrics_port is not None or
+            trace_record_path is not None):
+        raise ArgumentError('processes argument is incompatible with '
+                'metrics_port and trace_record arguments')
+    
+    if io_thread_count < 1:
+        raise ArgumentError('invalid io_threads argument')
+    
+    if imap_per_host is not None and imap_per_host < 1:
+        raise ArgumentError('invalid imap_per_host argument')
+    
+    if imap_per_host is None:
+        imap_per_host = thread_count
+    
+    if adaptive_max is None:
+        adaptive_max = thread_count
+    
+    if adaptive_min < 1:
+        raise ArgumentError('invalid adaptive_min argument')
+    
+    if adaptive_max < adaptive_min or adaptive_max > thread_count:
+        raise ArgumentError('invalid adaptive_max argument')
+    
+    rate_map = {}
+    
+    for rate_str in rate_str_list:
+        try:
+            operation, rate_burst = rate_limit.parse_rate(rate_str)
+        except ValueError:
+            raise ArgumentError('invalid rate argument: {!r}'.format(rate_str))
+        
+        rate_map[operation] = rate_burst
+    
+    if job_budget is not None and job_budget <= 0.0:
+        raise ArgumentError('invalid job_budget argument')
+    
+    if prefetch < 1:
+        raise ArgumentError('invalid prefetch argument')
+    
+    if lease_time <= 0.0:
+        raise ArgumentError('invalid lease_time argument')
+    
+    if out_flush_delay < 0.0:
+        raise ArgumentError('invalid out_flush_delay argument')
+    
+    if metrics_interval <= 0.0:
+        raise ArgumentError('invalid metrics_interval argument')
+    
+    if trace_record_path is not None and trace_replay_path is not None:
+        raise ArgumentError('trace_record and trace_replay arguments are '
+                'mutually exclusive')
+    
+    if trace_latency_scale < 0.0:
+        raise ArgumentError('invalid trace_latency_scale argument')
     
     if proxy_address_str is not None:
         if ':' not in proxy_address_str:
@@ -84,31 +488,164 @@ def main():
     else:
         proxy_address = None
     
+    if results_db_path is not None and results_run_id is None:
+        results_run_id = results_store.new_run(results_db_path, in_csv_path)
+    
+    if process_count > 1 and shard is None:
+        return main_processes(process_count, out_path, resume, out_flush_delay,
+                out_fsync, results_run_id)
+    
+    if trace_record_path is not None:
+        trace_writer = trace_transport.install_record(trace_record_path)
+    else:
+        trace_writer = None
+    
+    if trace_replay_path is not None:
+        trace_transport.install_replay(
+                trace_replay_path,
+                latency_scale=trace_latency_scale,
+                )
+    
+    imap_pool = reactivator.DEFAULT_IMAP_POOL
+    imap_pool.max_per_host = imap_per_host
+    
+    if not use_keep_alive:
+        reactivator.DEFAULT_HTTP_POOL = None
+    
+    http_pool = reactivator.DEFAULT_HTTP_POOL
+    
+    rate_limit.DEFAULT_RATE_LIMITER.rate_map = rate_map
+    
+    stats = phase_stats.DEFAULT_PHASE_STATS
+    metrics = live_metrics.DEFAULT_LIVE_METRICS
     ui_lock = threading.RLock()
-    out = out_mgr.OutMgr(out_path)
     
-    out.get_fd_and_lock(ext='out.log')
-    out.get_fd_and_lock(ext='err.log')
-    out.get_fd_and_lock(ext='err-tb.log')
-    good_fd, good_fd_lock = out.get_fd_and_lock(ext='good.csv')
-    bad_fd, bad_fd_lock = out.get_fd_and_lock(ext='bad.csv')
+    if shard is not None:
+        # side files (stats, uid cache, metrics) are own files of the shard
+        
+        out = out_mgr.OutMgr('{}.shard-{}'.format(out_path, shard.index),
+                append=resume)
+    else:
+        out = out_mgr.OutMgr(out_path, append=resume)
+    
+    if resume:
+        finished_rows = progress_journal.load_journal(
+                shard.journal_path if shard is not None else
+                        out.get_path(ext='journal'),
+                )
+    else:
+        finished_rows = None
+    
+    uid_cache = reactivator.DEFAULT_UID_CACHE
+    
+    if use_uid_cache:
+        uid_cache_path = out.get_path(ext='uid-cache.csv')
+        
+        if uid_cache_path is not None:
+            uid_cache.load(uid_cache_path)
+    
+    if shard is not None:
+        out.start_writer(
+                flush_delay=out_flush_delay,
+                last_ext='journal',
+                forward_fd=os.fdopen(shard.fd, 'wb'),
+                )
+    else:
+        start_out_writer(out, out_flush_delay, out_fsync)
+    
+    in_fd = open(in_csv_path, 'r', encoding='utf-8', errors='replace', newline='')
     
-    in_csv_reader = csv.reader(open(in_csv_path, 'r', encoding='utf-8', errors='replace'))
-    good_csv_writer = csv.writer(good_fd)
-    bad_csv_writer = csv.writer(bad_fd)
+    if work_queue_path is not None:
+        work_q = work_queue.WorkQueue(work_queue_path, lease_time=lease_time)
+    else:
+        work_q = None
+    
+    if results_db_path is not None:
+        results = results_store.ResultStore(results_db_path, results_run_id)
+        results.start()
+    else:
+        results = None
     
     def begin_handler(task):
+        metrics.add('tasks_begun_total')
+        metrics.add('tasks_in_flight')
+        
         with ui_lock:
             print_str = '[task_{}] {}: begin'.format(task.task_i, task.lj_username)
             out.write(print_str, ext='out.log')
             print(print_str)
     
     def done_handler(task):
+        lj_reac_ctx = task.job.lj_reac_ctx if task.job is not None else None
+        
+        stats.record(
+                'job',
+                time.monotonic() - task.begin_time,
+                task.error[0] if task.error is not None else None,
+                )
+        metrics.add('tasks_in_flight', -1)
+        metrics.add('tasks_done_total', result='good' if task.error is None else 'bad')
+        
+        # the result is written to out files only by run which owns lease of
+        # the row
+        
+        if work_q is not None and not work_q.ack(
+                task.row_i,
+                'good' if task.error is None else 'bad',
+                error='{!r} {!r}'.format(*task.error[:2])
+                        if task.error is not None else None,
+                ):
+            with ui_lock:
+                print_str = '[task_{}] {}: result is dropped: lease of the ' \
+                        'row is expired and is taken by other run'.format(
+                                task.task_i,
+                                task.lj_username,
+                                )
+                out.write(print_str, ext='out.log')
+                out.write(print_str, ext='err.log')
+                print(print_str)
+            
+            return
+        
+        if results is not None:
+            job = task.job
+            error_type = task.error[0] if task.error is not None else None
+            
+            results.record(
+                    task.row_i,
+                    dedup.account_key(task.lj_username),
+                    (task.email, task.email_pass, task.lj_username, task.lj_pass),
+                    'good' if task.error is None else 'bad',
+                    error_phase=job.error_phase_name
+                            if job is not None and error_type is not None else None,
+                    error_class=phase_stats.error_name(error_type)
+                            if error_type is not None else None,
+                    error=task.error[1] if task.error is not None else None,
+                    attempt_count=job.try_count if job is not None else None,
+                    job_time=time.monotonic() - task.begin_time,
+                    phase_time_map=job.phase_time_map if job is not None else None,
+                    )
+        
         with ui_lock:
+            if lj_reac_ctx is not None and (lj_reac_ctx.imap_rx_byte_count or
+                    lj_reac_ctx.imap_tx_byte_count):
+                out.write(
+                        '[task_{}] {}: imap traffic: received {} bytes, '
+                        'sent {} bytes'.format(
+                                task.task_i,
+                                task.lj_username,
+                                lj_reac_ctx.imap_rx_byte_count,
+                                lj_reac_ctx.imap_tx_byte_count,
+                                ),
+                        ext='out.log',
+                        )
+            
             if task.error is None:
-                with good_fd_lock:
-                    good_csv_writer.writerow((task.email, task.email_pass, task.lj_username, task.lj_pass))
-                    good_fd.flush()
+                out.write(
+                        csv_line((task.email, task.email_pass, task.lj_username, task.lj_pass)),
+                        ext='good.csv',
+                        end='',
+                        )
                 
                 print_str = '[task_{}] {}: done'.format(task.task_i, task.lj_username)
                 out.write(print_str, ext='out.log')
@@ -116,9 +653,11 @@ def main():
             else:
                 error_type, error_str, error_tb = task.error
                 
-                with bad_fd_lock:
-                    bad_csv_writer.writerow((task.email, task.email_pass, task.lj_username, task.lj_pass))
-                    bad_fd.flush()
+                out.write(
+                        csv_line((task.email, task.email_pass, task.lj_username, task.lj_pass)),
+                        ext='bad.csv',
+                        end='',
+                        )
                 
                 print_str = '[task_{}] {}: error: {!r} {!r}'.format(
                         task.task_i, task.lj_username, error_type, error_str
@@ -127,23 +666,142 @@ def main():
                 out.write(print_str, ext='err.log')
                 out.write('{}\n\n{}\n\n'.format(print_str, error_tb), ext='err-tb.log')
                 print(print_str)
+            
+            out.write(progress_journal.journal_line(task.row_i), ext='journal')
+        
+        if work_q is not None:
+            out.after_write(lambda: work_q.confirm(task.row_i))
+    
+    def recovered_handler(task, status, error):
+        # the result is recorded by other run, which is crashed before
+        # writing of it
+        
+        if results is not None:
+            results.record(
+                    task.row_i,
+                    dedup.account_key(task.lj_username),
+                    (task.email, task.email_pass, task.lj_username, task.lj_pass),
+                    status,
+                    error=error,
+                    )
+        
+        with ui_lock:
+            out.write(
+                    csv_line((task.email, task.email_pass, task.lj_username, task.lj_pass)),
+                    ext='good.csv' if status == 'good' else 'bad.csv',
+                    end='',
+                    )
+            
+            if status == 'good':
+                print_str = '[task_{}] {}: done (recorded by other run)'.format(
+                        task.task_i,
+                        task.lj_username,
+                        )
+            else:
+                print_str = '[task_{}] {}: error (recorded by other run): {}'.format(
+                        task.task_i,
+                        task.lj_username,
+                        error,
+                        )
+                out.write(print_str, ext='err.log')
+            
+            out.write(print_str, ext='out.log')
+            print(print_str)
+            
+            out.write(progress_journal.journal_line(task.row_i), ext='journal')
+        
+        out.after_write(lambda: work_q.confirm(task.row_i))
+    
+    def adaptive_log_func(print_str):
+        with ui_lock:
+            out.write(print_str, ext='out.log')
+            print(print_str)
+    
+    if use_adaptive:
+        concurrency = adaptive_limit.AdaptiveConcurrency(
+                adaptive_min,
+                adaptive_max,
+                log_func=adaptive_log_func,
+                )
+    else:
+        concurrency = None
     
     task_counter = itertools.count()
+    row_dedup = dedup.RowDedup() if use_dedup else None
+    mailbox_locks = dedup.MailboxLockMap()
+    resume_skip_counter = itertools.count()
     
-    def new_task_iter():
-        for row in in_csv_reader:
-            if len(row) != 4:
-                continue
+    def new_task(row_i, row):
+        # duplicates are checked before finished rows, so account keys of
+        # rows finished by previous run are known on resume too
+        
+        if row_dedup is not None and row_dedup.is_duplicate(row[2]):
+            return
+        
+        # every shard reads all rows (so dedup and row numbers of journal
+        # are the same as without shards) and takes its rows
+        
+        if shard is not None and \
+                shard_run.shard_of(row[0], shard.count) != shard.index:
+            return
+        
+        if finished_rows is not None and row_i in finished_rows:
+            next(resume_skip_counter)
             
-            task = Task()
-            task.task_i = next(task_counter)
-            task.email, task.email_pass, task.lj_username, task.lj_pass = row
+            return
+        
+        if work_q is not None:
+            work_q.put(row_i, row)
             
-            yield task
+            return
+        
+        return new_row_task(row_i, row)
+    
+    def new_row_task(row_i, row):
+        task = Task()
+        task.task_i = next(task_counter)
+        task.row_i = row_i
+        task.email, task.email_pass, task.lj_username, task.lj_pass = row
+        task.job = None
+        
+        return task
+    
+    def work_queue_get():
+        while True:
+            lease = work_q.get()
+            
+            if lease is None:
+                return
+            
+            row_i, row, result = lease
+            task = new_row_task(row_i, row)
+            
+            if result is None:
+                return task
+            
+            recovered_handler(task, *result)
+    
+    ingest = task_ingest.TaskIngest(in_fd, new_task, prefetch=prefetch)
+    ingest.start()
     
-    task_iter = new_task_iter()
-    task_iter_lock = threading.RLock()
-    useragent_list = get_useragent.get_useragent_list()
+    if work_q is not None:
+        # all rows are added to work queue before jobs (other runs may take
+        # them too)
+        
+        ingest.join()
+        
+        if ingest.error is not None:
+            raise ingest.error
+        
+        work_q.flush()
+        work_q.start()
+        task_get = work_queue_get
+    else:
+        task_get = ingest.get
+    
+    useragent_list = get_useragent.get_useragent_list(
+            opener=reactivator.build_opener(),
+            )
     
     print_str = 'user agent string list: {}'.format(
             ', '.join(repr(s) for s in  useragent_list),
@@ -151,39 +809,380 @@ def main():
     out.write(print_str, ext='out.log')
     print(print_str)
     
+    def new_task_job(task):
+        return phase_retry.new_job(
+                email=task.email,
+                email_pass=task.email_pass,
+                lj_username=task.lj_username,
+                lj_pass=task.lj_pass,
+                ua_name=random.choice(useragent_list),
+                proxy_address=proxy_address,
+                budget=job_budget,
+                )
+    
+    metrics.set_gauge_func('queue_depth', ingest.queue_size, queue='ingest')
+    
+    if use_metrics_file or metrics_port is not None:
+        metrics_surface = live_metrics.MetricsSurface(
+                metrics,
+                metrics_interval,
+                path=out.get_path(ext='metrics.prom') if use_metrics_file else None,
+                port=metrics_port,
+                )
+        metrics_surface.start()
+    else:
+        metrics_surface = None
+    
     def thread_func():
         while True:
-            with task_iter_lock:
-                try:
-                    task = next(task_iter)
-                except StopIteration:
-                    break
+            task = retry_sched.get()
+            
+            if task is None:
+                break
+            
+            if task.job is None:
+                begin_handler(task)
+                
+                task.begin_time = time.monotonic()
+                task.job = new_task_job(task)
+            
+            delay = phase_retry.job_step(
+                    task.job,
+                    safe_run_func=safe_run_func,
+                    mailbox_locks=mailbox_locks,
+                    concurrency=concurrency,
+                    )
+            
+            if delay is not None:
+                retry_sched.retry(task, delay)
+                
+                continue
+            
+            task.result, task.error = None, task.job.error
             
+            done_handler(task)
+            retry_sched.done(task)
+    
+    def stage_step_func(stage, task):
+        if task.job is None:
             begin_handler(task)
             
-            result, error = safe_run.three_safe_run(
-                    reactivator.blocking_lj_reactivator,
-                    email=task.email,
-                    email_pass=task.email_pass,
-                    lj_username=task.lj_username,
-                    lj_pass=task.lj_pass,
-                    ua_name=random.choice(useragent_list),
-                    proxy_address=proxy_address,
+            task.begin_time = time.monotonic()
+            task.job = new_task_job(task)
+        
+        return phase_retry.job_step(
+                task.job,
+                safe_run_func=safe_run_func,
+                mailbox_locks=mailbox_locks,
+                concurrency=concurrency,
+                phase_list=staged_reactivator.PHASE_LIST,
+                phase_name_set=stage.phase_name_set,
+                )
+    
+    def stage_next_phase_func(task):
+        if task.job is None:
+            return staged_reactivator.PHASE_LIST[0].__name__
+        
+        if task.job.finished:
+            return
+        
+        return staged_reactivator.PHASE_LIST[task.job.phase_i].__name__
+    
+    def stage_done_func(task):
+        task.result, task.error = None, task.job.error
+        
+        done_handler(task)
+    
+    async def async_worker_func(ready_queue, job_slots, executor):
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            task = await ready_queue.get()
+            
+            if task is None:
+                break
+            
+            if task.job is None:
+                begin_handler(task)
+                
+                task.begin_time = time.monotonic()
+                task.job = new_task_job(task)
+            
+            delay = await phase_retry.async_job_step(
+                    task.job,
+                    executor=executor,
+                    mailbox_locks=mailbox_locks,
+                    concurrency=concurrency,
                     )
             
-            task.result, task.error = result, error
+            if delay is not None:
+                # the event loop keeps a timer heap, so waiting for retry
+                # does not hold a worker
+                
+                loop.call_later(delay, ready_queue.put_nowait, task)
+                
+                continue
+            
+            task.result, task.error = None, task.job.error
             
             done_handler(task)
+            job_slots.release()
+    
+    async def async_main_func():
+        # jobs in progress (including ones which are waiting for retry) are
+        # limited by ``job_slots``, so ``ready_queue`` is bounded and
+        # reading of in csv-file goes not faster than jobs are finished
+        
+        loop = asyncio.get_running_loop()
+        ready_queue = asyncio.Queue()
+        metrics.set_gauge_func('queue_depth', ready_queue.qsize, queue='ready')
+        job_slots = asyncio.Semaphore(thread_count)
+        
+        with futures.ThreadPoolExecutor(max_workers=io_thread_count) as executor:
+            worker_list = list(
+                    asyncio.create_task(
+                            async_worker_func(ready_queue, job_slots, executor),
+                            )
+                    for worker_i in range(thread_count))
+            
+            while True:
+                await job_slots.acquire()
+                task = await loop.run_in_executor(executor, task_get)
+                
+                if task is None:
+                    job_slots.release()
+                    
+                    break
+                
+                ready_queue.put_nowait(task)
+            
+            for worker in worker_list:
+                await job_slots.acquire()
+            
+            for worker in worker_list:
+                ready_queue.put_nowait(None)
+            
+            await asyncio.gather(*worker_list)
+    
+    run_begin_time = time.monotonic()
+    
+    # with work queue, the run is repeated while rows of expired leases of
+    # other runs appear
+    
+    while True:
+        if async_mode:
+            asyncio.run(async_main_func())
+        elif stage_list is not None:
+            stage_pipeline.run_pipeline(
+                    stage_list,
+                    task_get,
+                    thread_count,
+                    stage_step_func,
+                    stage_next_phase_func,
+                    stage_done_func,
+                    stats=stats,
+                    metrics=metrics,
+                    )
+        else:
+            retry_sched = phase_retry.RetrySched(
+                    task_get,
+                    max_item_count=thread_count * phase_retry.SCHED_ITEMS_PER_WORKER,
+                    )
+            metrics.set_gauge_func('queue_depth', retry_sched.retry_size, queue='retry')
+            
+            thread_list = list(threading.Thread(target=thread_func)
+                    for thread_i in range(thread_count))
+            
+            for thread in thread_list:
+                thread.start()
+            
+            for thread in thread_list:
+                thread.join()
+        
+        if work_q is None or not work_q.wait_for_leases():
+            break
+        
+        print_str = 'work queue: taking rows of expired leases'
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    run_time = time.monotonic() - run_begin_time
+    
+    if metrics_surface is not None:
+        metrics_surface.stop()
+    
+    # recorded IMAP sessions are written to the trace on shutdown, so the
+    # pool is drained before the trace is closed
+    
+    imap_pool.close_all()
+    
+    if http_pool is not None:
+        http_pool.close_all()
+    
+    if trace_writer is not None:
+        trace_writer.close()
+    
+    uid_cache.close()
+    ingest.join()
+    in_fd.close()
+    
+    if ingest.error is not None:
+        raise ingest.error
+    
+    # in work queue mode rows only are added to the queue by ingest: tasks of
+    # the run are rows which were leased by it
+    
+    print_str = 'in csv-file: rows {}, tasks {}, empty rows {}, ' \
+            'malformed rows {}'.format(
+                    ingest.row_count,
+                    ingest.task_count if work_q is None else work_q.lease_count,
+                    ingest.empty_count,
+                    ingest.malformed_count,
+                    )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    if row_dedup is not None:
+        print_str = 'dedup: collapsed {} duplicate rows'.format(
+                row_dedup.duplicate_count,
+                )
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    if finished_rows is not None:
+        print_str = 'resume: journal has {} finished rows, skipped {} rows'.format(
+                finished_rows.count,
+                next(resume_skip_counter),
+                )
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    if work_q is not None:
+        print_str = 'work queue: added {} rows, leased {} rows (expired ' \
+                'leases {}, recovered results {}), acknowledged {}, lost ' \
+                'leases {}'.format(
+                        work_q.put_count,
+                        work_q.lease_count,
+                        work_q.expired_count,
+                        work_q.recovered_count,
+                        work_q.ack_count,
+                        work_q.lost_count,
+                        )
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    if results is not None:
+        results.close()
+        
+        print_str = 'results db: recorded {} results by {} transactions'.format(
+                results.record_count,
+                results.batch_count,
+                )
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    print_str = 'imap sessions: opened {}, reused {}, failed checks {}, ' \
+            'evicted {}'.format(
+                    imap_pool.open_count,
+                    imap_pool.reuse_count,
+                    imap_pool.check_fail_count,
+                    imap_pool.evict_count,
+                    )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    if http_pool is not None:
+        print_str = 'http connections: opened {}, reused {}, stale {}, ' \
+                'over read limit {}'.format(
+                        http_pool.open_count,
+                        http_pool.reuse_count,
+                        http_pool.stale_count,
+                        http_pool.over_limit_count,
+                        )
+        out.write(print_str, ext='out.log')
+        print(print_str)
+    
+    dns_cache = net_cache.DEFAULT_DNS_CACHE
+    print_str = 'dns cache: hits {}, misses {}, hit rate {:.1f}%'.format(
+            dns_cache.hit_count,
+            dns_cache.miss_count,
+            net_cache.hit_rate(dns_cache.hit_count, dns_cache.miss_count),
+            )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    tls_cache = net_cache.DEFAULT_TLS_CACHE
+    print_str = 'tls sessions: resumed {}, full handshakes {}, ' \
+            'hit rate {:.1f}%'.format(
+                    tls_cache.resume_count,
+                    tls_cache.full_count,
+                    net_cache.hit_rate(tls_cache.resume_count, tls_cache.full_count),
+                    )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    if concurrency is not None:
+        for host_limit in concurrency.limit_list():
+            print_str = 'adaptive: {}: final limit {} (min {}, max {}), ' \
+                    'decreased {} times'.format(
+                            host_limit.host,
+                            int(host_limit.limit),
+                            host_limit.min_limit,
+                            host_limit.max_limit,
+                            host_limit.decrease_count,
+                            )
+            out.write(print_str, ext='out.log')
+            print(print_str)
+    
+    if stage_list is not None:
+        for stage in stage_list:
+            print_str = 'stage {}: workers {}, steps {}, busy {:.1f}%'.format(
+                    stage.name,
+                    stage.worker_count,
+                    stage.step_count,
+                    stage.busy_time * 100.0 / (stage.worker_count * run_time)
+                            if run_time else 0.0,
+                    )
+            out.write(print_str, ext='out.log')
+            print(print_str)
+    
+    print_str = 'mailbox locks: put off {} steps'.format(
+            mailbox_locks.busy_count,
+            )
+    out.write(print_str, ext='out.log')
+    print(print_str)
+    
+    print_str = 'uid cache: hits {}, misses {}'.format(
+            uid_cache.hit_count,
+            uid_cache.miss_count,
+            )
+    out.write(print_str, ext='out.log')
+    print(print_str)
     
-    thread_list = list(threading.Thread(target=thread_func)
-            for thread_i in range(thread_count))
+    stats_path = out.get_path(ext='stats.json')
     
-    for thread in thread_list:
-        thread.start()
+    if stats_path is not None:
+        phase_stats.write_summary(stats_path, stats.summary())
     
-    for thread in thread_list:
-        thread.join()
+    for name, metric_summary in stats.summary()['metrics'].items():
+        print_str = '{}: count {}, errors {}, p50 {:.3f}s, p95 {:.3f}s, ' \
+                'p99 {:.3f}s'.format(
+                        name,
+                        metric_summary['count'],
+                        metric_summary['error_count'],
+                        metric_summary['p50'],
+                        metric_summary['p95'],
+                        metric_summary['p99'],
+                        )
+        out.write(print_str, ext='out.log')
+        print(print_str)
     
     print_str = 'done!'
     out.write(print_str, ext='out.log')
+    out.stop_writer()
     print(print_str)
+    
+    if work_q is not None:
+        # results are confirmed by the writer
+        
+        work_q.close()
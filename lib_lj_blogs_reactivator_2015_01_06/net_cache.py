@@ -0,0 +1,219 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import time
+import socket
+import ssl
+
+DEFAULT_DNS_TTL = 300.0
+
+class DnsCache:
+    # process-wide cache of ``getaddrinfo()`` results. ``getaddrinfo()``
+    # does not give TTL of records, so results are kept for ``ttl`` seconds.
+    # concurrent misses of the same address wait for one lookup
+    
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = DEFAULT_DNS_TTL
+        
+        self.ttl = ttl
+        self._cond = threading.Condition()
+        # (host, port) -> (expire_time, addr_info_list)
+        self._addr_map = {}
+        # (host, port) of lookups in progress
+        self._pending_set = set()
+        self.hit_count = 0
+        self.miss_count = 0
+    
+    def resolve(self, host, port):
+        # this function is thread-safe
+        
+        key = host, port
+        
+        with self._cond:
+            while True:
+                entry = self._addr_map.get(key)
+                
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hit_count += 1
+                    
+                    return entry[1]
+                
+                if key not in self._pending_set:
+                    break
+                
+                self._cond.wait()
+            
+            self.miss_count += 1
+            self._pending_set.add(key)
+        
+        try:
+            addr_info_list = socket.getaddrinfo(
+                    host,
+                    port,
+                    0,
+                    socket.SOCK_STREAM,
+                    )
+        except:
+            with self._cond:
+                self._pending_set.discard(key)
+                self._cond.notify_all()
+            
+            raise
+        
+        with self._cond:
+            self._addr_map[key] = time.monotonic() + self.ttl, addr_info_list
+            self._pending_set.discard(key)
+            self._cond.notify_all()
+        
+        return addr_info_list
+    
+    def forget(self, host, port):
+        # this function is thread-safe
+        
+        with self._cond:
+            self._addr_map.pop((host, port), None)
+    
+    def create_connection(
+            self,
+            address,
+            timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+            source_address=None,
+            ):
+        # like ``socket.create_connection()``, but addresses are taken from
+        # the cache. if no address can be connected, the cached addresses
+        # are forgotten
+        
+        host, port = address
+        last_error = None
+        
+        for af, socktype, proto, canonname, sa in self.resolve(host, port):
+            sock = None
+            
+            try:
+                sock = socket.socket(af, socktype, proto)
+                
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                
+                if source_address is not None:
+                    sock.bind(source_address)
+                
+                sock.connect(sa)
+                
+                return sock
+            except OSError as err:
+                last_error = err
+                
+                if sock is not None:
+                    sock.close()
+        
+        self.forget(host, port)
+        
+        if last_error is None:
+            raise OSError('getaddrinfo returns an empty list')
+        
+        raise last_error
+
+class TlsSessionCache:
+    # one ``SSLContext`` for all TLS connections, and the last TLS session of
+    # every (server_hostname, port), so new connections resume sessions
+    # instead of full handshakes
+    
+    def __init__(self, context=None):
+        if context is None:
+            context = ssl.create_default_context()
+        
+        self.context = context
+        self._lock = threading.Lock()
+        # (server_hostname, port) -> session
+        self._session_map = {}
+        self.resume_count = 0
+        self.full_count = 0
+    
+    def wrap_socket(self, sock, server_hostname, port):
+        # this function is thread-safe
+        
+        key = server_hostname, port
+        
+        with self._lock:
+            session = self._session_map.get(key)
+        
+        ssl_sock = self.context.wrap_socket(
+                sock,
+                server_hostname=server_hostname,
+                session=session,
+                )
+        
+        with self._lock:
+            if ssl_sock.session_reused:
+                self.resume_count += 1
+            else:
+                self.full_count += 1
+        
+        self.save(ssl_sock, port)
+        
+        return ssl_sock
+    
+    def save(self, ssl_sock, port):
+        # keeps session of ``ssl_sock``. TLS 1.3 tickets come after the
+        # handshake, so it is called again before the socket is closed.
+        # this function is thread-safe
+        
+        if not isinstance(ssl_sock, ssl.SSLSocket):
+            return
+        
+        try:
+            session = ssl_sock.session
+        except (OSError, ValueError):
+            return
+        
+        if session is None:
+            return
+        
+        with self._lock:
+            self._session_map[ssl_sock.server_hostname, port] = session
+    
+    def bind(self, port):
+        # returns object which looks like ``SSLContext`` for
+        # ``imaplib.IMAP4.starttls()``
+        
+        return BoundTlsContext(self, port)
+
+class BoundTlsContext:
+    def __init__(self, tls_cache, port):
+        self._tls_cache = tls_cache
+        self._port = port
+    
+    def wrap_socket(self, sock, server_hostname=None):
+        return self._tls_cache.wrap_socket(sock, server_hostname, self._port)
+
+def hit_rate(hit_count, miss_count):
+    total = hit_count + miss_count
+    
+    return hit_count * 100.0 / total if total else 0.0
+
+DEFAULT_DNS_CACHE = DnsCache()
+DEFAULT_TLS_CACHE = TlsSessionCache()
@@ -23,8 +23,14 @@
 assert str is not bytes
 
 import os, os.path, threading
+import queue
+import time
+import atexit
+import json
 
 DEFAULT_EXT = 'txt'
+DEFAULT_FLUSH_SIZE = 65536
+DEFAULT_FLUSH_DELAY = 1.0
 
 def normalize_ext(txt_file, ext=None):
     if not txt_file:
@@ -90,9 +96,16 @@ def create_file(path):
     
     return open(path, 'w', encoding='utf-8', newline='\n')
 
+def open_for_append(path):
+    return open(path, 'a', encoding='utf-8', newline='\n')
+
 class OutMgr(object):
-    def __init__(self, out_file=None, ext=None):
+    def __init__(self, out_file=None, ext=None, append=None):
+        # ``append``: existing out files are continued (they are not
+        # renamed to ``last-N.*``)
+        
         self._lock = threading.RLock()
+        self._append = bool(append)
         
         if ext is not None:
             self._ext = ext
@@ -100,6 +113,28 @@ class OutMgr(object):
             self._ext = DEFAULT_EXT
         self._out_file = normalize_ext(out_file, self._ext)
         self._fd_map = {}
+        self._queue = None
+        self._writer_thread = None
+        self._forward_fd = None
+        self.writer_error = None
+        self.group_count = 0
+    
+    def get_path(self, ext=None):
+        # returns path of out file with extension ``ext``. the file is not
+        # created and not renamed
+        
+        if ext is None:
+            ext = self._ext
+        
+        out_file = self._out_file
+        
+        if out_file is None:
+            return
+        
+        if ext != self._ext:
+            out_file = change_ext(out_file, ext)
+        
+        return out_file
     
     def get_fd_and_lock(self, ext=None):
         # this function is thread-safe
@@ -121,16 +156,33 @@ class OutMgr(object):
             if ext in self._fd_map:
                 return self._fd_map[ext], lock
             
-            self._fd_map[ext] = fd = create_file(out_file)
+            if self._append:
+                self._fd_map[ext] = fd = open_for_append(out_file)
+            else:
+                self._fd_map[ext] = fd = create_file(out_file)
             
             return fd, lock
     
     def write(self, text, ext=None, end=None):
-        # this function is thread-safe
+        # this function is thread-safe. when the writer is started, text is
+        # only put into its queue
         
         if end is None:
             end = '\n'
         
+        if ext is None:
+            ext = self._ext
+        
+        # the queue is read once: ``stop_writer()`` may reset it meanwhile
+        
+        write_queue = self._queue
+        
+        if write_queue is not None:
+            if self._out_file is not None or self._forward_fd is not None:
+                write_queue.put(('text', (ext, '{}{}'.format(text, end))))
+            
+            return
+        
         fd, lock = self.get_fd_and_lock(ext=ext)
         
         if fd is None:
@@ -139,3 +191,155 @@ class OutMgr(object):
         with lock:    
             fd.write('{}{}'.format(text, end))
             fd.flush()
+    
+    def after_write(self, func):
+        # this function is thread-safe. ``func()`` is called (by the writer
+        # thread, when it is started) after all records which are given
+        # before are written
+        
+        write_queue = self._queue
+        
+        if write_queue is not None:
+            write_queue.put(('func', func))
+            
+            return
+        
+        func()
+    
+    def start_writer(self, flush_size=None, flush_delay=None, fsync=None,
+            last_ext=None, forward_fd=None):
+        # starts single writer thread: records of all extensions are grouped
+        # and written (and flushed) together when ``flush_size`` characters
+        # are gathered or ``flush_delay`` seconds are passed since first
+        # record of group. ``fsync``: out files are synced after every group.
+        # ``last_ext``: records of the extension are written after records of
+        # other extensions of the group (progress journal should not be
+        # ahead of results). ``forward_fd``: records are not written to out
+        # files, but are forwarded to the binary file as lines of JSON (see
+        # ``read_forwarded()``)
+        
+        if flush_size is None:
+            flush_size = DEFAULT_FLUSH_SIZE
+        
+        if flush_delay is None:
+            flush_delay = DEFAULT_FLUSH_DELAY
+        
+        assert self._writer_thread is None
+        
+        self._forward_fd = forward_fd
+        self._queue = queue.SimpleQueue()
+        self._writer_thread = threading.Thread(
+                target=self._writer_func,
+                args=(flush_size, flush_delay, bool(fsync), last_ext),
+                daemon=True,
+                )
+        self._writer_thread.start()
+        
+        # main thread may be finished by exception: gathered records should
+        # be written anyway
+        
+        atexit.register(self.stop_writer)
+    
+    def stop_writer(self):
+        # writes all gathered records and stops writer thread. error of
+        # writing (if any) is raised here
+        
+        writer_thread = self._writer_thread
+        
+        if writer_thread is None:
+            return
+        
+        self._queue.put(None)
+        writer_thread.join()
+        self._writer_thread = None
+        self._queue = None
+        atexit.unregister(self.stop_writer)
+        
+        if self.writer_error is not None:
+            raise self.writer_error
+    
+    def _write_group(self, group_map, fsync, last_ext):
+        ext_list = sorted(group_map, key=lambda ext: ext == last_ext)
+        
+        if self._forward_fd is not None:
+            self._forward_fd.write(b''.join(
+                    json.dumps((ext, text)).encode() + b'\n'
+                    for ext in ext_list
+                    for text in group_map[ext]))
+            self._forward_fd.flush()
+            self.group_count += 1
+            
+            return
+        
+        for ext in ext_list:
+            fd, lock = self.get_fd_and_lock(ext=ext)
+            
+            with lock:
+                fd.write(''.join(group_map[ext]))
+                fd.flush()
+                
+                if fsync:
+                    os.fsync(fd.fileno())
+        
+        self.group_count += 1
+    
+    def _writer_func(self, flush_size, flush_delay, fsync, last_ext):
+        group_map = {}
+        group_size = 0
+        flush_time = None
+        func_list = []
+        stopping = False
+        
+        while not stopping:
+            try:
+                if flush_time is None:
+                    item = self._queue.get()
+                else:
+                    item = self._queue.get(
+                            timeout=max(flush_time - time.monotonic(), 0.0),
+                            )
+            except queue.Empty:
+                pass
+            else:
+                if item is None:
+                    stopping = True
+                else:
+                    kind, value = item
+                    
+                    if kind == 'func':
+                        func_list.append(value)
+                    else:
+                        ext, text = value
+                        group_map.setdefault(ext, []).append(text)
+                        group_size += len(text)
+                    
+                    if flush_time is None:
+                        flush_time = time.monotonic() + flush_delay
+                    
+                    if group_size < flush_size and \
+                            time.monotonic() < flush_time:
+                        continue
+            
+            if self.writer_error is None:
+                try:
+                    if group_map:
+                        self._write_group(group_map, fsync, last_ext)
+                    
+                    for func in func_list:
+                        func()
+                except Exception as e:
+                    self.writer_error = e
+            
+            group_map = {}
+            group_size = 0
+            flush_time = None
+            func_list = []
+
+def read_forwarded(fd):
+    # yields (ext, text) records which are forwarded by ``OutMgr`` of other
+    # process. every record is whole: partial lines are not mixed
+    
+    for line in fd:
+        ext, text = json.loads(line.decode())
+        
+        yield ext, text
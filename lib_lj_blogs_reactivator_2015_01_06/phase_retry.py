@@ -0,0 +1,522 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import heapq
+import itertools
+import time
+from . import safe_run
+from . import reactivator
+from . import async_reactivator
+from . import dedup
+from . import phase_stats
+
+# phases from sending of validation mail until receiving of it use mailbox of
+# job exclusively (see ``dedup.MailboxLockMap``)
+MAILBOX_PHASE_NAME_SET = frozenset(('send_valid_phase', 'mail_phase'))
+MAILBOX_BUSY_DELAY = 1.0
+# duration of phase which waits for validation email is not latency of host
+# (see ``adaptive_limit``)
+WAIT_PHASE_NAME_SET = frozenset(('mail_phase',))
+HOST_BUSY_DELAY = 0.2
+# jobs in progress per worker thread (given to workers or waiting for retry).
+# a job waiting for retry holds its session (cookies, opener), so new jobs
+# are not begun beyond it
+SCHED_ITEMS_PER_WORKER = 4
+
+class RetryPolicy:
+    def __init__(self, try_count, delay, restart_phase_name=None):
+        # ``try_count`` is a limit of failed tries for whole job.
+        # ``restart_phase_name`` is a name of phase which job is resumed from
+        # (``None`` is the failed phase itself)
+        
+        self.try_count = try_count
+        self.delay = delay
+        self.restart_phase_name = restart_phase_name
+
+RETRY_POLICY_MAP = {
+        # other errors (network timeouts, IMAP errors, ...): repeat failed phase
+        Exception: RetryPolicy(3, safe_run.THREE_SAFE_RUN_DELAY),
+        reactivator.LjReactivatorError:
+                RetryPolicy(3, safe_run.THREE_SAFE_RUN_DELAY),
+        reactivator.UnknownEmailServiceError: RetryPolicy(1, None),
+        # validation email was lost: it should be sent once again
+        reactivator.MailNotReceivedError: RetryPolicy(
+                3, safe_run.THREE_SAFE_RUN_DELAY, 'send_valid_phase'),
+        # LJ session is possible expired: login once again
+        reactivator.SendValidLjError: RetryPolicy(
+                3, safe_run.THREE_SAFE_RUN_DELAY, 'login_phase'),
+        }
+
+def find_retry_policy(error_type):
+    for cls in error_type.__mro__:
+        policy = RETRY_POLICY_MAP.get(cls)
+        
+        if policy is not None:
+            return policy
+    
+    return RETRY_POLICY_MAP[Exception]
+
+class Job:
+    pass
+
+def new_job(**ctx_kwargs):
+    job = Job()
+    job.ctx_kwargs = ctx_kwargs
+    job.lj_reac_ctx = None
+    job.phase_i = 0
+    job.error_count = 0
+    job.error = None
+    job.error_phase_name = None
+    job.try_count = 0
+    # start time of current try of job (from its begin or from retry until
+    # error or end), ``None`` is no try
+    job.try_start_time = None
+    job.phase_time_map = {}
+    # time of steps of current phase try which were put off (phase returned
+    # delay), the try is recorded when it is finished
+    job.phase_put_off_time = 0.0
+    # budget of phase is begun (the phase is put off or is run again)
+    job.phase_budget_begun = False
+    job.finished = False
+    job.mailbox_key = dedup.mailbox_key(ctx_kwargs['email'])
+    job.mailbox_locked = False
+    
+    return job
+
+def job_lock_mailbox(job, phase_name, mailbox_locks):
+    # returns ``False`` if the mailbox is used by other job now
+    
+    if mailbox_locks is None:
+        return True
+    
+    if phase_name in MAILBOX_PHASE_NAME_SET:
+        if not job.mailbox_locked:
+            if not mailbox_locks.try_acquire(job.mailbox_key, job):
+                job.lj_reac_ctx.metrics.add('mailbox_busy_total')
+                
+                return False
+            
+            job.mailbox_locked = True
+    else:
+        job_unlock_mailbox(job, mailbox_locks)
+    
+    return True
+
+def job_unlock_mailbox(job, mailbox_locks):
+    if job.mailbox_locked:
+        mailbox_locks.release(job.mailbox_key, job)
+        job.mailbox_locked = False
+
+def job_record_try(job, error_type):
+    if job.try_start_time is None:
+        return
+    
+    job.lj_reac_ctx.stats.record(
+            'try.job',
+            time.monotonic() - job.try_start_time,
+            error_type,
+            )
+    job.try_start_time = None
+
+def job_error(job, phase_list, error):
+    # returns delay before next try or ``None`` if job is failed finally
+    
+    job_record_try(job, error[0])
+    job.error = error
+    job.error_count += 1
+    job.error_phase_name = phase_list[job.phase_i].__name__
+    job.phase_budget_begun = False
+    
+    policy = find_retry_policy(error[0])
+    
+    if job.error_count >= policy.try_count:
+        return
+    
+    if reactivator.budget_exhausted(job.lj_reac_ctx, delay=policy.delay):
+        # the next try would be begun after end of budget
+        
+        job_cancel(job, phase_list)
+        
+        return
+    
+    if job.lj_reac_ctx is not None:
+        job.lj_reac_ctx.metrics.add(
+                'job_retries_total',
+                phase=phase_list[job.phase_i].__name__,
+                )
+    
+    if policy.restart_phase_name is not None:
+        phase_name_list = list(phase_func.__name__ for phase_func in phase_list)
+        
+        job.phase_i = min(
+                job.phase_i,
+                phase_name_list.index(policy.restart_phase_name),
+                )
+    
+    return policy.delay
+
+def job_cancel(job, phase_list):
+    # budget of job is exhausted: job is failed finally. the last error (if
+    # any) is kept in the text of error
+    
+    last_error = job.error
+    error_str = 'job budget is exhausted'
+    
+    if last_error is not None:
+        error_str = '{} (last error: {!r} {!r})'.format(
+                error_str,
+                last_error[0],
+                last_error[1],
+                )
+    
+    job.error = (
+            reactivator.BudgetExhaustedError,
+            error_str,
+            last_error[2] if last_error is not None else '',
+            )
+    job.error_phase_name = phase_list[job.phase_i].__name__
+    
+    if job.lj_reac_ctx is not None:
+        job_record_try(job, reactivator.BudgetExhaustedError)
+        job.lj_reac_ctx.metrics.add(
+                'job_budget_exhausted_total',
+                phase=job.error_phase_name,
+                )
+
+def job_begin_budget(job, phase_list):
+    # returns ``False`` if budget of job is exhausted (job is cancelled
+    # then). budget of phase is begun when the phase is entered first time
+    # for the try
+    
+    if reactivator.budget_exhausted(job.lj_reac_ctx):
+        job_cancel(job, phase_list)
+        
+        return False
+    
+    if not job.phase_budget_begun:
+        reactivator.begin_phase_budget(
+                job.lj_reac_ctx,
+                list(phase_func.__name__ for phase_func in phase_list[job.phase_i:]),
+                )
+        job.phase_budget_begun = True
+    
+    return True
+
+def job_begin_phase(job, phase_func):
+    # returns start time of phase try
+    
+    start_time = time.monotonic()
+    
+    if job.try_start_time is None:
+        job.try_start_time = start_time
+    
+    job.lj_reac_ctx.metrics.add('phases_in_flight', phase=phase_func.__name__)
+    
+    return start_time
+
+def job_record_phase(job, phase_func, start_time, error, put_off=None):
+    # every try of phase is recorded, so errors of phase are counted by type
+    # even when the try is repeated later. ``put_off``: the phase returned
+    # delay, it is not a try yet (its time is added to the try)
+    
+    if put_off is None:
+        put_off = False
+    
+    lj_reac_ctx = job.lj_reac_ctx
+    phase_name = phase_func.__name__
+    error_type = error[0] if error is not None else None
+    step_time = time.monotonic() - start_time
+    
+    job.phase_time_map[phase_name] = \
+            job.phase_time_map.get(phase_name, 0.0) + step_time
+    lj_reac_ctx.metrics.add('phases_in_flight', -1, phase=phase_name)
+    
+    if put_off:
+        job.phase_put_off_time += step_time
+        
+        return
+    
+    phase_time = job.phase_put_off_time + step_time
+    job.phase_put_off_time = 0.0
+    job.try_count += 1
+    
+    lj_reac_ctx.stats.record(
+            'phase.{}'.format(phase_name),
+            phase_time,
+            error_type,
+            )
+    lj_reac_ctx.metrics.add('phase_tries_total', phase=phase_name)
+    
+    if error_type is not None:
+        lj_reac_ctx.metrics.add(
+                'phase_errors_total',
+                phase=phase_name,
+                error=phase_stats.error_name(error_type),
+                )
+
+def job_host_limit(job, phase_func, concurrency):
+    # returns ``AimdLimit`` of host of phase or ``None``
+    
+    if concurrency is None:
+        return
+    
+    host = reactivator.phase_host(job.lj_reac_ctx, phase_func.__name__)
+    
+    if host is None:
+        return
+    
+    return concurrency.get_limit(host)
+
+def job_release_host(job, phase_func, slot, start_time, error):
+    if slot is None:
+        return
+    
+    slot.limit.release(
+            slot,
+            error_type=error[0] if error is not None else None,
+            latency=time.monotonic() - start_time
+                    if phase_func.__name__ not in WAIT_PHASE_NAME_SET else None,
+            )
+
+def job_step(
+        job,
+        safe_run_func=None,
+        mailbox_locks=None,
+        concurrency=None,
+        phase_list=None,
+        phase_name_set=None,
+        ):
+    # runs phases of job beginning from ``job.phase_i``. state of phases
+    # (cookies, confirm_url, ...) is kept in ``job.lj_reac_ctx`` between
+    # steps. returns delay before next step or ``None`` if job is finished
+    # (``job.finished``) or if the next phase is not in ``phase_name_set``.
+    # a phase may return delay too: it is run again after the delay.
+    # a step is put off when ``mailbox_locks`` has mailbox of job busy.
+    # if ``concurrency`` is given, concurrent phases of one host are limited
+    # by it (waiting for free slot holds the thread)
+    
+    if safe_run_func is None:
+        safe_run_func = safe_run.in_thread_safe_run
+    
+    if phase_list is None:
+        phase_list = reactivator.PHASE_LIST
+    
+    if job.lj_reac_ctx is None:
+        job.lj_reac_ctx, error = safe_run_func(
+                reactivator.new_lj_reactivator_ctx,
+                **job.ctx_kwargs
+                )
+        
+        if error is not None:
+            job.error = error
+            job.finished = True
+            
+            return
+    
+    while job.phase_i < len(phase_list):
+        phase_func = phase_list[job.phase_i]
+        
+        if phase_name_set is not None and phase_func.__name__ not in phase_name_set:
+            return
+        
+        if not job_begin_budget(job, phase_list):
+            job_unlock_mailbox(job, mailbox_locks)
+            job.finished = True
+            
+            return
+        
+        if not job_lock_mailbox(job, phase_func.__name__, mailbox_locks):
+            return MAILBOX_BUSY_DELAY
+        
+        host_limit = job_host_limit(job, phase_func, concurrency)
+        slot = host_limit.acquire() if host_limit is not None else None
+        start_time = job_begin_phase(job, phase_func)
+        result, error = safe_run_func(phase_func, job.lj_reac_ctx)
+        job_record_phase(
+                job,
+                phase_func,
+                start_time,
+                error,
+                put_off=error is None and result is not None,
+                )
+        job_release_host(job, phase_func, slot, start_time, error)
+        
+        if error is not None:
+            delay = job_error(job, phase_list, error)
+            
+            if delay is None:
+                job_unlock_mailbox(job, mailbox_locks)
+                job.finished = True
+            
+            return delay
+        
+        if result is not None:
+            return result
+        
+        job.phase_i += 1
+        job.phase_budget_begun = False
+    
+    job_record_try(job, None)
+    job_unlock_mailbox(job, mailbox_locks)
+    job.error = None
+    job.finished = True
+
+async def async_job_step(job, executor=None, mailbox_locks=None, concurrency=None):
+    if job.lj_reac_ctx is None:
+        job.lj_reac_ctx, error = safe_run.in_thread_safe_run(
+                reactivator.new_lj_reactivator_ctx,
+                **job.ctx_kwargs
+                )
+        
+        if error is not None:
+            job.error = error
+            job.finished = True
+            
+            return
+        
+        job.lj_reac_ctx.executor = executor
+    
+    while job.phase_i < len(async_reactivator.PHASE_LIST):
+        phase_func = async_reactivator.PHASE_LIST[job.phase_i]
+        
+        if not job_begin_budget(job, async_reactivator.PHASE_LIST):
+            job_unlock_mailbox(job, mailbox_locks)
+            job.finished = True
+            
+            return
+        
+        if not job_lock_mailbox(job, phase_func.__name__, mailbox_locks):
+            return MAILBOX_BUSY_DELAY
+        
+        host_limit = job_host_limit(job, phase_func, concurrency)
+        
+        if host_limit is not None:
+            # step is put off instead of waiting: it would block the event loop
+            
+            slot = host_limit.try_acquire()
+            
+            if slot is None:
+                return HOST_BUSY_DELAY
+        else:
+            slot = None
+        
+        start_time = job_begin_phase(job, phase_func)
+        result, error = await safe_run.async_safe_run(phase_func, job.lj_reac_ctx)
+        job_record_phase(job, phase_func, start_time, error)
+        job_release_host(job, phase_func, slot, start_time, error)
+        
+        if error is not None:
+            delay = job_error(job, async_reactivator.PHASE_LIST, error)
+            
+            if delay is None:
+                job_unlock_mailbox(job, mailbox_locks)
+                job.finished = True
+            
+            return delay
+        
+        job.phase_i += 1
+        job.phase_budget_begun = False
+    
+    job_record_try(job, None)
+    job_unlock_mailbox(job, mailbox_locks)
+    job.error = None
+    job.finished = True
+
+class RetrySched:
+    # gives items to workers: items which retry time has come (from timer
+    # heap) first, then new items from ``get_item_func()`` (it must be
+    # thread-safe and must return ``None`` when items are over). every item
+    # given by ``get()`` must be returned back by ``retry()`` or by ``done()``.
+    # new items are not taken while ``max_item_count`` items are in progress
+    # (given to workers or waiting for retry)
+    
+    def __init__(self, get_item_func, max_item_count=None):
+        self._get_item_func = get_item_func
+        self._max_item_count = max_item_count
+        self._item_iter_done = False
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._active_count = 0
+    
+    def get(self):
+        # this function is thread-safe
+        
+        while True:
+            with self._cond:
+                while True:
+                    if self._heap and self._heap[0][0] <= time.monotonic():
+                        retry_time, seq, item = heapq.heappop(self._heap)
+                        self._active_count += 1
+                        
+                        return item
+                    
+                    if not self._item_iter_done:
+                        if self._max_item_count is None or \
+                                self._active_count + len(self._heap) < \
+                                self._max_item_count:
+                            break
+                    elif not self._heap and not self._active_count:
+                        return
+                    
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - time.monotonic())
+                    else:
+                        self._cond.wait()
+                
+                self._active_count += 1
+            
+            item = self._get_item_func()
+            
+            if item is not None:
+                return item
+            
+            with self._cond:
+                self._item_iter_done = True
+                self._active_count -= 1
+                self._cond.notify_all()
+    
+    def retry_size(self):
+        # count of items which are waiting for retry
+        
+        return len(self._heap)
+    
+    def retry(self, item, delay):
+        # this function is thread-safe
+        
+        with self._cond:
+            heapq.heappush(
+                    self._heap,
+                    (time.monotonic() + delay, next(self._seq), item),
+                    )
+            self._active_count -= 1
+            self._cond.notify_all()
+    
+    def done(self, item):
+        # this function is thread-safe
+        
+        with self._cond:
+            self._active_count -= 1
+            self._cond.notify_all()
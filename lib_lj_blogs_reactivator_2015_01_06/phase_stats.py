@@ -0,0 +1,174 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os, os.path
+import threading
+import contextlib
+import math
+import time
+import json
+
+# latencies are counted in log-scale buckets: every bucket is
+# ``HISTOGRAM_RATIO`` times wider than previous one, so percentiles have
+# relative error less than 5% and histogram has less than 200 buckets
+HISTOGRAM_MIN_VALUE = 0.0001
+HISTOGRAM_RATIO = 1.1
+SUMMARY_PERCENTILES = (50, 95, 99)
+
+def error_name(error_type):
+    return error_type.__qualname__
+
+class Histogram:
+    def __init__(self):
+        self._bucket_map = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, value):
+        if value > HISTOGRAM_MIN_VALUE:
+            bucket_i = int(math.log(value / HISTOGRAM_MIN_VALUE, HISTOGRAM_RATIO)) + 1
+        else:
+            bucket_i = 0
+        
+        self._bucket_map[bucket_i] = self._bucket_map.get(bucket_i, 0) + 1
+        self.count += 1
+        self.total += value
+        
+        if self.min is None or value < self.min:
+            self.min = value
+        
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def percentile(self, percent):
+        if not self.count:
+            return
+        
+        rank = percent * self.count / 100.0
+        passed_count = 0
+        
+        for bucket_i in sorted(self._bucket_map):
+            passed_count += self._bucket_map[bucket_i]
+            
+            if passed_count >= rank:
+                break
+        
+        # geometric middle of bucket, but not out of seen values
+        
+        if bucket_i:
+            value = HISTOGRAM_MIN_VALUE * HISTOGRAM_RATIO ** (bucket_i - 0.5)
+        else:
+            value = HISTOGRAM_MIN_VALUE
+        
+        return min(max(value, self.min), self.max)
+
+class Metric:
+    def __init__(self):
+        self.histogram = Histogram()
+        self.error_count = 0
+        self.error_count_map = {}
+
+class PhaseStats:
+    # latencies of phases, mail polls, tries, ... by name. every record is
+    # an one duration and an error type (``None`` for success)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metric_map = {}
+        self.start_time = time.monotonic()
+    
+    def record(self, name, seconds, error_type=None):
+        # this function is thread-safe
+        
+        with self._lock:
+            metric = self._metric_map.get(name)
+            
+            if metric is None:
+                self._metric_map[name] = metric = Metric()
+            
+            metric.histogram.add(seconds)
+            
+            if error_type is not None:
+                key = error_name(error_type)
+                metric.error_count += 1
+                metric.error_count_map[key] = metric.error_count_map.get(key, 0) + 1
+    
+    @contextlib.contextmanager
+    def timer(self, name):
+        start_time = time.monotonic()
+        
+        try:
+            yield
+        except BaseException as err:
+            self.record(name, time.monotonic() - start_time, type(err))
+            
+            raise
+        
+        self.record(name, time.monotonic() - start_time)
+    
+    def summary(self):
+        # returns JSON-compatible ``dict``
+        
+        with self._lock:
+            metric_summary_map = {}
+            
+            for name, metric in sorted(self._metric_map.items()):
+                histogram = metric.histogram
+                metric_summary = {
+                        'count': histogram.count,
+                        'error_count': metric.error_count,
+                        'errors': dict(sorted(metric.error_count_map.items())),
+                        'total': histogram.total,
+                        'min': histogram.min,
+                        'max': histogram.max,
+                        }
+                
+                for percent in SUMMARY_PERCENTILES:
+                    metric_summary['p{}'.format(percent)] = \
+                            histogram.percentile(percent)
+                
+                metric_summary_map[name] = metric_summary
+        
+        return {
+                'elapsed': time.monotonic() - self.start_time,
+                'metrics': metric_summary_map,
+                }
+
+def write_summary(path, summary):
+    # the file is replaced at once, so readers never see a half of it
+    
+    tmp_path = os.path.join(
+            os.path.dirname(path),
+            'new.{}'.format(os.path.basename(path)),
+            )
+    
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as fd:
+        json.dump(summary, fd, indent=4)
+        fd.write('\n')
+    
+    os.replace(tmp_path, path)
+
+DEFAULT_PHASE_STATS = PhaseStats()
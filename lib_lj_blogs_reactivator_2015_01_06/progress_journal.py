@@ -0,0 +1,77 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os.path
+
+# progress journal: append-only file with indexes of finished rows of in
+# csv-file (one decimal number per line)
+
+class RowBitmap:
+    # set of non-negative integers (one bit per number)
+    
+    def __init__(self):
+        self._data = bytearray()
+        self.count = 0
+    
+    def add(self, num):
+        byte_i, bit_mask = num >> 3, 1 << (num & 7)
+        
+        if byte_i >= len(self._data):
+            self._data.extend(bytes(max(byte_i + 1 - len(self._data), len(self._data))))
+        
+        if not self._data[byte_i] & bit_mask:
+            self._data[byte_i] |= bit_mask
+            self.count += 1
+    
+    def __contains__(self, num):
+        byte_i = num >> 3
+        
+        return byte_i < len(self._data) and bool(self._data[byte_i] & (1 << (num & 7)))
+
+def load_journal(path):
+    # returns ``RowBitmap`` of finished rows. a broken last line (after
+    # crash) is ignored
+    
+    bitmap = RowBitmap()
+    
+    if path is None or not os.path.exists(path):
+        return bitmap
+    
+    with open(path, 'rb') as fd:
+        for line in fd:
+            if not line.endswith(b'\n'):
+                break
+            
+            try:
+                row_i = int(line)
+            except ValueError:
+                continue
+            
+            if row_i >= 0:
+                bitmap.add(row_i)
+    
+    return bitmap
+
+def journal_line(row_i):
+    return str(row_i)
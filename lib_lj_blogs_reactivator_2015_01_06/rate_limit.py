@@ -0,0 +1,151 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import time
+from . import phase_stats
+from . import live_metrics
+
+# operations which are limited
+OPERATION_NAMES = ('http', 'imap_login', 'imap_poll')
+
+class TokenBucket:
+    # ``rate`` tokens per second, no more than ``burst`` tokens are saved.
+    # a token is taken at once, even if bucket is empty: count of tokens goes
+    # below zero and the caller waits until its token is refilled. so
+    # waiting callers are served in order
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._time = time.monotonic()
+    
+    def reserve(self):
+        # returns delay before the caller may go on. this function is
+        # thread-safe
+        
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                    self._tokens + (now - self._time) * self.rate,
+                    float(self.burst),
+                    )
+            self._time = now
+            self._tokens -= 1.0
+            
+            if self._tokens >= 0.0:
+                return 0.0
+            
+            return -self._tokens / self.rate
+
+class RateLimiter:
+    # ``TokenBucket`` for every (host, operation). ``rate_map`` is
+    # operation -> (rate, burst). operations which are not in ``rate_map``
+    # are not limited
+    
+    def __init__(self, rate_map=None, stats=None, metrics=None):
+        if rate_map is None:
+            rate_map = {}
+        
+        if stats is None:
+            stats = phase_stats.DEFAULT_PHASE_STATS
+        
+        if metrics is None:
+            metrics = live_metrics.DEFAULT_LIVE_METRICS
+        
+        self.rate_map = rate_map
+        self._stats = stats
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._bucket_map = {}
+    
+    def _get_bucket(self, host, operation):
+        rate_burst = self.rate_map.get(operation)
+        
+        if rate_burst is None:
+            return
+        
+        key = host, operation
+        
+        with self._lock:
+            bucket = self._bucket_map.get(key)
+            
+            if bucket is None:
+                bucket = self._bucket_map[key] = TokenBucket(*rate_burst)
+            
+            return bucket
+    
+    def reserve(self, host, operation):
+        # returns delay before the operation may be done. this function is
+        # thread-safe
+        
+        bucket = self._get_bucket(host, operation)
+        
+        if bucket is None:
+            return 0.0
+        
+        delay = bucket.reserve()
+        
+        self._stats.record('rate_wait.{}'.format(operation), delay)
+        
+        if delay:
+            self._metrics.add('rate_limit_waits_total', host=host, operation=operation)
+            self._metrics.add(
+                    'rate_limit_wait_seconds_total',
+                    delay,
+                    host=host,
+                    operation=operation,
+                    )
+        
+        return delay
+    
+    def wait(self, host, operation):
+        # this function is thread-safe
+        
+        delay = self.reserve(host, operation)
+        
+        if delay:
+            time.sleep(delay)
+
+def parse_rate(value):
+    # parses ``OPERATION=RATE[/BURST]``. returns (operation, (rate, burst)).
+    # burst is one second of rate by default
+    
+    operation, sep, rate_str = value.partition('=')
+    
+    if not sep or operation not in OPERATION_NAMES:
+        raise ValueError('unknown operation: {!r}'.format(operation))
+    
+    rate_str, sep, burst_str = rate_str.partition('/')
+    rate = float(rate_str)
+    burst = float(burst_str) if sep else max(rate, 1.0)
+    
+    if rate <= 0.0 or burst < 1.0:
+        raise ValueError('invalid rate or burst: {!r}'.format(value))
+    
+    return operation, (rate, burst)
+
+DEFAULT_RATE_LIMITER = RateLimiter()
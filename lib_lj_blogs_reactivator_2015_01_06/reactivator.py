@@ -23,6 +23,7 @@
 assert str is not bytes
 
 import time
+import datetime
 import re
 from urllib import parse as url_parse
 from urllib import request as url_request
@@ -30,6 +31,16 @@ from http import cookiejar
 import socket
 import imaplib
 from email import parser as email_parser
+from . import mail_watch
+from . import imap_pool
+from . import http_pool
+from . import resp_stream
+from . import net_cache
+from . import rate_limit
+from . import imap_parse
+from . import uid_watermark
+from . import phase_stats
+from . import live_metrics
 
 try:
     from lib_socks_proxy_2013_10_03 import socks_proxy_context
@@ -42,6 +53,27 @@ LJ_HTTP_URL = 'http://www.livejournal.com'
 
 REQUEST_TIMEOUT = 60.0
 REQUEST_READ_LIMIT = 10000000
+# response bodies which one job holds in memory at once
+JOB_MEMORY_LIMIT = 1000000
+
+VALIDATION_MAIL_FROM = 'do-not-reply@livejournal.com'
+VALIDATION_MAIL_SUBJECT = 'Validate Email'
+
+MAIL_WAIT_TIMEOUT = 100.0
+MAIL_CHECK_MIN_DELAY = 1.0
+MAIL_CHECK_MAX_DELAY = 10.0
+
+# budget of job (see ``new_lj_reactivator_ctx()``) is divided between phases
+# by weights: a phase gets its share of remaining budget of the job, and the
+# rest is left for next phases and retries
+PHASE_BUDGET_WEIGHT_MAP = {
+        'login_phase': 1.0,
+        'send_valid_phase': 1.0,
+        'mail_phase': 4.0,
+        'confirm_phase': 1.0,
+        }
+# the least timeout of network call when share of phase is over
+BUDGET_MIN_TIMEOUT = 1.0
 
 class LjReactivatorError(Exception):
     pass
@@ -49,6 +81,12 @@ class LjReactivatorError(Exception):
 class EmailError(LjReactivatorError):
     pass
 
+class UnknownEmailServiceError(EmailError):
+    pass
+
+class MailNotReceivedError(EmailError):
+    pass
+
 class AuthLjError(LjReactivatorError):
     pass
 
@@ -58,67 +96,368 @@ class SendValidLjError(LjReactivatorError):
 class ConfirmLjError(LjReactivatorError):
     pass
 
+class BudgetExhaustedError(LjReactivatorError):
+    pass
+
 class LjReactivatorCtx:
     pass
 
+IMAP_CONNECT_TIMEOUT = 15.0
+
 class SafeIMAP4(imaplib.IMAP4):
-    def _create_socket(self):
-        sock = socket.create_connection(
+    def _create_socket(self, timeout=None):
+        # ``timeout`` argument is passed by Python 3.9 and newer
+        
+        if timeout is None:
+            timeout = IMAP_CONNECT_TIMEOUT
+        
+        sock = net_cache.DEFAULT_DNS_CACHE.create_connection(
                 (self.host, self.port),
-                timeout=15.0,
+                timeout=timeout,
                 )
         
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         
         return sock
+    
+    # TLS sessions are resumed by shared cache
+    
+    def starttls(self, ssl_context=None):
+        if ssl_context is None:
+            ssl_context = net_cache.DEFAULT_TLS_CACHE.bind(self.port)
+        
+        return super().starttls(ssl_context=ssl_context)
+    
+    def shutdown(self):
+        net_cache.DEFAULT_TLS_CACHE.save(getattr(self, 'sock', None), self.port)
+        
+        super().shutdown()
+    
+    # counting of traffic
+    
+    rx_byte_count = 0
+    tx_byte_count = 0
+    
+    def read(self, size):
+        data = super().read(size)
+        self.rx_byte_count += len(data)
+        
+        return data
+    
+    def readline(self):
+        line = super().readline()
+        self.rx_byte_count += len(line)
+        
+        return line
+    
+    def send(self, data):
+        self.tx_byte_count += len(data)
+        
+        return super().send(data)
+
+# transport hooks (see ``trace_transport``): ``IMAP_CLASS`` is class of IMAP
+# sessions, ``HTTP_HANDLER_FUNC()`` returns additional ``urllib`` handler for
+# every new opener
+IMAP_CLASS = SafeIMAP4
+HTTP_HANDLER_FUNC = None
 
-def mail_fetch(email, imap_host, email_login, email_pass):
+def build_opener(*handlers):
+    if HTTP_HANDLER_FUNC is not None:
+        handlers += (HTTP_HANDLER_FUNC(),)
+    
+    return url_request.build_opener(*handlers)
+
+class MailService:
+    def __init__(
+            self,
+            imap_host,
+            imap_port=None,
+            imap_starttls=None,
+            web_auth_url=None,
+            web_auth_referer=None,
+            ):
+        if imap_port is None:
+            imap_port = imaplib.IMAP4_PORT
+        
+        if imap_starttls is None:
+            imap_starttls = True
+        
+        self.imap_host = imap_host
+        self.imap_port = imap_port
+        self.imap_starttls = imap_starttls
+        self.web_auth_url = web_auth_url
+        self.web_auth_referer = web_auth_referer
+
+MAIL_RU_SERVICE = MailService(
+        'imap.mail.ru',
+        web_auth_url='https://auth.mail.ru/cgi-bin/auth?from=splash',
+        web_auth_referer='https://auth.mail.ru/',
+        )
+
+# email domain -> mail service
+MAIL_SERVICE_MAP = {
+        'mail.ru': MAIL_RU_SERVICE,
+        'inbox.ru': MAIL_RU_SERVICE,
+        'list.ru': MAIL_RU_SERVICE,
+        'bk.ru': MAIL_RU_SERVICE,
+        }
+
+def imap_error_with_email(email, imap_error):
+    error_str = 'email is {!r}, error is {!r}'.format(
+            email,
+            imap_error,
+            )
+    
+    return imaplib.IMAP4.error(error_str)
+
+def imap_open(mail_service, email_login, email_pass, timeout=None):
+    # returns authenticated IMAP session with selected INBOX. ``timeout`` is
+    # timeout of socket (``None`` is ``IMAP_CONNECT_TIMEOUT``)
+    
+    rate_limit.DEFAULT_RATE_LIMITER.wait(mail_service.imap_host, 'imap_login')
+    imap = IMAP_CLASS(
+            host=mail_service.imap_host,
+            port=mail_service.imap_port,
+            timeout=timeout,
+            )
+    
     try:
-        imap = SafeIMAP4(host=imap_host)
-        imap.starttls()
+        if mail_service.imap_starttls:
+            imap.starttls()
+        
         imap.login(email_login, email_pass)
-        try:
-            imap.select()
-            typ, search_data = imap.search(None, 'UNSEEN')
+        imap.select()
+        
+        typ, uidvalidity_data = imap.response('UIDVALIDITY')
+        typ, uidnext_data = imap.response('UIDNEXT')
+        
+        if uidvalidity_data and uidvalidity_data[0] is not None and \
+                uidnext_data and uidnext_data[0] is not None:
+            imap.uidvalidity = int(uidvalidity_data[0])
+            imap.select_uidnext = int(uidnext_data[0])
+        else:
+            imap.uidvalidity = None
+            imap.select_uidnext = None
+        
+        imap.email_login = email_login
+    except:
+        imap.shutdown()
+        
+        raise
+    
+    return imap
+
+def imap_settimeout(imap, timeout):
+    sock = getattr(imap, 'sock', None)
+    
+    if sock is not None:
+        sock.settimeout(timeout)
+
+def imap_close(imap):
+    try:
+        imap.close()
+        imap.logout()
+    except (imaplib.IMAP4.error, OSError):
+        imap.shutdown()
+
+IMAP_MONTH_NAMES = (
+        'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+        'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+        )
+
+def imap_quote(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+def imap_date(date):
+    return '{:02}-{}-{:04}'.format(
+            date.day,
+            IMAP_MONTH_NAMES[date.month - 1],
+            date.year,
+            )
+
+def imap_check(typ, data, cmd_name):
+    if typ != 'OK':
+        raise imaplib.IMAP4.error('{} command error: {} {!r}'.format(
+                cmd_name, typ, data))
+
+def mail_read_winner(imap, uid):
+    # downloads ``text/plain`` part of message ``uid``. returns its text or
+    # ``None``
+    
+    typ, fetch_data = imap.uid('FETCH', str(uid), '(BODYSTRUCTURE)')
+    imap_check(typ, fetch_data, 'FETCH')
+    
+    text_plain = None
+    
+    for attr_map in imap_parse.parse_fetch_data(fetch_data):
+        if 'BODYSTRUCTURE' in attr_map:
+            text_plain = imap_parse.find_text_plain(attr_map['BODYSTRUCTURE'])
+    
+    if text_plain is None:
+        return
+    
+    section, encoding = text_plain
+    
+    # not ``BODY.PEEK``: the winner is marked as seen
+    
+    typ, fetch_data = imap.uid('FETCH', str(uid), '(BODY[{}])'.format(section))
+    imap_check(typ, fetch_data, 'FETCH')
+    
+    for attr_map in imap_parse.parse_fetch_data(fetch_data):
+        payload = attr_map.get('BODY[]')
+        
+        if not isinstance(payload, bytes):
+            continue
+        
+        payload = imap_parse.decode_transfer(payload, encoding)
+        
+        return payload.decode(errors='replace')
+
+def mail_search(imap, email, uid_cache=None):
+    # finds validation email in selected mailbox of ``imap`` session.
+    # returns its text or ``None``.
+    #
+    # candidates are searched by server, then only their headers are
+    # fetched (by one command), and only ``text/plain`` part of the winners
+    # is downloaded (newest first, until one with confirm url). if
+    # ``uid_cache`` is given, messages which were checked before (by
+    # previous calls) are not searched again
+    
+    since_date = datetime.date.today() - datetime.timedelta(days=1)
+    criteria_list = [
+            'UNSEEN',
+            'FROM', imap_quote(VALIDATION_MAIL_FROM),
+            'SUBJECT', imap_quote(VALIDATION_MAIL_SUBJECT),
+            'SINCE', imap_date(since_date),
+            ]
+    
+    if uid_cache is not None and imap.uidvalidity is not None:
+        cache_key = imap.host, imap.port, imap.email_login
+        checked_uid = uid_cache.get(cache_key, imap.uidvalidity)
+    else:
+        cache_key = None
+        checked_uid = 0
+    
+    if checked_uid:
+        criteria_list[:0] = 'UID', '{}:*'.format(checked_uid + 1)
+    
+    typ, search_data = imap.uid('SEARCH', *criteria_list)
+    imap_check(typ, search_data, 'SEARCH')
+    
+    # ``n:*`` always includes the last message, even if its UID is
+    # less than ``n``
+    
+    uid_list = list(
+            uid for uid in (
+                    search_data[0].split() if search_data and search_data[0] else ()
+                    )
+            if int(uid) > checked_uid)
+    
+    # all messages which existed on SELECT are checked by this search
+    # (with the found candidates)
+    
+    if cache_key is not None:
+        new_checked_uid = max(
+                [imap.select_uidnext - 1] + list(int(uid) for uid in uid_list),
+                )
+    
+    if not uid_list:
+        if cache_key is not None:
+            uid_cache.set(cache_key, imap.uidvalidity, new_checked_uid)
+        
+        return
+    
+    typ, fetch_data = imap.uid(
+            'FETCH',
+            b','.join(uid_list).decode(),
+            '(BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT)])',
+            )
+    imap_check(typ, fetch_data, 'FETCH')
+    
+    header_parser = email_parser.BytesHeaderParser()
+    winner_uid_list = []
+    
+    for attr_map in imap_parse.parse_fetch_data(fetch_data):
+        uid = attr_map.get('UID')
+        header_data = attr_map.get('BODY[]')
+        
+        if uid is None or not isinstance(header_data, bytes):
+            continue
+        
+        msg = header_parser.parsebytes(header_data)
+        
+        msg_from = msg.get_all('from')
+        msg_to = msg.get_all('to')
+        msg_subject = msg.get_all('subject')
+        
+        if not msg_from or tuple(msg_from) != (VALIDATION_MAIL_FROM,) or \
+                not msg_to or tuple(msg_to) != (email,) or \
+                not msg_subject or tuple(msg_subject) != (VALIDATION_MAIL_SUBJECT,):
+            continue
+        
+        winner_uid_list.append(int(uid))
+    
+    msg_text = None
+    
+    for uid in sorted(winner_uid_list, reverse=True):
+        winner_text = mail_read_winner(imap, uid)
+        
+        if find_confirm_url(winner_text) is not None:
+            msg_text = winner_text
             
-            for num in reversed(search_data[0].split()):
-                typ, fetch_data = imap.fetch(num, '(RFC822)')
-                
-                msg_parser = email_parser.BytesFeedParser()
-                msg_parser.feed(fetch_data[0][1])
-                msg = msg_parser.close()
-                
-                msg_from = msg.get_all('from')
-                msg_to = msg.get_all('to')
-                msg_subject = msg.get_all('subject')
-                
-                if not msg_from or tuple(msg_from) != ('do-not-reply@livejournal.com',) or \
-                        not msg_to or tuple(msg_to) != (email,) or \
-                        not msg_subject or tuple(msg_subject) != ('Validate Email',):
-                    continue
-                
-                for msg_part in msg.walk():
-                    if msg_part.get_content_type() == 'text/plain':
-                        payload = msg_part.get_payload(decode=True)
-                        
-                        assert isinstance(payload, bytes)
-                        
-                        msg_text = payload.decode(errors='replace')
-                        
-                        return msg_text
-        finally:
-            imap.close()
-            imap.logout()
+            break
+    
+    # the watermark is moved only after the winners are read: if reading is
+    # aborted, they are searched again by next call
+    
+    if cache_key is not None:
+        uid_cache.set(cache_key, imap.uidvalidity, new_checked_uid)
+    
+    return msg_text
+
+DEFAULT_IMAP_POOL = imap_pool.ImapPool(imap_open, imap_close)
+# ``None`` turns keep-alive of HTTP connections off
+DEFAULT_HTTP_POOL = http_pool.HttpConnPool(read_limit=REQUEST_READ_LIMIT)
+DEFAULT_UID_CACHE = uid_watermark.UidWatermarkCache()
+
+def mail_fetch(
+        email,
+        mail_service,
+        email_login,
+        email_pass,
+        imap_pool=None,
+        uid_cache=None,
+        stats=None,
+        rate_limiter=None,
+        timeout=None,
+        ):
+    if imap_pool is None:
+        imap_pool = DEFAULT_IMAP_POOL
+    
+    if uid_cache is None:
+        uid_cache = DEFAULT_UID_CACHE
+    
+    if stats is None:
+        stats = phase_stats.DEFAULT_PHASE_STATS
+    
+    if rate_limiter is None:
+        rate_limiter = rate_limit.DEFAULT_RATE_LIMITER
+    
+    try:
+        rate_limiter.wait(mail_service.imap_host, 'imap_poll')
+        
+        with stats.timer('mail_poll'), \
+                imap_pool.session(
+                        mail_service,
+                        email_login,
+                        email_pass,
+                        timeout=timeout,
+                        ) as imap:
+            return mail_search(imap, email, uid_cache=uid_cache)
     except imaplib.IMAP4.error as imap_error:
-        error_str = 'email is {!r}, error is {!r}'.format(
-                email,
-                imap_error,
-                )
-        raise imaplib.IMAP4.error(error_str)
+        raise imap_error_with_email(email, imap_error)
 
-def login_phase(lj_reac_ctx):
-    opener = lj_reac_ctx.opener
-    open_func = lj_reac_ctx.open_func
+def new_login_request(lj_reac_ctx):
     ua_name = lj_reac_ctx.ua_name
     username = lj_reac_ctx.lj_username
     password = lj_reac_ctx.lj_pass
@@ -126,81 +465,85 @@ def login_phase(lj_reac_ctx):
     lj_login_url = url_parse.urljoin(LJ_HTTPS_URL, 'login.bml?ret=1')
     lj_update_url = url_parse.urljoin(LJ_HTTP_URL, 'update.bml')
     
-    resp = open_func(
-            opener,
-            url_request.Request(
-                    lj_login_url,
-                    data=url_parse.urlencode({
-                            'user': username,
-                            'remember_me': '1',
-                            'ref': lj_update_url,
-                            'password': password,
-                            'action:login': 'Log in',
-                            }).encode(),
-                    headers={
-                            'User-Agent': ua_name,
-                            'Referer': lj_login_url,
-                            },
-                    ),
-            timeout=REQUEST_TIMEOUT,
+    return url_request.Request(
+            lj_login_url,
+            data=url_parse.urlencode({
+                    'user': username,
+                    'remember_me': '1',
+                    'ref': lj_update_url,
+                    'password': password,
+                    'action:login': 'Log in',
+                    }).encode(),
+            headers={
+                    'User-Agent': ua_name,
+                    'Referer': lj_login_url,
+                    },
             )
+
+def check_login_resp(lj_reac_ctx, resp):
+    lj_update_url = url_parse.urljoin(LJ_HTTP_URL, 'update.bml')
     
     if resp.getcode() != 200 or resp.geturl() != lj_update_url:
         raise AuthLjError('lj auth error')
 
-def send_valid_phase(lj_reac_ctx):
-    opener = lj_reac_ctx.opener
-    open_func = lj_reac_ctx.open_func
+def new_send_valid_request(lj_reac_ctx):
     ua_name = lj_reac_ctx.ua_name
     username = lj_reac_ctx.lj_username
     
     lj_update_url = url_parse.urljoin(LJ_HTTP_URL, 'update.bml')
     lj_register_url = url_parse.urljoin(LJ_HTTP_URL, 'register.bml')
     
-    resp = open_func(
-            opener,
-            url_request.Request(
-                    lj_register_url,
-                    data=url_parse.urlencode({
-                            'authas': username,
-                            'action:send': 'Send Validation Email',
-                            }).encode(),
-                    headers={
-                            'User-Agent': ua_name,
-                            'Referer': lj_update_url,
-                            },
-                    ),
-            timeout=REQUEST_TIMEOUT,
+    return url_request.Request(
+            lj_register_url,
+            data=url_parse.urlencode({
+                    'authas': username,
+                    'action:send': 'Send Validation Email',
+                    }).encode(),
+            headers={
+                    'User-Agent': ua_name,
+                    'Referer': lj_update_url,
+                    },
             )
+
+def check_send_valid_resp(lj_reac_ctx, resp):
+    lj_register_url = url_parse.urljoin(LJ_HTTP_URL, 'register.bml')
     
     if resp.getcode() != 200 or resp.geturl() != lj_register_url:
         raise SendValidLjError('lj send validation error')
 
-def mail_phase(lj_reac_ctx):
+def mail_prepare(lj_reac_ctx):
+    # resolves mail service of email and passes web-ui authorization (if
+    # it is needed). results are saved to ``lj_reac_ctx``
+    
     ua_name = lj_reac_ctx.ua_name
     email = lj_reac_ctx.email
     email_pass = lj_reac_ctx.email_pass
     
-    mail_ru_imap_host = 'imap.mail.ru'
+    email_splt_left, email_splt_right = email.rsplit('@', 1) \
+            if '@' in email else (email, '')
+    mail_service = MAIL_SERVICE_MAP.get(email_splt_right)
     
-    if email.endswith('@mail.ru') or \
-            email.endswith('@inbox.ru') or \
-            email.endswith('@list.ru') or \
-            email.endswith('@bk.ru'):
-        email_login = email
-        imap_host = mail_ru_imap_host
-    else:
-        raise EmailError('unknown email service')
+    if mail_service is None:
+        raise UnknownEmailServiceError('unknown email service')
     
-    if imap_host == mail_ru_imap_host:
-        mail_web_url = 'https://auth.mail.ru/cgi-bin/auth?from=splash'
-        mail_web_url_referer = 'https://auth.mail.ru/'
-        
-        email_splt_left, email_splt_right = email.rsplit('@', 1)
+    email_login = email
+    
+    if mail_service.web_auth_url is not None:
+        mail_web_url = mail_service.web_auth_url
+        mail_web_url_referer = mail_service.web_auth_referer
         
         mail_cookies = cookiejar.CookieJar()
-        mail_opener = url_request.build_opener(
+        mail_handler_list = [
                 url_request.HTTPCookieProcessor(cookiejar=mail_cookies),
+                ]
+        
+        if DEFAULT_HTTP_POOL is not None:
+            mail_handler_list.append(http_pool.KeepAliveHandler(DEFAULT_HTTP_POOL))
+        
+        mail_opener = build_opener(*mail_handler_list)
+        lj_reac_ctx.rate_limiter.wait(
+                url_parse.urlsplit(mail_web_url).hostname,
+                'http',
                 )
         
         resp = mail_opener.open(
@@ -217,73 +560,216 @@ def mail_phase(lj_reac_ctx):
                                 'Referer': mail_web_url_referer,
                                 },
                         ),
-                timeout=REQUEST_TIMEOUT,
+                timeout=budget_timeout(lj_reac_ctx, REQUEST_TIMEOUT),
+                )
+        resp_stream.drain(
+                resp,
+                REQUEST_READ_LIMIT,
+                ceiling=lj_reac_ctx.mem_ceiling,
                 )
         
         if resp.getcode() != 200 or resp.geturl() != mail_web_url:
             raise EmailError('mail web ui error')
     
-    for att_i in range(10):
-        time.sleep(10)
-        
-        mail_text = mail_fetch(email, imap_host, email_login, email_pass)
-        
-        if mail_text is None:
-            continue
-        
-        assert isinstance(mail_text, str)
-        
-        confirm_url_prefix = 'http://www.livejournal.com/confirm/'
-        confirm_url_match = re.search(
-                r'\s(?P<confirm_url>' + re.escape(confirm_url_prefix) + r'\S+)\s',
-                mail_text,
-                flags=re.S,
-                )
-        
-        if confirm_url_match is None:
-            continue
-        
-        confirm_url = confirm_url_match.group('confirm_url')
-        
-        break
-    else:
-        raise EmailError(
-                'confirm_url not received',
-                )
+    lj_reac_ctx.mail_service = mail_service
+    lj_reac_ctx.email_login = email_login
+    lj_reac_ctx.imap_host = mail_service.imap_host
+
+def find_confirm_url(mail_text):
+    if mail_text is None:
+        return
     
-    lj_reac_ctx.confirm_url = confirm_url
+    assert isinstance(mail_text, str)
+    
+    confirm_url_prefix = url_parse.urljoin(LJ_HTTP_URL, 'confirm/')
+    confirm_url_match = re.search(
+            r'\s(?P<confirm_url>' + re.escape(confirm_url_prefix) + r'\S+)\s',
+            mail_text,
+            flags=re.S,
+            )
+    
+    if confirm_url_match is None:
+        return
+    
+    return confirm_url_match.group('confirm_url')
 
-def confirm_phase(lj_reac_ctx):
-    opener = lj_reac_ctx.opener
-    open_func = lj_reac_ctx.open_func
+def new_confirm_request(lj_reac_ctx):
     ua_name = lj_reac_ctx.ua_name
     confirm_url = lj_reac_ctx.confirm_url
     
-    lj_register_url = url_parse.urljoin(LJ_HTTP_URL, 'register.bml')
-    
-    resp = open_func(
-            opener,
-            url_request.Request(
-                    confirm_url,
-                    headers={
-                            'User-Agent': ua_name,
-                            },
-                    ),
-            timeout=REQUEST_TIMEOUT,
+    return url_request.Request(
+            confirm_url,
+            headers={
+                    'User-Agent': ua_name,
+                    },
             )
+
+def check_confirm_resp(lj_reac_ctx, resp):
+    lj_register_url = url_parse.urljoin(LJ_HTTP_URL, 'register.bml')
     
     if resp.getcode() != 200 or \
             not resp.geturl().startswith('{}?'.format(lj_register_url)):
         raise ConfirmLjError('lj confirm error')
 
-def blocking_lj_reactivator(
+def begin_phase_budget(lj_reac_ctx, phase_name_list):
+    # sets deadline of phase which begins now. ``phase_name_list``: names of
+    # the phase and of next phases
+    
+    if lj_reac_ctx.deadline is None:
+        return
+    
+    now = time.monotonic()
+    weight_list = list(
+            PHASE_BUDGET_WEIGHT_MAP.get(phase_name, 1.0)
+            for phase_name in phase_name_list)
+    lj_reac_ctx.phase_deadline = now + max(0.0, lj_reac_ctx.deadline - now) * \
+            weight_list[0] / sum(weight_list)
+
+def budget_exhausted(lj_reac_ctx, delay=None):
+    # returns ``True`` if budget of job is over (or will be over after
+    # ``delay`` seconds)
+    
+    if lj_reac_ctx.deadline is None:
+        return False
+    
+    return time.monotonic() + (delay or 0.0) >= lj_reac_ctx.deadline
+
+def budget_deadline(lj_reac_ctx, deadline):
+    # returns ``deadline`` (monotonic time) limited by budget of phase
+    
+    if lj_reac_ctx.phase_deadline is None:
+        return deadline
+    
+    return min(deadline, lj_reac_ctx.phase_deadline)
+
+def budget_timeout(lj_reac_ctx, timeout):
+    # returns timeout of network call: ``timeout`` limited by remaining
+    # budget of phase. share of phase is not strict (the call gets at least
+    # ``BUDGET_MIN_TIMEOUT``), but budget of job is
+    
+    if lj_reac_ctx.phase_deadline is None:
+        return timeout
+    
+    now = time.monotonic()
+    job_remaining = lj_reac_ctx.deadline - now
+    
+    if job_remaining <= 0.0:
+        raise BudgetExhaustedError('job budget is exhausted')
+    
+    return min(
+            timeout,
+            job_remaining,
+            max(lj_reac_ctx.phase_deadline - now, BUDGET_MIN_TIMEOUT),
+            )
+
+def open_drained(lj_reac_ctx, request):
+    # opens ``request`` and consumes body of response by chunks, so
+    # kept-alive connection goes back to pool at once. returns closed
+    # response, which still gives its code and url
+    
+    lj_reac_ctx.rate_limiter.wait(
+            url_parse.urlsplit(request.full_url).hostname,
+            'http',
+            )
+    resp = lj_reac_ctx.open_func(
+            lj_reac_ctx.opener,
+            request,
+            timeout=budget_timeout(lj_reac_ctx, REQUEST_TIMEOUT),
+            )
+    resp_stream.drain(resp, REQUEST_READ_LIMIT, ceiling=lj_reac_ctx.mem_ceiling)
+    
+    return resp
+
+def login_phase(lj_reac_ctx):
+    resp = open_drained(lj_reac_ctx, new_login_request(lj_reac_ctx))
+    
+    check_login_resp(lj_reac_ctx, resp)
+
+def send_valid_phase(lj_reac_ctx):
+    resp = open_drained(lj_reac_ctx, new_send_valid_request(lj_reac_ctx))
+    
+    check_send_valid_resp(lj_reac_ctx, resp)
+
+def mail_phase(lj_reac_ctx):
+    mail_prepare(lj_reac_ctx)
+    
+    email = lj_reac_ctx.email
+    deadline = budget_deadline(lj_reac_ctx, time.monotonic() + MAIL_WAIT_TIMEOUT)
+    
+    try:
+        with lj_reac_ctx.imap_pool.session(
+                lj_reac_ctx.mail_service,
+                lj_reac_ctx.email_login,
+                lj_reac_ctx.email_pass,
+                timeout=budget_timeout(lj_reac_ctx, IMAP_CONNECT_TIMEOUT),
+                ) as imap:
+            rx_byte_count = imap.rx_byte_count
+            tx_byte_count = imap.tx_byte_count
+            
+            try:
+                watcher = mail_watch.MailWatcher(
+                        imap,
+                        min_delay=MAIL_CHECK_MIN_DELAY,
+                        max_delay=MAIL_CHECK_MAX_DELAY,
+                        )
+                changed = True
+                
+                while True:
+                    if changed:
+                        lj_reac_ctx.rate_limiter.wait(
+                                lj_reac_ctx.imap_host,
+                                'imap_poll',
+                                )
+                        
+                        imap_settimeout(
+                                imap,
+                                budget_timeout(lj_reac_ctx, IMAP_CONNECT_TIMEOUT),
+                                )
+                        
+                        with lj_reac_ctx.stats.timer('mail_poll'):
+                            confirm_url = find_confirm_url(mail_search(
+                                    imap,
+                                    email,
+                                    uid_cache=lj_reac_ctx.uid_cache,
+                                    ))
+                        
+                        if confirm_url is not None:
+                            break
+                    
+                    remaining = deadline - time.monotonic()
+                    
+                    if remaining <= 0.0:
+                        raise MailNotReceivedError(
+                                'confirm_url not received',
+                                )
+                    
+                    changed = watcher.wait(remaining)
+            finally:
+                lj_reac_ctx.imap_rx_byte_count += imap.rx_byte_count - rx_byte_count
+                lj_reac_ctx.imap_tx_byte_count += imap.tx_byte_count - tx_byte_count
+    except imaplib.IMAP4.error as imap_error:
+        raise imap_error_with_email(email, imap_error)
+    
+    lj_reac_ctx.confirm_url = confirm_url
+
+def confirm_phase(lj_reac_ctx):
+    resp = open_drained(lj_reac_ctx, new_confirm_request(lj_reac_ctx))
+    
+    check_confirm_resp(lj_reac_ctx, resp)
+
+def new_lj_reactivator_ctx(
         email=None,
         email_pass=None,
         lj_username=None,
         lj_pass=None,
         ua_name=None,
         proxy_address=None,
+        budget=None,
         ):
+    # ``budget``: seconds which the job (all phases with retries) may take
+    # from now (``None`` is without budget: every network call has its own
+    # timeout then)
+    
     assert email is not None
     assert email_pass is not None
     assert lj_username is not None
@@ -307,9 +793,19 @@ def blocking_lj_reactivator(
             return opener.open(*args, **kwargs)
     
     cookies = cookiejar.CookieJar()
-    opener = url_request.build_opener(
+    handler_list = [
             url_request.HTTPCookieProcessor(cookiejar=cookies),
-            )
+            ]
+    
+    if DEFAULT_HTTP_POOL is not None:
+        # connections to LJ are kept alive between phases and jobs
+        
+        handler_list.append(http_pool.KeepAliveHandler(
+                DEFAULT_HTTP_POOL,
+                proxy_key=tuple(proxy_address) if proxy_address is not None else None,
+                ))
+    
+    opener = build_opener(*handler_list)
     
     lj_reac_ctx = LjReactivatorCtx()
     lj_reac_ctx.email = email
@@ -320,8 +816,39 @@ def blocking_lj_reactivator(
     lj_reac_ctx.proxy_address = proxy_address
     lj_reac_ctx.open_func = open_func
     lj_reac_ctx.opener = opener
+    lj_reac_ctx.confirm_url = None
+    lj_reac_ctx.imap_pool = DEFAULT_IMAP_POOL
+    lj_reac_ctx.http_pool = DEFAULT_HTTP_POOL
+    lj_reac_ctx.uid_cache = DEFAULT_UID_CACHE
+    lj_reac_ctx.mem_ceiling = resp_stream.MemoryCeiling(JOB_MEMORY_LIMIT)
+    lj_reac_ctx.stats = phase_stats.DEFAULT_PHASE_STATS
+    lj_reac_ctx.metrics = live_metrics.DEFAULT_LIVE_METRICS
+    lj_reac_ctx.rate_limiter = rate_limit.DEFAULT_RATE_LIMITER
+    lj_reac_ctx.imap_rx_byte_count = 0
+    lj_reac_ctx.imap_tx_byte_count = 0
+    lj_reac_ctx.deadline = time.monotonic() + budget if budget is not None else None
+    lj_reac_ctx.phase_deadline = None
+    # deadline of waiting for validation mail (see ``staged_reactivator``)
+    lj_reac_ctx.mail_deadline = None
     
-    login_phase(lj_reac_ctx)
-    send_valid_phase(lj_reac_ctx)
-    confirm_url = mail_phase(lj_reac_ctx)
-    confirm_phase(lj_reac_ctx)
+    return lj_reac_ctx
+
+def phase_host(lj_reac_ctx, phase_name):
+    # returns host which phase works with (or ``None`` if it is unknown)
+    
+    if phase_name == 'mail_phase':
+        email = lj_reac_ctx.email
+        mail_service = MAIL_SERVICE_MAP.get(
+                email.rsplit('@', 1)[1] if '@' in email else '',
+                )
+        
+        return mail_service.imap_host if mail_service is not None else None
+    
+    return url_parse.urlsplit(LJ_HTTP_URL).hostname
+
+PHASE_LIST = (
+        login_phase,
+        send_valid_phase,
+        mail_phase,
+        confirm_phase,
+        )
@@ -0,0 +1,156 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import contextlib
+
+CHUNK_SIZE = 65536
+
+class BodyLimitError(ValueError):
+    pass
+
+class MemoryCeiling:
+    # counts bytes of response bodies which one job holds in memory at once.
+    # object belongs to one job, so it is not thread-safe
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+    
+    def reserve(self, size):
+        if self.used + size > self.limit:
+            raise BodyLimitError(
+                    'memory ceiling of job is exceeded: {} + {} > {} bytes'.format(
+                            self.used, size, self.limit,
+                            ),
+                    )
+        
+        self.used += size
+        self.peak = max(self.peak, self.used)
+    
+    def release(self, size):
+        self.used -= size
+    
+    @contextlib.contextmanager
+    def hold(self, size):
+        self.reserve(size)
+        
+        try:
+            yield
+        finally:
+            self.release(size)
+
+def iter_chunks(resp, read_limit, chunk_size=None, ceiling=None):
+    # yields body of ``resp`` by chunks until end of body or until
+    # ``read_limit`` bytes are read. the yielded chunk is counted by
+    # ``ceiling`` until the next one is requested
+    
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    
+    remaining = read_limit
+    
+    while remaining > 0:
+        read_size = min(chunk_size, remaining)
+        
+        if ceiling is not None:
+            # chunks become smaller when the job is close to its ceiling
+            
+            read_size = min(read_size, max(ceiling.limit - ceiling.used, 1))
+        
+        chunk = resp.read(read_size)
+        
+        if not chunk:
+            return
+        
+        remaining -= len(chunk)
+        
+        if ceiling is None:
+            yield chunk
+            
+            continue
+        
+        with ceiling.hold(len(chunk)):
+            yield chunk
+
+def drain(resp, read_limit, ceiling=None):
+    # reads and throws away body of ``resp`` (so its connection can be
+    # reused), then closes it. returns count of read bytes
+    
+    byte_count = 0
+    
+    try:
+        for chunk in iter_chunks(resp, read_limit, ceiling=ceiling):
+            byte_count += len(chunk)
+    finally:
+        resp.close()
+    
+    return byte_count
+
+def find_between(resp, start_marker, stop_marker, read_limit, ceiling=None):
+    # finds bytes between ``start_marker`` and ``stop_marker`` in body of
+    # ``resp`` without keeping whole body. only the tail (which may hold
+    # beginning of a marker) and the found part are kept. returns ``None``
+    # if markers are not found in the first ``read_limit`` bytes
+    
+    assert isinstance(start_marker, bytes)
+    assert isinstance(stop_marker, bytes)
+    
+    tail = b''
+    found = None
+    
+    try:
+        for chunk in iter_chunks(resp, read_limit, ceiling=ceiling):
+            if found is None:
+                data = tail + chunk
+                start_pos = data.find(start_marker)
+                
+                if start_pos == -1:
+                    tail = data[-(len(start_marker) - 1):] \
+                            if len(start_marker) > 1 else b''
+                    
+                    continue
+                
+                found = bytearray()
+                data = data[start_pos + len(start_marker):]
+            else:
+                data = chunk
+            
+            # stop marker may begin in the already found part
+            
+            search_pos = max(len(found) - len(stop_marker) + 1, 0)
+            
+            if ceiling is not None:
+                ceiling.reserve(len(data))
+            
+            found += data
+            stop_pos = found.find(stop_marker, search_pos)
+            
+            if stop_pos != -1:
+                return bytes(found[:stop_pos])
+    finally:
+        if found is not None and ceiling is not None:
+            ceiling.release(len(found))
+        
+        resp.close()
@@ -0,0 +1,377 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import argparse
+import threading
+import queue
+import time
+import atexit
+import json
+import csv
+import sqlite3
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_DELAY = 1.0
+BUSY_TIMEOUT = 60.0
+
+# results database: one row per finished job of every run. it is written by
+# single writer thread with batched transactions (a transaction per
+# ``batch_size`` results or per ``flush_delay`` seconds), and is queried
+# later by ``export`` command (see ``main()``)
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS run (
+    run_id INTEGER PRIMARY KEY,
+    begin_time REAL NOT NULL,
+    in_path TEXT
+);
+CREATE TABLE IF NOT EXISTS result (
+    result_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL,
+    row_i INTEGER NOT NULL,
+    account_key TEXT NOT NULL,
+    email TEXT NOT NULL,
+    email_pass TEXT NOT NULL,
+    lj_username TEXT NOT NULL,
+    lj_pass TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error_phase TEXT,
+    error_class TEXT,
+    error TEXT,
+    attempt_count INTEGER NOT NULL,
+    job_time REAL,
+    phase_times TEXT,
+    done_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_status ON result (status);
+CREATE INDEX IF NOT EXISTS result_error_class ON result (error_class);
+CREATE INDEX IF NOT EXISTS result_account_key ON result (account_key);
+CREATE INDEX IF NOT EXISTS result_run_id ON result (run_id);
+'''
+
+RESULT_COLUMN_LIST = (
+        'run_id',
+        'row_i',
+        'account_key',
+        'email',
+        'email_pass',
+        'lj_username',
+        'lj_pass',
+        'status',
+        'error_phase',
+        'error_class',
+        'error',
+        'attempt_count',
+        'job_time',
+        'phase_times',
+        'done_time',
+        )
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA_SQL)
+    
+    return conn
+
+def new_run(path, in_path):
+    # returns id of new run
+    
+    conn = connect(path)
+    
+    try:
+        with conn:
+            cur = conn.execute(
+                    'INSERT INTO run (begin_time, in_path) VALUES (?, ?)',
+                    (time.time(), in_path),
+                    )
+        
+        return cur.lastrowid
+    finally:
+        conn.close()
+
+class ResultStore:
+    def __init__(self, path, run_id, batch_size=None, flush_delay=None):
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        
+        if flush_delay is None:
+            flush_delay = DEFAULT_FLUSH_DELAY
+        
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_delay = flush_delay
+        self._queue = queue.SimpleQueue()
+        self._writer_thread = None
+        self.run_id = run_id
+        self.writer_error = None
+        self.record_count = 0
+        self.batch_count = 0
+    
+    def record(
+            self,
+            row_i,
+            account_key,
+            row,
+            status,
+            error_phase=None,
+            error_class=None,
+            error=None,
+            attempt_count=None,
+            job_time=None,
+            phase_time_map=None,
+            ):
+        # this function is thread-safe. the result is only put into queue of
+        # the writer
+        
+        self._queue.put((
+                self.run_id,
+                row_i,
+                account_key,
+                ) + tuple(row) + (
+                status,
+                error_phase,
+                error_class,
+                error,
+                attempt_count if attempt_count is not None else 0,
+                job_time,
+                json.dumps(phase_time_map) if phase_time_map is not None else None,
+                time.time(),
+                ))
+    
+    def _write_batch(self, conn, batch):
+        with conn:
+            conn.executemany(
+                    'INSERT INTO result ({}) VALUES ({})'.format(
+                            ', '.join(RESULT_COLUMN_LIST),
+                            ', '.join('?' for column in RESULT_COLUMN_LIST),
+                            ),
+                    batch,
+                    )
+        
+        self.record_count += len(batch)
+        self.batch_count += 1
+    
+    def _writer_func(self):
+        conn = connect(self._path)
+        batch = []
+        flush_time = None
+        stopping = False
+        
+        try:
+            while not stopping:
+                try:
+                    if flush_time is None:
+                        item = self._queue.get()
+                    else:
+                        item = self._queue.get(
+                                timeout=max(flush_time - time.monotonic(), 0.0),
+                                )
+                except queue.Empty:
+                    pass
+                else:
+                    if item is None:
+                        stopping = True
+                    else:
+                        batch.append(item)
+                        
+                        if flush_time is None:
+                            flush_time = time.monotonic() + self._flush_delay
+                        
+                        if len(batch) < self._batch_size and \
+                                time.monotonic() < flush_time:
+                            continue
+                
+                if batch and self.writer_error is None:
+                    try:
+                        self._write_batch(conn, batch)
+                    except Exception as e:
+                        self.writer_error = e
+                
+                batch = []
+                flush_time = None
+        finally:
+            conn.close()
+    
+    def start(self):
+        self._writer_thread = threading.Thread(
+                target=self._writer_func,
+                daemon=True,
+                )
+        self._writer_thread.start()
+        
+        # main thread may be finished by exception: gathered results should
+        # be written anyway (see ``out_mgr.OutMgr.start_writer()``)
+        
+        atexit.register(self.close)
+    
+    def close(self):
+        # writes all gathered results. error of writing (if any) is raised
+        # here
+        
+        if self._writer_thread is None:
+            return
+        
+        self._queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        atexit.unregister(self.close)
+        
+        if self.writer_error is not None:
+            raise self.writer_error
+
+def export_rows(
+        conn,
+        run_count=None,
+        latest=None,
+        status=None,
+        error_phase=None,
+        error_class=None,
+        ):
+    # yields (email, email_pass, lj_username, lj_pass) of accounts which
+    # results match filters (one row per account: the latest matching
+    # result). ``run_count``: only results of last runs. ``latest``: only
+    # the latest result of every account is matched
+    
+    if run_count is not None:
+        run_where = 'run_id IN (SELECT run_id FROM run ORDER BY run_id DESC ' \
+                'LIMIT ?)'
+        where_list = [run_where]
+        param_list = [run_count]
+    else:
+        run_where = None
+        where_list = []
+        param_list = []
+    
+    if latest:
+        where_list.append('result_id IN (SELECT MAX(result_id) FROM result '
+                '{}GROUP BY account_key)'.format(
+                        'WHERE {} '.format(run_where) if run_where is not None else '',
+                        ))
+        
+        if run_where is not None:
+            param_list.append(run_count)
+    
+    for column, value in (
+            ('status', status),
+            ('error_phase', error_phase),
+            ('error_class', error_class),
+            ):
+        if value is not None:
+            where_list.append('{} = ?'.format(column))
+            param_list.append(value)
+    
+    # SQLite takes bare columns from the row of ``MAX()``
+    
+    cur = conn.execute(
+            'SELECT MAX(result_id), email, email_pass, lj_username, lj_pass '
+            'FROM result {}GROUP BY account_key ORDER BY 1'.format(
+                    'WHERE {} '.format(' AND '.join(where_list))
+                            if where_list else '',
+                    ),
+            param_list,
+            )
+    
+    for result in cur:
+        yield result[1:]
+
+def export_cmd(args):
+    conn = connect(args.db_path)
+    
+    try:
+        with open(args.out_path, 'w', encoding='utf-8', newline='') as fd:
+            csv_writer = csv.writer(fd)
+            row_count = 0
+            
+            for row in export_rows(
+                    conn,
+                    run_count=args.last_runs,
+                    latest=args.latest,
+                    status=args.status,
+                    error_phase=args.error_phase,
+                    error_class=args.error_class,
+                    ):
+                csv_writer.writerow(row)
+                row_count += 1
+    finally:
+        conn.close()
+    
+    print('exported {} rows'.format(row_count))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='queries of results database of lj-blogs-reactivator',
+            )
+    
+    subparsers = parser.add_subparsers(metavar='COMMAND')
+    subparsers.required = True
+    
+    export_parser = subparsers.add_parser(
+            'export',
+            help='export accounts which results match filters to in '
+                    'csv-file (4 columns) for next run',
+            )
+    export_parser.set_defaults(cmd_func=export_cmd)
+    export_parser.add_argument(
+            '--status',
+            choices=('good', 'bad'),
+            help='final status of job',
+            )
+    export_parser.add_argument(
+            '--error-phase',
+            metavar='PHASE-NAME',
+            help='phase which job is failed in (for example: '
+                    'send_valid_phase)',
+            )
+    export_parser.add_argument(
+            '--error-class',
+            metavar='CLASS-NAME',
+            help='class of final error (for example: MailNotReceivedError)',
+            )
+    export_parser.add_argument(
+            '--last-runs',
+            metavar='RUN-COUNT',
+            type=int,
+            help='only results of RUN-COUNT last runs',
+            )
+    export_parser.add_argument(
+            '--latest',
+            action='store_true',
+            help='match only the latest result of every account (accounts '
+                    'which are fixed by later runs are not exported)',
+            )
+    export_parser.add_argument(
+            'db_path',
+            metavar='RESULTS-DB-PATH',
+            help='path to results database',
+            )
+    export_parser.add_argument(
+            'out_path',
+            metavar='OUT-PATH',
+            help='path to csv-file',
+            )
+    
+    args = parser.parse_args()
+    
+    args.cmd_func(args)
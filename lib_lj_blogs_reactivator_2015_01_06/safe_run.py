@@ -24,8 +24,8 @@ assert str is not bytes
 
 import threading
 import traceback
-import time
 
+# delay before next try of failed phase (see ``phase_retry.RETRY_POLICY_MAP``)
 THREE_SAFE_RUN_DELAY = 10.0
 
 def safe_run(unsafe_func, *args, **kwargs):
@@ -49,13 +49,27 @@ def safe_run(unsafe_func, *args, **kwargs):
     
     return safe_run_ctx['result'], safe_run_ctx['error']
 
-def three_safe_run(unsafe_func, *args, **kwargs):
-    for try_i in range(3):
-        result, error = safe_run(unsafe_func, *args, **kwargs)
-        
-        if error is None:
-            return result, error
-        
-        time.sleep(THREE_SAFE_RUN_DELAY)
+def in_thread_safe_run(unsafe_func, *args, **kwargs):
+    # the same as ``safe_run()``, but without creating of separate thread.
+    # it is enough for worker threads (they do not receive signals), and it
+    # avoids thread creating and joining on every call
     
-    return result, error
+    try:
+        result = unsafe_func(*args, **kwargs)
+    except Exception as err:
+        return None, (type(err), str(err), traceback.format_exc())
+    
+    return result, None
+
+SAFE_RUN_FUNC_MAP = {
+        'thread': safe_run,
+        'in-thread': in_thread_safe_run,
+        }
+
+async def async_safe_run(unsafe_coro_func, *args, **kwargs):
+    try:
+        result = await unsafe_coro_func(*args, **kwargs)
+    except Exception as err:
+        return None, (type(err), str(err), traceback.format_exc())
+    
+    return result, None
@@ -0,0 +1,156 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os
+import sys
+import threading
+import multiprocessing
+from . import out_mgr
+from . import dedup
+
+PROGRESS_INTERVAL = 10.0
+# records of these out files get prefix of shard (task numbers of shards
+# are repeated)
+SHARD_PREFIX_EXT_SET = frozenset(('out.log', 'err.log', 'err-tb.log'))
+
+class ShardError(Exception):
+    pass
+
+class Shard:
+    pass
+
+class ShardProgress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.good_count = 0
+        self.bad_count = 0
+
+def shard_of(email, shard_count):
+    # rows of one mailbox go to one shard, so ``dedup.MailboxLockMap`` of
+    # the shard keeps mailbox for one job
+    
+    return dedup.key_hash(dedup.mailbox_key(email)) % shard_count
+
+def _child_func(child_main_func, shard):
+    # lines of child go to terminal through parent
+    
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, sys.stdout.fileno())
+    os.close(devnull_fd)
+    
+    child_main_func(shard)
+
+def _reader_func(shard_i, read_fd, out, progress, print_func):
+    with os.fdopen(read_fd, 'rb') as fd:
+        for ext, text in out_mgr.read_forwarded(fd):
+            if ext in SHARD_PREFIX_EXT_SET:
+                text = '[shard_{}] {}'.format(shard_i, text)
+            
+            with progress.lock:
+                if ext == 'good.csv':
+                    progress.good_count += 1
+                elif ext == 'bad.csv':
+                    progress.bad_count += 1
+                
+                out.write(text, ext=ext, end='')
+                
+                if ext == 'out.log':
+                    print_func(text.rstrip('\n'))
+
+def start_processes(process_count, child_main_func, journal_path):
+    # runs ``child_main_func(shard)`` in ``process_count`` forked processes.
+    # every child takes its shard of in rows (see ``shard_of()``), and
+    # forwards its records to ``shard.fd`` instead of out files. the
+    # processes are forked before parent starts its threads
+    
+    mp_ctx = multiprocessing.get_context('fork')
+    shard_list = []
+    
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    for shard_i in range(process_count):
+        read_fd, write_fd = os.pipe()
+        
+        shard = Shard()
+        shard.index = shard_i
+        shard.count = process_count
+        shard.fd = write_fd
+        shard.journal_path = journal_path
+        shard.proc = mp_ctx.Process(
+                target=_child_func,
+                args=(child_main_func, shard),
+                )
+        shard.proc.start()
+        shard.read_fd = read_fd
+        os.close(write_fd)
+        
+        shard_list.append(shard)
+    
+    return shard_list
+
+def merge_processes(shard_list, out, print_func):
+    # writes records of children by ``out`` of parent (whole records, so
+    # lines of children are not mixed) and reports progress every
+    # ``PROGRESS_INTERVAL`` seconds. returns ``ShardProgress``. raises
+    # ``ShardError`` if a child is failed
+    
+    progress = ShardProgress()
+    reader_list = list(
+            threading.Thread(
+                    target=_reader_func,
+                    args=(shard.index, shard.read_fd, out, progress, print_func),
+                    )
+            for shard in shard_list)
+    
+    for reader in reader_list:
+        reader.start()
+    
+    for reader in reader_list:
+        while True:
+            reader.join(PROGRESS_INTERVAL)
+            
+            if not reader.is_alive():
+                break
+            
+            with progress.lock:
+                print_str = 'progress: good {}, bad {}, processes running {}'.format(
+                        progress.good_count,
+                        progress.bad_count,
+                        sum(1 for shard in shard_list if shard.proc.is_alive()),
+                        )
+                out.write(print_str, ext='out.log')
+                print_func(print_str)
+    
+    for shard in shard_list:
+        shard.proc.join()
+    
+    for shard in shard_list:
+        if shard.proc.exitcode != 0:
+            raise ShardError('process of shard_{} is failed with exit code {}'.format(
+                    shard.index,
+                    shard.proc.exitcode,
+                    ))
+    
+    return progress
@@ -0,0 +1,207 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import collections
+import heapq
+import itertools
+import time
+from . import phase_stats
+from . import live_metrics
+
+class Stage:
+    # queue of one stage with timers for put off items (like
+    # ``phase_retry.RetrySched``), served by ``worker_count`` threads
+    
+    def __init__(self, name, phase_name_set, worker_count):
+        self.name = name
+        self.phase_name_set = frozenset(phase_name_set)
+        self.worker_count = worker_count
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        self._heap = []
+        self._seq = itertools.count()
+        self._closed = False
+        self.step_count = 0
+        self.busy_time = 0.0
+    
+    def put(self, item, delay=None):
+        # this function is thread-safe
+        
+        with self._cond:
+            if delay:
+                heapq.heappush(
+                        self._heap,
+                        (time.monotonic() + delay, next(self._seq), item),
+                        )
+            else:
+                self._ready.append(item)
+            
+            self._cond.notify()
+    
+    def get(self):
+        # this function is thread-safe. returns ``None`` when stage is closed
+        
+        with self._cond:
+            while True:
+                if self._heap and self._heap[0][0] <= time.monotonic():
+                    retry_time, seq, item = heapq.heappop(self._heap)
+                    
+                    return item
+                
+                if self._ready:
+                    return self._ready.popleft()
+                
+                if self._closed:
+                    return
+                
+                if self._heap:
+                    self._cond.wait(self._heap[0][0] - time.monotonic())
+                else:
+                    self._cond.wait()
+    
+    def size(self):
+        # count of items which are waiting in stage
+        
+        return len(self._ready) + len(self._heap)
+    
+    def close(self):
+        # this function is thread-safe
+        
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    
+    def add_step(self, seconds):
+        # this function is thread-safe
+        
+        with self._cond:
+            self.step_count += 1
+            self.busy_time += seconds
+
+def run_pipeline(
+        stage_list,
+        get_item_func,
+        max_in_flight,
+        step_func,
+        next_phase_func,
+        done_func,
+        stats=None,
+        metrics=None,
+        ):
+    # runs items through stages. ``get_item_func()`` gives new items (it
+    # returns ``None`` when items are over), no more than ``max_in_flight``
+    # items are in progress. ``step_func(stage, item)`` runs phases of item
+    # of the stage, it returns delay (item stays in stage) or ``None``.
+    # ``next_phase_func(item)`` returns name of phase which item waits for
+    # (the item goes to stage of the phase) or ``None`` if it is finished
+    # (``done_func(item)`` is called then)
+    
+    if stats is None:
+        stats = phase_stats.DEFAULT_PHASE_STATS
+    
+    if metrics is None:
+        metrics = live_metrics.DEFAULT_LIVE_METRICS
+    
+    stage_map = {}
+    
+    for stage in stage_list:
+        for phase_name in stage.phase_name_set:
+            stage_map[phase_name] = stage
+        
+        metrics.set_gauge_func(
+                'queue_depth',
+                stage.size,
+                queue='stage_{}'.format(stage.name),
+                )
+    
+    in_flight_slots = threading.Semaphore(max_in_flight)
+    
+    def route(item):
+        phase_name = next_phase_func(item)
+        
+        if phase_name is None:
+            done_func(item)
+            in_flight_slots.release()
+            
+            return
+        
+        stage_map[phase_name].put(item)
+    
+    def worker_func(stage):
+        while True:
+            item = stage.get()
+            
+            if item is None:
+                break
+            
+            metrics.add('stage_busy_workers', stage=stage.name)
+            start_time = time.monotonic()
+            
+            try:
+                delay = step_func(stage, item)
+            finally:
+                seconds = time.monotonic() - start_time
+                
+                metrics.add('stage_busy_workers', -1, stage=stage.name)
+                metrics.add('stage_steps_total', stage=stage.name)
+                stats.record('stage.{}'.format(stage.name), seconds)
+                stage.add_step(seconds)
+            
+            if delay is not None:
+                stage.put(item, delay)
+                
+                continue
+            
+            route(item)
+    
+    thread_list = list(
+            threading.Thread(target=worker_func, args=(stage,))
+            for stage in stage_list
+            for worker_i in range(stage.worker_count))
+    
+    for thread in thread_list:
+        thread.start()
+    
+    while True:
+        in_flight_slots.acquire()
+        item = get_item_func()
+        
+        if item is None:
+            in_flight_slots.release()
+            
+            break
+        
+        route(item)
+    
+    # all items are finished when all slots are free
+    
+    for slot_i in range(max_in_flight):
+        in_flight_slots.acquire()
+    
+    for stage in stage_list:
+        stage.close()
+    
+    for thread in thread_list:
+        thread.join()
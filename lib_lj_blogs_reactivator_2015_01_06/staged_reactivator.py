@@ -0,0 +1,96 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import time
+from . import reactivator
+
+# phases for staged pipeline (see ``stage_pipeline``). ``mail_phase`` here
+# does one check of mailbox per call and returns delay before the next check,
+# so one worker of mail stage serves many jobs. IMAP session goes back to pool
+# between checks
+
+def mail_phase(lj_reac_ctx):
+    if lj_reac_ctx.mail_deadline is None:
+        reactivator.mail_prepare(lj_reac_ctx)
+        
+        lj_reac_ctx.mail_deadline = reactivator.budget_deadline(
+                lj_reac_ctx,
+                time.monotonic() + reactivator.MAIL_WAIT_TIMEOUT,
+                )
+        lj_reac_ctx.mail_check_delay = reactivator.MAIL_CHECK_MIN_DELAY
+    
+    try:
+        confirm_url = reactivator.find_confirm_url(reactivator.mail_fetch(
+                lj_reac_ctx.email,
+                lj_reac_ctx.mail_service,
+                lj_reac_ctx.email_login,
+                lj_reac_ctx.email_pass,
+                imap_pool=lj_reac_ctx.imap_pool,
+                uid_cache=lj_reac_ctx.uid_cache,
+                stats=lj_reac_ctx.stats,
+                rate_limiter=lj_reac_ctx.rate_limiter,
+                timeout=reactivator.budget_timeout(
+                        lj_reac_ctx,
+                        reactivator.IMAP_CONNECT_TIMEOUT,
+                        ),
+                ))
+        
+        if confirm_url is None:
+            remaining = lj_reac_ctx.mail_deadline - time.monotonic()
+            
+            if remaining <= 0.0:
+                raise reactivator.MailNotReceivedError(
+                        'confirm_url not received',
+                        )
+            
+            delay = min(lj_reac_ctx.mail_check_delay, remaining)
+            lj_reac_ctx.mail_check_delay = min(
+                    lj_reac_ctx.mail_check_delay * 2.0,
+                    reactivator.MAIL_CHECK_MAX_DELAY,
+                    )
+            
+            return delay
+    except:
+        # the next try of phase waits for mail from the beginning
+        
+        lj_reac_ctx.mail_deadline = None
+        
+        raise
+    
+    lj_reac_ctx.mail_deadline = None
+    lj_reac_ctx.confirm_url = confirm_url
+
+PHASE_LIST = (
+        reactivator.login_phase,
+        reactivator.send_valid_phase,
+        mail_phase,
+        reactivator.confirm_phase,
+        )
+
+# stages of pipeline: (name, names of phases)
+STAGE_LIST = (
+        ('send', ('login_phase', 'send_valid_phase')),
+        ('mail', ('mail_phase',)),
+        ('confirm', ('confirm_phase',)),
+        )
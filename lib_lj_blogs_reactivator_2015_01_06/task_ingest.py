@@ -0,0 +1,149 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import queue
+import collections
+import csv
+
+DEFAULT_PREFETCH = 1000
+DEFAULT_BATCH_SIZE = 50
+
+class TaskIngest:
+    # reads in csv-file in separate thread. rows are converted to tasks by
+    # ``new_task_func(row_i, row)`` and are given to workers by ``get()``.
+    #
+    # read-ahead is limited by ``prefetch`` tasks: the reader waits when
+    # workers are slower (back-pressure). tasks are passed by batches, and
+    # workers take them from shared deque without locking (a lock is taken
+    # only for getting the next batch)
+    
+    def __init__(self, in_fd, new_task_func, prefetch=None, batch_size=None):
+        if prefetch is None:
+            prefetch = DEFAULT_PREFETCH
+        
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        
+        batch_size = max(1, min(batch_size, prefetch))
+        
+        self._in_fd = in_fd
+        self._new_task_func = new_task_func
+        self._batch_size = batch_size
+        self._batch_queue = queue.Queue(maxsize=max(1, prefetch // batch_size))
+        self._ready = collections.deque()
+        self._refill_lock = threading.Lock()
+        self._done = False
+        self._thread = None
+        self.error = None
+        self.row_count = 0
+        self.task_count = 0
+        self.empty_count = 0
+        self.malformed_count = 0
+        self.skipped_count = 0
+    
+    def _reader_func(self):
+        batch = []
+        
+        try:
+            for row_i, row in enumerate(csv.reader(self._in_fd)):
+                self.row_count += 1
+                
+                if not row:
+                    self.empty_count += 1
+                    
+                    continue
+                
+                if len(row) != 4:
+                    self.malformed_count += 1
+                    
+                    continue
+                
+                task = self._new_task_func(row_i, row)
+                
+                if task is None:
+                    self.skipped_count += 1
+                    
+                    continue
+                
+                self.task_count += 1
+                batch.append(task)
+                
+                if len(batch) >= self._batch_size:
+                    self._batch_queue.put(batch)
+                    batch = []
+        except Exception as err:
+            self.error = err
+        finally:
+            if batch:
+                self._batch_queue.put(batch)
+            
+            self._batch_queue.put(None)
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._reader_func, daemon=True)
+        self._thread.start()
+    
+    def get(self):
+        # this function is thread-safe. returns ``None`` when tasks are over
+        
+        while True:
+            try:
+                return self._ready.popleft()
+            except IndexError:
+                pass
+            
+            with self._refill_lock:
+                if self._ready:
+                    continue
+                
+                if self._done:
+                    return
+                
+                batch = self._batch_queue.get()
+                
+                if batch is None:
+                    self._done = True
+                    
+                    return
+                
+                self._ready.extend(batch)
+    
+    def queue_size(self):
+        # approximate count of tasks which were read ahead
+        
+        return self._batch_queue.qsize() * self._batch_size + len(self._ready)
+    
+    def __iter__(self):
+        while True:
+            task = self.get()
+            
+            if task is None:
+                return
+            
+            yield task
+    
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
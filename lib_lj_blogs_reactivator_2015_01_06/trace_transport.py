@@ -0,0 +1,587 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import threading
+import socket
+import time
+import io
+import re
+import gzip
+import zlib
+import json
+import http.client
+from urllib import request as url_request
+from urllib import response as url_response
+from urllib import error as url_error
+from . import reactivator
+
+# record/replay transport: HTTP exchanges of openers (see
+# ``reactivator.build_opener()``) and IMAP sessions (see
+# ``reactivator.IMAP_CLASS``) are recorded into trace file, and then they
+# are replayed without network. the trace is gzip-compressed JSON lines:
+#
+#   {"type": "http", "method": ..., "url": ..., "latency": ..., "status": ...,
+#           "reason": ..., "headers": [[name, value], ...], "body": ...}
+#   {"type": "http", "method": ..., "url": ..., "latency": ..., "error": ...}
+#   {"type": "imap-greeting", "host": ..., "port": ..., "events": [...]}
+#   {"type": "imap", "host": ..., "port": ..., "login": ..., "verb": ...,
+#           "tag": ..., "events": [["c" or "s", delay, data], ...]}
+#
+# bytes are kept as latin-1 strings. IMAP events are data sent by client
+# (``c``) and data received from server (``s``) with delays after previous
+# event. HTTP exchanges are matched by method and URL (or by method and
+# directory of URL when exact URL is not recorded, e.g. other confirm URL).
+# IMAP exchanges are matched by login and command (login which is not
+# recorded is mapped to recorded one). recorded entries are used in cycle, so
+# small trace can be replayed for many accounts
+
+class TraceError(Exception):
+    pass
+
+class TraceWriter:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._fd = gzip.open(path, 'wt', encoding='utf-8', newline='\n')
+        self.record_count = 0
+    
+    def write(self, record):
+        # this function is thread-safe
+        
+        line = json.dumps(record, separators=(',', ':'))
+        
+        with self._lock:
+            if self._fd is None:
+                return
+            
+            self._fd.write('{}\n'.format(line))
+            self.record_count += 1
+    
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+
+def url_dir_key(method, url):
+    return method, url.split('?', 1)[0].rsplit('/', 1)[0]
+
+class CycleMap:
+    # key -> recorded entries, which are given in cycle
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry_list_map = {}
+        self._pos_map = {}
+    
+    def add(self, key, entry):
+        self._entry_list_map.setdefault(key, []).append(entry)
+    
+    def __contains__(self, key):
+        return key in self._entry_list_map
+    
+    def next(self, key):
+        # this function is thread-safe
+        
+        entry_list = self._entry_list_map.get(key)
+        
+        if not entry_list:
+            return
+        
+        with self._lock:
+            pos = self._pos_map.get(key, 0)
+            self._pos_map[key] = pos + 1
+        
+        return entry_list[pos % len(entry_list)]
+
+class TraceReader:
+    def __init__(self, path, latency_scale=None):
+        # ``latency_scale``: recorded latencies are multiplied by it (``0.0``
+        # is replaying without delays)
+        
+        if latency_scale is None:
+            latency_scale = 1.0
+        
+        self.latency_scale = latency_scale
+        self.http_map = CycleMap()
+        self.http_dir_map = CycleMap()
+        self.imap_greeting_map = CycleMap()
+        # (host, port, login, verb) -> list of exchanges
+        self.imap_exchange_map = {}
+        # (host, port) -> list of recorded logins
+        self.imap_login_map = {}
+        
+        with gzip.open(path, 'rt', encoding='utf-8') as fd:
+            for line in fd:
+                if not line.endswith('\n'):
+                    # broken last line
+                    
+                    break
+                
+                record = json.loads(line)
+                
+                if record['type'] == 'http':
+                    self.http_map.add((record['method'], record['url']), record)
+                    self.http_dir_map.add(
+                            url_dir_key(record['method'], record['url']),
+                            record,
+                            )
+                elif record['type'] == 'imap-greeting':
+                    self.imap_greeting_map.add(
+                            (record['host'], record['port']),
+                            record,
+                            )
+                elif record['type'] == 'imap':
+                    self.imap_exchange_map.setdefault(
+                            (record['host'], record['port'], record['login'],
+                                    record['verb']),
+                            [],
+                            ).append(record)
+                    login_list = self.imap_login_map.setdefault(
+                            (record['host'], record['port']),
+                            [],
+                            )
+                    
+                    if record['login'] is not None and \
+                            record['login'] not in login_list:
+                        login_list.append(record['login'])
+    
+    def map_imap_login(self, host, port, login):
+        # login which is not recorded is replaced by one of recorded logins
+        # (always the same one)
+        
+        login_list = self.imap_login_map.get((host, port))
+        
+        if login is None or not login_list or login in login_list:
+            return login
+        
+        return login_list[zlib.crc32(login.encode()) % len(login_list)]
+    
+    def sleep(self, delay):
+        delay *= self.latency_scale
+        
+        if delay > 0.0:
+            time.sleep(delay)
+
+def new_http_response(req, record):
+    headers = http.client.HTTPMessage()
+    
+    for name, value in record['headers']:
+        headers[name] = value
+    
+    resp = url_response.addinfourl(
+            io.BytesIO(record['body'].encode('latin-1')),
+            headers,
+            req.full_url,
+            record['status'],
+            )
+    resp.msg = record['reason']
+    
+    return resp
+
+class RecordHttpHandler(url_request.BaseHandler):
+    # is called before default handlers of opener
+    handler_order = 100
+    
+    def __init__(self, trace_writer):
+        self._trace_writer = trace_writer
+    
+    def _open(self, req, inner_open_func):
+        record = {
+                'type': 'http',
+                'method': req.get_method(),
+                'url': req.full_url,
+                }
+        start_time = time.monotonic()
+        
+        try:
+            resp = inner_open_func(req)
+            
+            try:
+                body = resp.read(reactivator.REQUEST_READ_LIMIT)
+            finally:
+                resp.close()
+        except OSError as err:
+            record['latency'] = time.monotonic() - start_time
+            record['error'] = str(err)
+            self._trace_writer.write(record)
+            
+            raise
+        
+        record['latency'] = time.monotonic() - start_time
+        record['status'] = resp.status
+        record['reason'] = resp.reason
+        record['headers'] = list(list(item) for item in resp.headers.items())
+        record['body'] = body.decode('latin-1')
+        self._trace_writer.write(record)
+        
+        return new_http_response(req, record)
+    
+    def http_open(self, req):
+        return self._open(req, url_request.HTTPHandler().http_open)
+    
+    def https_open(self, req):
+        return self._open(req, url_request.HTTPSHandler().https_open)
+
+class ReplayHttpHandler(url_request.BaseHandler):
+    handler_order = 100
+    
+    def __init__(self, trace_reader):
+        self._trace_reader = trace_reader
+    
+    def http_open(self, req):
+        trace_reader = self._trace_reader
+        method = req.get_method()
+        record = trace_reader.http_map.next((method, req.full_url))
+        
+        if record is None:
+            record = trace_reader.http_dir_map.next(
+                    url_dir_key(method, req.full_url),
+                    )
+        
+        if record is None:
+            raise url_error.URLError(
+                    'not found in trace: {} {}'.format(method, req.full_url),
+                    )
+        
+        trace_reader.sleep(record['latency'])
+        
+        if 'error' in record:
+            raise url_error.URLError(record['error'])
+        
+        return new_http_response(req, record)
+    
+    https_open = http_open
+
+IMAP_LITERAL_RE = re.compile(rb'\{\d+\}\r\n$')
+IMAP_TAG_RE = re.compile(rb'(?P<tag>[A-Z]+\d+) (?P<uid>UID )?(?P<verb>[A-Za-z]+)')
+
+def imap_login_arg(line):
+    # returns login from line of LOGIN command
+    
+    arg_list = line.split(None, 3)
+    
+    if len(arg_list) < 3:
+        return
+    
+    return arg_list[2].strip(b'"').decode('utf-8', 'replace')
+
+def split_imap_events(host, port, event_list):
+    # splits events of session into records: greeting and exchanges (command
+    # of client, including continuation data like ``DONE`` of IDLE, and
+    # responses of server until tagged response)
+    
+    record_list = []
+    record = {
+            'type': 'imap-greeting',
+            'host': host,
+            'port': port,
+            'events': [],
+            }
+    login = None
+    
+    for direction, delay, data in event_list:
+        tag_match = IMAP_TAG_RE.match(data.encode('latin-1')) \
+                if direction == 'c' else None
+        
+        if tag_match is not None:
+            verb = tag_match.group('verb').upper().decode()
+            
+            if tag_match.group('uid'):
+                verb = 'UID {}'.format(verb)
+            
+            if verb == 'LOGIN':
+                login = imap_login_arg(data.encode('latin-1'))
+            
+            record_list.append(record)
+            record = {
+                    'type': 'imap',
+                    'host': host,
+                    'port': port,
+                    'login': login,
+                    'verb': verb,
+                    'tag': tag_match.group('tag').decode(),
+                    'events': [],
+                    }
+        
+        record['events'].append((direction, delay, data))
+    
+    record_list.append(record)
+    
+    return record_list
+
+class RecordIMAP4(reactivator.SafeIMAP4):
+    trace_writer = None
+    
+    def __init__(self, *args, **kwargs):
+        # events are kept before connecting: ``shutdown()`` should not fail
+        # when the socket is not created
+        
+        self._trace_events = []
+        self._trace_time = time.monotonic()
+        
+        super().__init__(*args, **kwargs)
+    
+    def _create_socket(self, timeout=None):
+        sock = super()._create_socket(timeout=timeout)
+        self._trace_time = time.monotonic()
+        
+        return sock
+    
+    def _trace_event(self, direction, data):
+        now = time.monotonic()
+        self._trace_events.append((direction, now - self._trace_time, data.decode('latin-1')))
+        self._trace_time = now
+    
+    def read(self, size):
+        data = super().read(size)
+        self._trace_event('s', data)
+        
+        return data
+    
+    def readline(self):
+        line = super().readline()
+        self._trace_event('s', line)
+        
+        return line
+    
+    def send(self, data):
+        self._trace_event('c', data)
+        
+        return super().send(data)
+    
+    def shutdown(self):
+        try:
+            super().shutdown()
+        finally:
+            for record in split_imap_events(self.host, self.port, self._trace_events):
+                self.trace_writer.write(record)
+
+class ImapReplayServer:
+    # plays server side of IMAP session from recorded exchanges. exchange is
+    # chosen by login and command (data of client is not checked else), and
+    # tag of recorded exchange is replaced by tag of client
+    
+    def __init__(self, sock, trace_reader, host, port):
+        self._sock = sock
+        self._trace_reader = trace_reader
+        self._host = host
+        self._port = port
+        self._buf = b''
+        # (recorded login, login of client): recorded login is replaced in
+        # responses when login of client is not recorded
+        self._login_pair = None
+        # exchanges of every mailbox are replayed in recorded order (in
+        # cycle) from beginning of every session
+        self._pos_map = {}
+    
+    def _recv_chunk(self, size=None):
+        # returns line (``size`` is ``None``) or ``size`` bytes
+        
+        while (b'\r\n' not in self._buf) if size is None else \
+                (len(self._buf) < size):
+            data = self._sock.recv(65536)
+            
+            if not data:
+                raise EOFError
+            
+            self._buf += data
+        
+        chunk_size = self._buf.index(b'\r\n') + 2 if size is None else size
+        chunk, self._buf = self._buf[:chunk_size], self._buf[chunk_size:]
+        
+        return chunk
+    
+    def _play(self, event_list, rec_tag=None, tag=None):
+        if rec_tag is not None:
+            rec_tag_re = re.compile(rb'(?m)^' + re.escape(rec_tag) + rb'(?= )')
+        
+        literal_line = None
+        
+        for direction, delay, data in event_list:
+            data = data.encode('latin-1')
+            
+            if direction == 'c':
+                self._recv_chunk(None if data.endswith(b'\r\n') else len(data))
+                
+                continue
+            
+            self._trace_reader.sleep(delay)
+            
+            if rec_tag is not None:
+                data = rec_tag_re.sub(tag, data)
+            
+            if self._login_pair is not None:
+                data = data.replace(*self._login_pair)
+            
+            if literal_line is not None:
+                # size of literal can be changed by replacing of login
+                
+                data = literal_line[:literal_line.rindex(b'{')] + \
+                        '{{{}}}\r\n'.format(len(data)).encode() + data
+                literal_line = None
+            elif IMAP_LITERAL_RE.search(data) is not None:
+                literal_line = data
+                
+                continue
+            
+            self._sock.sendall(data)
+    
+    def _find_record(self, login, verb):
+        key = self._host, self._port, login, verb
+        record_list = self._trace_reader.imap_exchange_map.get(key)
+        
+        if not record_list:
+            return
+        
+        pos = self._pos_map.get(key, 0)
+        self._pos_map[key] = pos + 1
+        
+        return record_list[pos % len(record_list)]
+    
+    def run(self):
+        trace_reader = self._trace_reader
+        login = None
+        
+        try:
+            with self._sock:
+                greeting = trace_reader.imap_greeting_map.next((self._host, self._port))
+                
+                if greeting is not None:
+                    self._play(greeting['events'])
+                
+                while True:
+                    line = self._recv_chunk()
+                    tag_match = IMAP_TAG_RE.match(line)
+                    
+                    if tag_match is None:
+                        continue
+                    
+                    tag = tag_match.group('tag')
+                    verb = tag_match.group('verb').upper().decode()
+                    
+                    if tag_match.group('uid'):
+                        verb = 'UID {}'.format(verb)
+                    
+                    if verb == 'LOGIN':
+                        client_login = imap_login_arg(line)
+                        login = trace_reader.map_imap_login(
+                                self._host,
+                                self._port,
+                                client_login,
+                                )
+                        
+                        if login != client_login:
+                            self._login_pair = login.encode(), client_login.encode()
+                        else:
+                            self._login_pair = None
+                    
+                    record = self._find_record(login, verb)
+                    
+                    if record is None:
+                        self._sock.sendall(tag + b' BAD not found in trace\r\n')
+                        
+                        continue
+                    
+                    # first event is the command itself: it is received
+                    
+                    self._play(
+                            record['events'][1:],
+                            rec_tag=record['tag'].encode(),
+                            tag=tag,
+                            )
+                    
+                    if verb == 'LOGOUT':
+                        break
+        except (EOFError, OSError):
+            pass
+
+class ReplayIMAP4(reactivator.SafeIMAP4):
+    trace_reader = None
+    
+    def _create_socket(self, timeout=None):
+        if (self.host, self.port) not in self.trace_reader.imap_greeting_map:
+            raise TraceError(
+                    'not found in trace: imap {}:{}'.format(self.host, self.port),
+                    )
+        
+        sock, server_sock = socket.socketpair()
+        
+        threading.Thread(
+                target=ImapReplayServer(
+                        server_sock,
+                        self.trace_reader,
+                        self.host,
+                        self.port,
+                        ).run,
+                daemon=True,
+                ).start()
+        
+        return sock
+    
+    def starttls(self, ssl_context=None):
+        # recorded session is decrypted already
+        
+        name = 'STARTTLS'
+        
+        if self._tls_established:
+            raise self.abort('TLS session already established')
+        
+        if name not in self.capabilities:
+            raise self.abort('TLS not supported by server')
+        
+        typ, dat = self._simple_command(name)
+        
+        if typ != 'OK':
+            raise self.error("Couldn't establish TLS session")
+        
+        self._tls_established = True
+        self._get_capabilities()
+        
+        return self._untagged_response(typ, dat, name)
+
+def install_record(path):
+    # returns ``TraceWriter``, which should be closed after all IMAP sessions
+    
+    trace_writer = TraceWriter(path)
+    
+    reactivator.IMAP_CLASS = type(
+            'RecordIMAP4',
+            (RecordIMAP4,),
+            {'trace_writer': trace_writer},
+            )
+    reactivator.HTTP_HANDLER_FUNC = lambda: RecordHttpHandler(trace_writer)
+    
+    return trace_writer
+
+def install_replay(path, latency_scale=None):
+    trace_reader = TraceReader(path, latency_scale=latency_scale)
+    
+    reactivator.IMAP_CLASS = type(
+            'ReplayIMAP4',
+            (ReplayIMAP4,),
+            {'trace_reader': trace_reader},
+            )
+    reactivator.HTTP_HANDLER_FUNC = lambda: ReplayHttpHandler(trace_reader)
+    
+    return trace_reader
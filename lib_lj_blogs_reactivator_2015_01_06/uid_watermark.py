@@ -0,0 +1,115 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os, os.path, threading
+import csv
+
+class UidWatermarkCache:
+    # remembers (UIDVALIDITY, the highest checked UID) of every mailbox, so
+    # next checks search only new messages. if ``path`` is given (or
+    # ``load()`` is called), the cache is loaded from that file and changes
+    # are appended to it
+    
+    def __init__(self, path=None):
+        self._lock = threading.RLock()
+        self._map = {}
+        self._fd = None
+        self._csv_writer = None
+        self.hit_count = 0
+        self.miss_count = 0
+        
+        if path is not None:
+            self.load(path)
+    
+    def load(self, path):
+        # this function is not thread-safe. it must be called before using
+        
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8', newline='') as fd:
+                for row in csv.reader(fd):
+                    if len(row) != 5:
+                        continue
+                    
+                    imap_host, imap_port, email_login, uidvalidity, uid = row
+                    
+                    try:
+                        key = imap_host, int(imap_port), email_login
+                        self._map[key] = int(uidvalidity), int(uid)
+                    except ValueError:
+                        continue
+        
+        # the file is compacted: only the last value of every key is kept
+        
+        tmp_path = os.path.join(
+                os.path.dirname(path),
+                'new.{}'.format(os.path.basename(path)),
+                )
+        
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as fd:
+            csv_writer = csv.writer(fd)
+            
+            for key, value in self._map.items():
+                csv_writer.writerow(key + value)
+        
+        os.replace(tmp_path, path)
+        
+        self._fd = open(path, 'a', encoding='utf-8', newline='')
+        self._csv_writer = csv.writer(self._fd)
+    
+    def get(self, key, uidvalidity):
+        # this function is thread-safe. returns the highest checked UID or 0
+        
+        with self._lock:
+            value = self._map.get(key)
+            
+            if value is None or value[0] != uidvalidity:
+                self.miss_count += 1
+                
+                return 0
+            
+            self.hit_count += 1
+            
+            return value[1]
+    
+    def set(self, key, uidvalidity, uid):
+        # this function is thread-safe
+        
+        with self._lock:
+            value = self._map.get(key)
+            
+            if value is not None and value[0] == uidvalidity and value[1] >= uid:
+                return
+            
+            self._map[key] = uidvalidity, uid
+            
+            if self._csv_writer is not None:
+                self._csv_writer.writerow(key + (uidvalidity, uid))
+                self._fd.flush()
+    
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+                self._csv_writer = None
@@ -0,0 +1,330 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (c) 2015 Andrej Antonov <polymorphm@gmail.com> 
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+assert str is not bytes
+
+import os
+import socket
+import threading
+import collections
+import time
+import random
+import sqlite3
+
+DEFAULT_LEASE_TIME = 120.0
+DEFAULT_LEASE_BATCH_SIZE = 10
+PUT_BATCH_SIZE = 1000
+POLL_DELAY = 1.0
+BUSY_TIMEOUT = 60.0
+
+STATE_PENDING = 0
+STATE_LEASED = 1
+STATE_DONE = 2
+STATE_WRITTEN = 3
+
+# work queue of rows of in csv-file which is shared by several processes
+# (nodes) through SQLite-file: every node takes rows by lease (lease is
+# renewed while the node works with the row), and acknowledges the result.
+# leases of crashed nodes expire and rows are taken by other nodes. the
+# result is recorded only by ack of the owner of lease, so every row has one
+# result (exactly-once).
+#
+# the lease is kept after ack until the node confirms that the result is
+# written to its out files: if the node is crashed between, other node
+# takes the recorded result (the job is not repeated) and writes it
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS work_row (
+    row_i INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    email_pass TEXT NOT NULL,
+    lj_username TEXT NOT NULL,
+    lj_pass TEXT NOT NULL,
+    state INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expire REAL,
+    lease_count INTEGER NOT NULL DEFAULT 0,
+    status TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS work_row_state ON work_row (state, lease_expire);
+'''
+
+def new_owner():
+    return '{}-{}-{:08x}'.format(
+            socket.gethostname(),
+            os.getpid(),
+            random.getrandbits(32),
+            )
+
+class WorkQueue:
+    def __init__(self, path, lease_time=None, lease_batch_size=None):
+        if lease_time is None:
+            lease_time = DEFAULT_LEASE_TIME
+        
+        if lease_batch_size is None:
+            lease_batch_size = DEFAULT_LEASE_BATCH_SIZE
+        
+        self.owner = new_owner()
+        self._lease_time = lease_time
+        self._lease_batch_size = lease_batch_size
+        self._lock = threading.Lock()
+        self._lease_lock = threading.Lock()
+        self._conn = sqlite3.connect(
+                path,
+                timeout=BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+                )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA_SQL)
+        self._put_list = []
+        self._ready = collections.deque()
+        self._renew_stop = threading.Event()
+        self._renew_thread = None
+        self.put_count = 0
+        self.lease_count = 0
+        self.expired_count = 0
+        self.ack_count = 0
+        self.lost_count = 0
+        self.recovered_count = 0
+    
+    def _transaction(self, func):
+        # lock of SQLite-file is taken at begin (``BEGIN IMMEDIATE``), so
+        # nodes do not fail on upgrade of read lock
+        
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            
+            try:
+                result = func(self._conn)
+            except:
+                self._conn.execute('ROLLBACK')
+                
+                raise
+            
+            self._conn.execute('COMMIT')
+        
+        return result
+    
+    def put(self, row_i, row):
+        # this function is not thread-safe (it is called by reader of in
+        # csv-file). rows are inserted by batches. every node is given the
+        # same in csv-file: rows which are in the queue already are ignored
+        
+        self._put_list.append((row_i,) + tuple(row))
+        
+        if len(self._put_list) >= PUT_BATCH_SIZE:
+            self.flush()
+    
+    def flush(self):
+        put_list = self._put_list
+        self._put_list = []
+        
+        if not put_list:
+            return
+        
+        def put_func(conn):
+            cur = conn.executemany(
+                    'INSERT OR IGNORE INTO work_row '
+                    '(row_i, email, email_pass, lj_username, lj_pass) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    put_list,
+                    )
+            
+            return cur.rowcount
+        
+        self.put_count += self._transaction(put_func)
+    
+    def _lease(self):
+        now = time.time()
+        
+        def lease_func(conn):
+            lease_list = conn.execute(
+                    'SELECT row_i, email, email_pass, lj_username, lj_pass, '
+                    'state, status, error FROM work_row WHERE state = ? OR '
+                    '(state IN (?, ?) AND lease_expire < ?) ORDER BY row_i '
+                    'LIMIT ?',
+                    (
+                            STATE_PENDING,
+                            STATE_LEASED,
+                            STATE_DONE,
+                            now,
+                            self._lease_batch_size,
+                            ),
+                    ).fetchall()
+            
+            conn.executemany(
+                    'UPDATE work_row SET state = ?, lease_owner = ?, '
+                    'lease_expire = ?, lease_count = lease_count + 1 '
+                    'WHERE row_i = ?',
+                    list(
+                            (
+                                    STATE_DONE if lease[5] == STATE_DONE else STATE_LEASED,
+                                    self.owner,
+                                    now + self._lease_time,
+                                    lease[0],
+                                    )
+                            for lease in lease_list),
+                    )
+            
+            return lease_list
+        
+        lease_list = self._transaction(lease_func)
+        
+        for lease in lease_list:
+            self.lease_count += 1
+            
+            if lease[5] == STATE_DONE:
+                self.recovered_count += 1
+                result = lease[6:8]
+            else:
+                if lease[5] == STATE_LEASED:
+                    self.expired_count += 1
+                
+                result = None
+            
+            self._ready.append((lease[0], lease[1:5], result))
+    
+    def get(self):
+        # this function is thread-safe. returns (row_i, row, result) of
+        # leased row or ``None`` when there are no rows to lease now. rows
+        # which are leased by other nodes may be leased later (see
+        # ``wait_for_leases()``). ``result`` is (status, error) if the result
+        # is recorded already, but is not written (``confirm()`` must be
+        # called after writing), or ``None``
+        
+        while True:
+            try:
+                return self._ready.popleft()
+            except IndexError:
+                pass
+            
+            with self._lease_lock:
+                if self._ready:
+                    continue
+                
+                self._lease()
+                
+                if not self._ready:
+                    return
+    
+    def ack(self, row_i, status, error=None):
+        # this function is thread-safe. records result of the row. returns
+        # ``False`` if lease of the row was lost (the row is expired and is
+        # taken by other node): the result must be dropped then. otherwise
+        # ``confirm()`` must be called after writing of the result
+        
+        def ack_func(conn):
+            cur = conn.execute(
+                    'UPDATE work_row SET state = ?, status = ?, error = ? '
+                    'WHERE row_i = ? AND state = ? AND lease_owner = ?',
+                    (STATE_DONE, status, error, row_i, STATE_LEASED, self.owner),
+                    )
+            
+            return cur.rowcount == 1
+        
+        acked = self._transaction(ack_func)
+        
+        if acked:
+            self.ack_count += 1
+        else:
+            self.lost_count += 1
+        
+        return acked
+    
+    def confirm(self, row_i):
+        # this function is thread-safe. the result of the row is written: the
+        # lease is released
+        
+        def confirm_func(conn):
+            conn.execute(
+                    'UPDATE work_row SET state = ?, lease_expire = NULL '
+                    'WHERE row_i = ? AND state = ? AND lease_owner = ?',
+                    (STATE_WRITTEN, row_i, STATE_DONE, self.owner),
+                    )
+        
+        self._transaction(confirm_func)
+    
+    def wait_for_leases(self):
+        # waits while rows are leased by other nodes and nothing can be
+        # leased. returns ``True`` when there are rows to lease (left by
+        # crashed node), or ``False`` when all rows are done. rows of this
+        # node are not waited for: they are done, and they are confirmed when
+        # out files are written
+        
+        while not self._renew_stop.is_set():
+            with self._lock:
+                row_count, leasable_count = self._conn.execute(
+                        'SELECT COUNT(*), SUM(state = ? OR lease_expire < ?) '
+                        'FROM work_row WHERE state != ? AND '
+                        '(state = ? OR lease_owner != ?)',
+                        (
+                                STATE_PENDING,
+                                time.time(),
+                                STATE_WRITTEN,
+                                STATE_PENDING,
+                                self.owner,
+                                ),
+                        ).fetchone()
+            
+            if not row_count:
+                return False
+            
+            if leasable_count:
+                return True
+            
+            self._renew_stop.wait(POLL_DELAY)
+        
+        return False
+    
+    def _renew_func(self):
+        while not self._renew_stop.wait(self._lease_time / 3):
+            def renew_func(conn):
+                conn.execute(
+                        'UPDATE work_row SET lease_expire = ? WHERE state IN '
+                        '(?, ?) AND lease_owner = ?',
+                        (
+                                time.time() + self._lease_time,
+                                STATE_LEASED,
+                                STATE_DONE,
+                                self.owner,
+                                ),
+                        )
+            
+            self._transaction(renew_func)
+    
+    def start(self):
+        # starts renewal of leases of the node
+        
+        self._renew_thread = threading.Thread(target=self._renew_func, daemon=True)
+        self._renew_thread.start()
+    
+    def close(self):
+        self._renew_stop.set()
+        
+        if self._renew_thread is not None:
+            self._renew_thread.join()
+            self._renew_thread = None
+        
+        with self._lock:
+            self._conn.close()